@@ -0,0 +1,88 @@
+"""Benchmark vectorized corner matching against the original per-point loop.
+
+Runs on every dataset in `src/tests/data` that has its `1.ply` pointcloud available:
+
+    python benchmarks/corner_matching.py
+"""
+import json
+import os
+import time
+import cv2
+import numpy as np
+import open3d
+import depthquality.meshes as meshes
+import depthquality.quality as quality
+from depthquality.fiducials import detect_arucos
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "tests", "data")
+DATASETS = {
+    "vert_cylinders": "VERTICAL_CYLINDERS",
+    "horiz_cylinders": "HORIZONTAL_CYLINDERS",
+    "spheres": "SPHERES",
+    "angled_plates": "ANGLED_PLATES",
+}
+
+
+def loop_compute_corner_coordinates(pointcloud, camera_matrix, corner_list):
+    """The original implementation of `quality.compute_corner_coordinates`, point by point."""
+    corner_coordinates = {}
+    for entry in corner_list:
+        corner_coordinates[entry] = []
+
+    for point in np.asarray(pointcloud.points):
+        u = np.floor(camera_matrix["fx"] * point[0] / point[2] + camera_matrix["ppx"])
+        v = np.floor(camera_matrix["fy"] * point[1] / point[2] + camera_matrix["ppy"])
+
+        matched_corner = quality.fuzzy_match_corner(u, v, corner_list)
+        if matched_corner:
+            corner_coordinates[matched_corner].append(point)
+
+    return {key: np.mean(val, axis=0) for key, val in corner_coordinates.items() if val}
+
+
+def time_call(function, *args, repeat=1):
+    """Return the result of function(*args) and the best wall-clock time over repeat runs."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    print("{:<16} {:>9} {:>10} {:>12} {:>9}".format(
+        "dataset", "points", "loop (s)", "vector (s)", "speedup"))
+    for dataset, mesh_name in DATASETS.items():
+        folder = os.path.join(DATA_DIR, dataset)
+        pointcloud_filename = os.path.join(folder, "1.ply")
+        if not os.path.exists(pointcloud_filename):
+            print("{:<16} skipped, no 1.ply".format(dataset))
+            continue
+
+        reference_mesh = getattr(meshes, mesh_name)
+        with open(os.path.join(folder, "camera_matrix.json"), 'r') as j_file:
+            camera_matrix = json.load(j_file)
+        detected_arucos = detect_arucos(cv2.imread(os.path.join(folder, "1.png")))
+        corner_list = [
+            (int(corner[1]), int(corner[0]))
+            for aruco_id, corners in detected_arucos.items()
+            if aruco_id in reference_mesh.fiducial_locations.keys()
+            for corner in corners.values()]
+        pointcloud = open3d.io.read_point_cloud(pointcloud_filename)
+
+        expected, loop_time = time_call(
+            loop_compute_corner_coordinates, pointcloud, camera_matrix, corner_list)
+        actual, vector_time = time_call(
+            quality.compute_corner_coordinates, pointcloud, camera_matrix, corner_list, repeat=5)
+
+        assert expected.keys() == actual.keys()
+        for key, value in expected.items():
+            np.testing.assert_allclose(actual[key], value, rtol=1e-9)
+
+        print("{:<16} {:>9} {:>10.3f} {:>12.4f} {:>8.0f}x".format(
+            dataset, len(pointcloud.points), loop_time, vector_time, loop_time / vector_time))
+
+
+if __name__ == '__main__':
+    main()
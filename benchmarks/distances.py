@@ -0,0 +1,51 @@
+"""Benchmark point-to-mesh distance throughput, in points per second, for every backend.
+
+Points are scattered around the surface of each bundled reference mesh like a pointcloud:
+
+    python benchmarks/distances.py [num_points]
+"""
+import os
+import sys
+import time
+import numpy as np
+import pymesh
+import depthquality.distances as distances
+
+MESH_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "meshes")
+MESH_FILENAMES = ["vertical_cylinders.obj", "horizontal_cylinders.obj", "angled_plates.obj"]
+
+
+def sample_points(mesh, num_points, noise=2.0, seed=0):
+    """Return points on random faces of the mesh, with gaussian noise of `noise` mm."""
+    rng = np.random.RandomState(seed)
+    faces = rng.randint(len(mesh.faces), size=num_points)
+    barycentric = rng.dirichlet([1, 1, 1], size=num_points)
+    points = np.einsum("ij,ijk->ik", barycentric, mesh.vertices[mesh.faces[faces]])
+    return points + rng.normal(scale=noise, size=points.shape)
+
+
+def throughput(function, points):
+    start = time.perf_counter()
+    function(points)
+    return len(points) / (time.perf_counter() - start)
+
+
+def main(num_points=200000):
+    print("{:<26} {:>12} {:>12} {:>12} {:>12}".format(
+        "mesh", "pymesh", "bvh (1)", "bvh ({})".format(os.cpu_count()), "field"))
+    for mesh_filename in MESH_FILENAMES:
+        mesh = pymesh.load_mesh(os.path.join(MESH_DIR, mesh_filename))
+        points = sample_points(mesh, num_points)
+        tree = distances.TriangleTree(mesh.vertices, mesh.faces)
+        distance_field = distances.get_distance_field(mesh)
+
+        print("{:<26} {:>12.0f} {:>12.0f} {:>12.0f} {:>12.0f}".format(
+            mesh_filename,
+            throughput(lambda p: distances.exact_squared_distances(mesh, p), points),
+            throughput(lambda p: tree.query(p, workers=1), points),
+            throughput(tree.query, points),
+            throughput(distance_field.squared_distances, points)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,254 @@
+"""Benchmark every stage of the evaluation pipeline, on real and synthetic captures.
+
+Every bundled reference mesh is rendered with `depthquality.synthetic` at a resolution giving
+each of the requested pointcloud sizes, and the real captures in `src/tests/data` are added
+whenever their `1.ply` pointcloud is available. The stages are timed one by one:
+
+    python benchmarks/pipeline.py --output timings.json
+    python benchmarks/pipeline.py --baseline timings.json --tolerance 0.2
+
+With a baseline, any stage that got slower than the tolerance allows is reported, and the
+script exits with status 1. The synthetic captures are cached in the depthquality cache
+directory, so only the first run pays for rendering them.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from collections import namedtuple
+import cv2
+import numpy as np
+import depthquality.meshes as meshes
+import depthquality.quality as quality
+import depthquality.synthetic as synthetic
+from depthquality import caching
+from depthquality import depthimages
+from depthquality import plyfiles
+from depthquality.fiducials import detect_arucos
+
+# version of the results format, bump whenever it changes
+RESULTS_VERSION = 1
+
+STAGES = (
+    "image_load", "aruco_detection", "cloud_load", "corner_matching", "rigid_fit", "crop",
+    "distance_query", "surface_area")
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "tests", "data")
+MESH_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "meshes")
+DATASETS = {
+    "vert_cylinders": "VERTICAL_CYLINDERS",
+    "horiz_cylinders": "HORIZONTAL_CYLINDERS",
+    "spheres": "SPHERES",
+    "angled_plates": "ANGLED_PLATES",
+}
+DEFAULT_SIZES = (100000, 1000000, 5000000)
+DEPTH_SCALE = 0.001
+
+# a capture to benchmark; source is "real" or "synthetic"
+Case = namedtuple(
+    "Case", ("source", "mesh_name", "num_points", "rgb", "camera_matrix", "pointcloud"))
+
+# a stage that got slower than the baseline allows
+Regression = namedtuple(
+    "Regression", ("source", "mesh_name", "num_points", "stage", "baseline", "current"))
+
+
+def time_stages(reference_mesh, case, distance_method):
+    """Run the pipeline on a case once, and return the wall-clock time of every stage."""
+    timings = {}
+    start = time.perf_counter()
+
+    def lap(stage):
+        nonlocal start
+        now = time.perf_counter()
+        timings[stage] = now - start
+        start = now
+
+    img = cv2.imread(case.rgb)
+    camera_matrix = quality.read_camera_matrix(case.camera_matrix)
+    lap("image_load")
+    detected_arucos = detect_arucos(img)
+    lap("aruco_detection")
+    # the PLY is memory-mapped, so read all of its points here, or the stage that first touches
+    # them would be charged for the reads
+    points = np.array(plyfiles.read_ply_points(case.pointcloud))
+    lap("cloud_load")
+    corner_list = quality.get_corner_list(reference_mesh, detected_arucos)
+    corner_coordinates = quality.compute_corner_coordinates(points, camera_matrix, corner_list)
+    lap("corner_matching")
+    rigid_transform, camera_angle = quality.estimate_rigid_transform(
+        reference_mesh, detected_arucos, corner_coordinates, DEPTH_SCALE)
+    lap("rigid_fit")
+    # only the points of the pattern area are transformed, so the crop includes the transform
+    cropped_points, _ = quality.crop_to_pattern_area(
+        reference_mesh, points, rigid_transform, DEPTH_SCALE)
+    lap("crop")
+    reference_mesh.get_squared_distances(cropped_points / DEPTH_SCALE, method=distance_method)
+    lap("distance_query")
+    reference_mesh.get_pattern_surface_area(camera_angle=camera_angle)
+    lap("surface_area")
+    return timings
+
+
+def make_synthetic_case(mesh_name, num_points, data_dir):
+    """Render (or load the cached) synthetic capture of a mesh with exactly num_points points."""
+    directory = os.path.join(data_dir, "{}_{}".format(mesh_name.lower(), num_points))
+    case = Case("synthetic", mesh_name, num_points, os.path.join(directory, "0.png"),
+                os.path.join(directory, "camera_matrix.json"), os.path.join(directory, "0.ply"))
+    if all(os.path.exists(filename) for filename in case[3:]):
+        return case
+
+    # a 4:3 image with at least num_points pixels, where the fixture fills most of the view
+    width = int(np.ceil(np.sqrt(num_points * 4 / 3)))
+    height = int(np.ceil(width * 3 / 4))
+    camera_matrix = synthetic.make_camera_matrix(width, height, horizontal_fov=np.radians(45))
+    renderer = synthetic.CaptureRenderer(
+        getattr(meshes, mesh_name), camera_matrix, width, height)
+    capture = renderer.capture(
+        synthetic.look_at([20, -30, 350]), depth_scale=DEPTH_SCALE, noise=0.5,
+        rng=np.random.RandomState(0))
+
+    # every pixel has a point, like the pointclouds of most cameras: the ones that miss the
+    # fixture see a wall behind it, and a fixed subset of them is dropped to get num_points
+    depth = capture.depth.copy()
+    depth[depth == 0] = 1000
+    rng = np.random.RandomState(0)
+    is_kept = np.zeros(depth.size, dtype=bool)
+    is_kept[rng.choice(depth.size, num_points, replace=False)] = True
+    depth.flat[~is_kept] = 0
+    capture = capture._replace(depth=depth, points=depthimages.deproject_window(
+        depth, camera_matrix, DEPTH_SCALE))
+    synthetic.write_capture(directory, "0", capture)
+    return case
+
+
+def iter_cases(mesh_names, sizes, data_dir):
+    """Yield the real captures that are available, then the synthetic ones."""
+    for dataset, mesh_name in DATASETS.items():
+        folder = os.path.join(DATA_DIR, dataset)
+        pointcloud = os.path.join(folder, "1.ply")
+        if mesh_name in mesh_names and os.path.exists(pointcloud):
+            yield Case("real", mesh_name, len(plyfiles.read_ply_points(pointcloud)),
+                       os.path.join(folder, "1.png"),
+                       os.path.join(folder, "camera_matrix.json"), pointcloud)
+    for mesh_name in mesh_names:
+        for num_points in sizes:
+            yield make_synthetic_case(mesh_name, num_points, data_dir)
+
+
+def run_benchmarks(mesh_names, sizes, data_dir, distance_method="field", repeat=3):
+    """Return the results of every case, with the median time of every stage over repeat runs."""
+    results = []
+    for case in iter_cases(mesh_names, sizes, data_dir):
+        reference_mesh = getattr(meshes, case.mesh_name)
+        # one untimed run to build the lazily cached state (meshes, distance fields, tables)
+        time_stages(reference_mesh, case, distance_method)
+        runs = [time_stages(reference_mesh, case, distance_method) for _ in range(repeat)]
+        stages = {stage: float(np.median([run[stage] for run in runs])) for stage in STAGES}
+        results.append({
+            "source": case.source,
+            "mesh": case.mesh_name,
+            "num_points": case.num_points,
+            "stages": stages,
+            "total": sum(stages.values()),
+        })
+        print_result(results[-1])
+    return {
+        "version": RESULTS_VERSION,
+        "distance_method": distance_method,
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2, min_seconds=1e-3):
+    """Return the Regressions of the stages more than tolerance slower than in the baseline.
+
+    Stages that take less than min_seconds more than in the baseline are never reported, so
+    that the timer resolution of the fastest stages does not flag them.
+    """
+    baseline_stages = {
+        (result["source"], result["mesh"], result["num_points"]): result["stages"]
+        for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        key = (result["source"], result["mesh"], result["num_points"])
+        if key not in baseline_stages:
+            continue
+        for stage, current in result["stages"].items():
+            expected = baseline_stages[key].get(stage)
+            if expected is not None and current > expected * (1 + tolerance) and \
+                    current - expected > min_seconds:
+                regressions.append(Regression(*key, stage, expected, current))
+    return regressions
+
+
+def print_result(result):
+    if result["source"] == "real":
+        name = "{} (real)".format(result["mesh"].lower())
+    else:
+        name = result["mesh"].lower()
+    print("{:<22} {:>9} ".format(name, result["num_points"]) + " ".join(
+        "{:>9.4f}".format(result["stages"][stage]) for stage in STAGES) +
+        " {:>9.4f}".format(result["total"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--meshes", nargs="+", default=list(DATASETS.values()),
+                        help="the reference meshes to benchmark (default: all of them)")
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES),
+                        help="the number of points of the synthetic captures")
+    parser.add_argument("--distance-method", default="field", choices=meshes.DISTANCE_METHODS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--data-dir", default=os.path.join(caching.get_cache_dir(), "benchmarks"),
+                        help="where the synthetic captures are cached")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results to this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="the allowed slowdown of any stage, as a fraction of the baseline")
+    args = parser.parse_args(argv)
+
+    # meshes without their OBJ file (e.g. a checkout without the spheres) are skipped
+    mesh_names = []
+    for mesh_name in args.meshes:
+        filename = os.path.join(MESH_DIR, meshes.BUILTIN_MESH_FILENAMES[mesh_name])
+        if os.path.exists(filename):
+            mesh_names.append(mesh_name)
+        else:
+            print("{} skipped, no {}".format(mesh_name, filename))
+
+    print("{:<22} {:>9} ".format("capture", "points") + " ".join(
+        "{:>9}".format(stage[:9]) for stage in STAGES) + " {:>9}".format("total"))
+    results = run_benchmarks(
+        mesh_names, args.sizes, args.data_dir, distance_method=args.distance_method,
+        repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get("distance_method") != results["distance_method"]:
+            print("the baseline used the {} distance method, not {}".format(
+                baseline.get("distance_method"), results["distance_method"]))
+        regressions = compare_to_baseline(results, baseline, tolerance=args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {} {} {}: {} took {:.4f} s, baseline {:.4f} s".format(
+                regression.source, regression.mesh_name, regression.num_points,
+                regression.stage, regression.current, regression.baseline))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,14 +10,18 @@ if __name__ == '__main__':
         packages=['depthquality'],
         package_dir={'': 'src'},
         package_data={'depthquality': glob.glob('meshes/*.obj')},
+        entry_points={
+            'console_scripts': ['depth-quality = depthquality.cli:main'],
+        },
         author="Root AI",
         author_email="mprat@root-ai.com",
         description="Analyzing depth camera quality with 3D printed fixtures.",
         license="",
-        python_requires='>=3.5',
+        python_requires='>=3.8',
         install_requires=[
             "numpy>=1.16",
             "open3d-python>=0.14.1",
+            "scipy>=1.1",
             # we take a dependency on opencv-contrib-python because the
             # library for detecting ArUco markers is here
             "opencv-contrib-python>=3.0,<4.0"
@@ -0,0 +1,219 @@
+"""Evaluate many captures at once, in parallel over a pool of processes."""
+import csv
+import json
+import multiprocessing
+import os
+import traceback
+from collections import namedtuple
+import cv2
+import numpy as np
+import depthquality.meshes as meshes
+import depthquality.quality as quality
+import depthquality.sequences as sequences
+from depthquality import timing
+
+# one capture to evaluate; pointcloud is either a pointcloud (e.g. PLY) or an organized depth
+# image (PNG or `.npy`), and reference_mesh is the name of a built-in mesh or the path to an OBJ
+Capture = namedtuple(
+    "Capture", ("rgb", "camera_matrix", "pointcloud", "depth_scale", "reference_mesh"))
+
+# the result of evaluating a capture; error is None on success, and the traceback otherwise.
+# timings holds the timing.TimingEvents of its stages, when the timing is enabled
+CaptureResult = namedtuple(
+    "CaptureResult",
+    ("capture", "rmse", "density", "camera_angle", "num_points", "error", "timings"),
+    defaults=(None,))
+
+DEPTH_IMAGE_EXTENSIONS = (".png", ".npy")
+
+# reference meshes loaded from an OBJ path, once per process
+_custom_meshes = {}
+
+
+def get_reference_mesh(reference_mesh):
+    """Return the ReferenceMesh for a built-in mesh name or an OBJ path, loading it only once."""
+    if reference_mesh in meshes.BUILTIN_MESH_FILENAMES:
+        return meshes.get_builtin_mesh(reference_mesh)
+    if reference_mesh not in _custom_meshes:
+        _custom_meshes[reference_mesh] = meshes.ReferenceMesh(path=reference_mesh)
+    return _custom_meshes[reference_mesh]
+
+
+def read_manifest(filename):
+    """Read the captures listed in a CSV or JSON Lines manifest.
+
+    Every row or line has the fields of `Capture`. Relative paths are relative to the
+    directory of the manifest; reference_mesh can also be the name of a built-in mesh.
+    """
+    with open(filename, 'r') as f:
+        if os.path.splitext(filename)[1].lower() == ".csv":
+            records = list(csv.DictReader(f))
+        else:
+            records = [json.loads(line) for line in f if line.strip()]
+
+    base_dir = os.path.dirname(os.path.abspath(filename))
+
+    def resolve(path):
+        return os.path.join(base_dir, path)
+
+    captures = []
+    for record in records:
+        reference_mesh = record["reference_mesh"]
+        if reference_mesh not in meshes.BUILTIN_MESH_FILENAMES:
+            reference_mesh = resolve(reference_mesh)
+        captures.append(Capture(
+            rgb=resolve(record["rgb"]),
+            camera_matrix=resolve(record["camera_matrix"]),
+            pointcloud=resolve(record["pointcloud"]),
+            depth_scale=float(record["depth_scale"]),
+            reference_mesh=reference_mesh))
+    return captures
+
+
+def read_capture_directory(directory, reference_mesh, depth_scale):
+    """Return the captures in a directory tree, all of the same reference mesh and depth scale.
+
+    Every directory holding a `camera_matrix.json` is a capture directory, whose captures are
+    the frames of `sequences.iter_directory`: an RGB image `<name>.png` next to a pointcloud
+    `<name>.ply`, or a depth image `<name>.npy` or `<name>_depth.png`.
+    """
+    captures = []
+    for root, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        if "camera_matrix.json" not in filenames:
+            continue
+        for frame in sequences.iter_directory(root):
+            captures.append(Capture(
+                rgb=frame.rgb,
+                camera_matrix=os.path.join(root, "camera_matrix.json"),
+                pointcloud=frame.depth,
+                depth_scale=depth_scale,
+                reference_mesh=reference_mesh))
+    return captures
+
+
+def evaluate_capture(capture, distance_method="pymesh", dtype=np.float64):
+    """Run the whole pipeline on a single capture and return its CaptureResult.
+
+    Any exception is caught and reported in the error field, so one bad capture does not
+    stop a batch. With the timing enabled (see `timing.enable`), the result holds the timing of
+    every stage. With dtype=np.float32, pointclouds are evaluated in single precision, see
+    `quality.crop_and_calculate_rmse_and_density`.
+    """
+    with timing.record() as events:
+        with timing.stage("evaluate_capture"):
+            result = _evaluate_capture(capture, distance_method, dtype)
+    return result._replace(timings=tuple(events) if events else None)
+
+
+def _evaluate_capture(capture, distance_method, dtype):
+    try:
+        reference_mesh = get_reference_mesh(capture.reference_mesh)
+        if os.path.splitext(capture.pointcloud)[1].lower() in DEPTH_IMAGE_EXTENSIONS:
+            aligned_pointcloud, camera_angle = quality.align_depth_image_to_reference(
+                reference_mesh, capture.rgb, capture.camera_matrix, capture.pointcloud,
+                capture.depth_scale)
+            cropped_pointcloud = quality.clip_pointcloud_to_pattern_area(
+                reference_mesh, aligned_pointcloud, depth_scale=capture.depth_scale)
+            rmse, density = quality.calculate_rmse_and_density(
+                ground_truth_mesh=reference_mesh,
+                cropped_pointcloud=cropped_pointcloud,
+                depth_scale=capture.depth_scale,
+                camera_angle=camera_angle,
+                distance_method=distance_method,
+                dtype=dtype)
+            num_points = len(cropped_pointcloud.points)
+        else:
+            with timing.stage("image_load"):
+                img = cv2.imread(capture.rgb)
+                camera_matrix = quality.read_camera_matrix(capture.camera_matrix)
+            pointcloud = quality.read_pointcloud(capture.pointcloud)
+            rigid_transform, camera_angle = quality.estimate_pointcloud_transform(
+                reference_mesh, img, camera_matrix, pointcloud, capture.depth_scale)
+            # the pointcloud is streamed, so even the largest ones take little memory
+            rmse, density, num_points = quality.crop_and_calculate_rmse_and_density(
+                reference_mesh, pointcloud, rigid_transform, capture.depth_scale, camera_angle,
+                distance_method=distance_method, dtype=dtype)
+        return CaptureResult(capture, rmse, density, camera_angle, num_points, None)
+    except Exception:  # pylint: disable=broad-except
+        return CaptureResult(capture, np.nan, np.nan, None, 0, traceback.format_exc())
+
+
+def _evaluate_indexed_capture(args):
+    index, capture, distance_method, dtype, timing_enabled = args
+    with timing.enabled(timing_enabled):
+        return index, evaluate_capture(capture, distance_method, dtype)
+
+
+def _capture_size(capture):
+    try:
+        return os.path.getsize(capture.pointcloud)
+    except OSError:
+        return 0
+
+
+def iter_capture_results(captures, processes=None, distance_method="pymesh", store=None,
+                         dtype=np.float64):
+    """Evaluate captures over a pool of processes, yielding (index, CaptureResult) as they finish.
+
+    Every worker process loads each reference mesh only once. The largest pointclouds are
+    dispatched first, one capture at a time, so that the workers finish at about the same time;
+    the results come in the order they finish, with the index of their capture in captures.
+    With processes=1 the captures are evaluated in this process. The workers time their stages
+    whenever the timing is enabled in this process.
+
+    With a `store.ResultStore`, the captures whose inputs already have a result in it are not
+    evaluated again but yielded first, and every new successful result is added to it. dtype is
+    that of `evaluate_capture`.
+    """
+    captures = list(captures)
+    keys = [None] * len(captures)
+    todo = []
+    for index, capture in enumerate(captures):
+        if store is not None:
+            keys[index] = store.capture_key(capture, distance_method, dtype)
+            stored_result = store.get(keys[index]) if keys[index] is not None else None
+            if stored_result is not None:
+                yield index, CaptureResult(capture, *stored_result, None)
+                continue
+        todo.append(index)
+
+    order = sorted(todo, key=lambda i: _capture_size(captures[i]), reverse=True)
+    timing_enabled = timing.is_enabled()
+    tasks = [
+        (index, captures[index], distance_method, dtype, timing_enabled) for index in order]
+
+    def add_to_store(results):
+        for index, result in results:
+            if keys[index] is not None:
+                store.add(keys[index], result)
+            yield index, result
+
+    if processes == 1:
+        yield from add_to_store(map(_evaluate_indexed_capture, tasks))
+    else:
+        with multiprocessing.Pool(processes=processes) as pool:
+            yield from add_to_store(pool.imap_unordered(_evaluate_indexed_capture, tasks))
+
+
+def evaluate_captures(captures, processes=None, distance_method="pymesh", trace_filename=None,
+                      store=None, dtype=np.float64):
+    """Evaluate all captures over a pool of processes and return their results in order.
+
+    See `iter_capture_results` for how the captures are dispatched, and for the store of
+    results that skips the captures that were already evaluated. The workers time their
+    stages whenever the timing is enabled in this process, or a trace_filename is given; the
+    timing of all the captures is then written to it as a Chrome trace, with a track for every
+    worker process.
+    """
+    captures = list(captures)
+    results = [None] * len(captures)
+    with timing.enabled(timing.is_enabled() or trace_filename is not None):
+        for index, result in iter_capture_results(
+                captures, processes, distance_method, store=store, dtype=dtype):
+            results[index] = result
+
+    if trace_filename is not None:
+        timing.write_chrome_trace(
+            trace_filename, [event for result in results for event in result.timings or ()])
+    return results
@@ -0,0 +1,69 @@
+"""Helpers for the on-disk cache of preprocessed data."""
+import hashlib
+import os
+import tempfile
+import warnings
+import numpy as np
+
+
+def get_cache_dir():
+    """Return the cache directory, `$DEPTHQUALITY_CACHE_DIR` or `~/.cache/depthquality`."""
+    return os.environ.get(
+        "DEPTHQUALITY_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "depthquality"))
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Return the sha256 hex digest of the contents of the file at path."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def array_digest(*arrays):
+    """Return the sha256 hex digest of the contents, shapes and types of the arrays."""
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(repr((array.dtype.str, array.shape)).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def cache_key(*parts):
+    """Return a short hex key identifying the given parts (digests, versions, arguments)."""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:24]
+
+
+def load_arrays(path):
+    """Load the arrays cached at path, or return None if there is no valid cache file."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as cached:
+            return {name: cached[name] for name in cached.files}
+    except (IOError, OSError, ValueError) as err:
+        warnings.warn("Ignoring unreadable cache file {}: {}".format(path, err))
+        return None
+
+
+def save_arrays(path, **arrays):
+    """Atomically write the arrays to an uncompressed `.npz` file at path.
+
+    The file is written next to its destination and then moved into place, so concurrent
+    processes never read a partially written cache. Failing to write only emits a warning.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(suffix=".npz", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    except (IOError, OSError) as err:
+        warnings.warn("Could not write cache file {}: {}".format(path, err))
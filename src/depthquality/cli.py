@@ -0,0 +1,218 @@
+"""The `depth-quality` command: evaluate a directory or a manifest of captures.
+
+    depth-quality captures/ --mesh VERTICAL_CYLINDERS --depth-scale 0.001 -o results.jsonl
+    depth-quality manifest.csv --workers 8 -o results.csv
+
+The results are written one line per capture as they come in, as JSON Lines or, for a `.csv`
+output, as CSV. Captures that already have a successful result in the output are skipped, so an
+interrupted run picks up where it stopped when it is run again, and retries the failed ones.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import numpy as np
+import depthquality.batch as batch
+import depthquality.meshes as meshes
+import depthquality.store as store
+from depthquality import timing
+
+RESULT_FIELDS = batch.Capture._fields + (
+    "rmse", "density", "camera_angle_x", "camera_angle_y", "camera_angle_z", "num_points",
+    "error")
+
+# the fields that identify a capture in the results, for resuming
+KEY_FIELDS = ("rgb", "pointcloud", "reference_mesh")
+
+
+def get_output_format(filename):
+    return "csv" if os.path.splitext(filename)[1].lower() == ".csv" else "jsonl"
+
+
+def result_to_record(result):
+    """Return a CaptureResult as a flat dictionary of RESULT_FIELDS, with None for NaNs."""
+    record = dict(result.capture._asdict())
+    camera_angle = [None] * 3 if result.camera_angle is None else \
+        [float(value) for value in result.camera_angle]
+    record.update({
+        "rmse": None if np.isnan(result.rmse) else float(result.rmse),
+        "density": None if np.isnan(result.density) else float(result.density),
+        "camera_angle_x": camera_angle[0],
+        "camera_angle_y": camera_angle[1],
+        "camera_angle_z": camera_angle[2],
+        "num_points": int(result.num_points),
+        "error": result.error,
+    })
+    return record
+
+
+def get_capture_key(record):
+    return tuple(str(record[field]) for field in KEY_FIELDS)
+
+
+def read_records(filename, output_format):
+    """Return the records already in an output file, and whether they are all complete.
+
+    A run that is killed can leave its last record half written, which is then left out.
+    """
+    with open(filename, 'r', newline='') as f:
+        text = f.read()
+    is_complete = not text or text.endswith("\n")
+    if output_format != "csv":
+        records = [json.loads(line) for line in text.split("\n")[:-1] if line.strip()]
+        return records, is_complete
+
+    records = []
+    try:
+        # strict, so that a row cut short inside a quoted field is an error
+        for record in csv.DictReader(io.StringIO(text, newline=''), strict=True):
+            records.append(record)
+    except csv.Error:
+        return records, False
+    if not is_complete:
+        records.pop()
+    return records, is_complete
+
+
+class RecordWriter:
+    """Append records to a JSON Lines or CSV file, flushing every one of them to disk.
+
+    With records, the file is rewritten with them first, e.g. to drop a half written record.
+    """
+
+    def __init__(self, filename, output_format, records=None):
+        is_new = records is not None or not os.path.exists(filename) or \
+            os.path.getsize(filename) == 0
+        self.file = open(filename, 'w' if is_new else 'a', newline='')
+        self.output_format = output_format
+        if output_format == "csv":
+            self.csv_writer = csv.DictWriter(self.file, fieldnames=RESULT_FIELDS)
+            if is_new:
+                self.csv_writer.writeheader()
+        for record in records or ():
+            self.write(record)
+
+    def write(self, record):
+        if self.output_format == "csv":
+            self.csv_writer.writerow(record)
+        else:
+            self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_mesh_argument(mesh):
+    """Return the upper case name of a built-in mesh (given in any case), or an OBJ path."""
+    if mesh.upper() in meshes.BUILTIN_MESH_FILENAMES:
+        return mesh.upper()
+    if not os.path.exists(mesh):
+        raise ValueError("{} is neither a built-in mesh ({}) nor an OBJ file".format(
+            mesh, ", ".join(sorted(meshes.BUILTIN_MESH_FILENAMES))))
+    return os.path.abspath(mesh)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog="depth-quality", description=__doc__.split("\n")[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter, epilog="\n".join(
+            __doc__.split("\n")[1:]))
+    parser.add_argument(
+        "input", help="a directory of captures, or a CSV or JSON Lines manifest (see "
+        "depthquality.batch.read_manifest)")
+    parser.add_argument(
+        "--mesh", help="the name of a built-in reference mesh or the path to an OBJ; required "
+        "for a directory, and overrides the meshes of a manifest")
+    parser.add_argument(
+        "--depth-scale", type=float, help="the depth scale of the captures of a directory")
+    parser.add_argument(
+        "-o", "--output", required=True,
+        help="the results file, as CSV if it ends in .csv and as JSON Lines otherwise")
+    parser.add_argument(
+        "-j", "--workers", type=int, help="the number of worker processes (default: all cores)")
+    parser.add_argument(
+        "--distance-method", default="pymesh", choices=meshes.DISTANCE_METHODS)
+    parser.add_argument(
+        "--float32", action="store_true",
+        help="evaluate pointclouds in single precision, to halve the memory traffic")
+    parser.add_argument(
+        "--overwrite", action="store_true",
+        help="evaluate every capture again instead of skipping those in the output")
+    parser.add_argument(
+        "--store", help="a SQLite result store (see depthquality.store), to only evaluate the "
+        "captures whose inputs have no result in it yet")
+    parser.add_argument("--trace", help="write the timing of every stage as a Chrome trace")
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    try:
+        mesh = None if args.mesh is None else get_mesh_argument(args.mesh)
+    except ValueError as err:
+        parser.error(str(err))
+
+    if os.path.isdir(args.input):
+        if mesh is None or args.depth_scale is None:
+            parser.error("--mesh and --depth-scale are required to evaluate a directory")
+        captures = batch.read_capture_directory(
+            os.path.abspath(args.input), mesh, args.depth_scale)
+    elif os.path.isfile(args.input):
+        captures = batch.read_manifest(args.input)
+        if mesh is not None:
+            captures = [capture._replace(reference_mesh=mesh) for capture in captures]
+    else:
+        parser.error("no such directory or manifest: {}".format(args.input))
+
+    output_format = get_output_format(args.output)
+    done = set()
+    # the records to rewrite the output with, None to append to it
+    records = [] if args.overwrite else None
+    if os.path.exists(args.output) and not args.overwrite:
+        kept_records, is_complete = read_records(args.output, output_format)
+        # failures are often transient, so they are evaluated again, and replace their records
+        succeeded = [record for record in kept_records if not record["error"]]
+        done = {get_capture_key(record) for record in succeeded}
+        if not is_complete or len(succeeded) < len(kept_records):
+            records = succeeded
+    todo = [capture for capture in captures if get_capture_key(capture._asdict()) not in done]
+    print("{} captures, {} already evaluated".format(len(captures), len(captures) - len(todo)))
+
+    num_failed = 0
+    events = []
+    result_store = store.ResultStore(args.store) if args.store is not None else None
+    with timing.enabled(timing.is_enabled() or args.trace is not None), \
+            RecordWriter(args.output, output_format, records) as writer:
+        results = batch.iter_capture_results(
+            todo, processes=args.workers, distance_method=args.distance_method,
+            store=result_store, dtype=np.float32 if args.float32 else np.float64)
+        for count, (_, result) in enumerate(results, 1):
+            writer.write(result_to_record(result))
+            events.extend(result.timings or ())
+            if result.error is None:
+                status = "rmse {:.3f} mm, density {:.3f}".format(result.rmse, result.density)
+            else:
+                num_failed += 1
+                status = "failed: {}".format(result.error.strip().split("\n")[-1])
+            print("[{}/{}] {} {}".format(count, len(todo), result.capture.rgb, status))
+
+    if result_store is not None:
+        result_store.close()
+    if args.trace is not None:
+        timing.write_chrome_trace(args.trace, events)
+    print("{} evaluated, {} failed".format(len(todo), num_failed))
+    return 1 if num_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""All functionality related to organized depth images."""
+import os
+import cv2
+import numpy as np
+
+
+def read_depth_image(filename):
+    """Read a single-channel depth image from a `.npy` file or a (16-bit) image file."""
+    if os.path.splitext(filename)[1].lower() == ".npy":
+        depth_image = np.load(filename)
+    else:
+        depth_image = cv2.imread(filename, cv2.IMREAD_ANYDEPTH)
+        if depth_image is None:
+            raise IOError("Could not read depth image {}".format(filename))
+
+    if depth_image.ndim != 2:
+        raise ValueError("Expected a single-channel depth image, got shape {}".format(
+            depth_image.shape))
+    return depth_image
+
+
+def deproject_window(depth_image, camera_matrix, depth_scale,
+                     row_start=0, row_stop=None, col_start=0, col_stop=None,
+                     return_indices=False):
+    """Deproject the pixels of depth_image[row_start:row_stop, col_start:col_stop] to 3D points.
+
+    The window is clipped to the image, and pixels without a valid (positive) depth are dropped.
+    The depth values are multiplied by depth_scale, so the points are in the same units as a
+    pointcloud deprojected by the camera. With return_indices, the flat index of the pixel of
+    every point in depth_image is returned as well.
+    """
+    height, width = depth_image.shape
+    row_start, col_start = max(row_start, 0), max(col_start, 0)
+    row_stop = height if row_stop is None else min(row_stop, height)
+    col_stop = width if col_stop is None else min(col_stop, width)
+    if row_start >= row_stop or col_start >= col_stop:
+        if return_indices:
+            return np.empty((0, 3)), np.empty(0, dtype=np.int64)
+        return np.empty((0, 3))
+
+    window = depth_image[row_start:row_stop, col_start:col_stop]
+    rows, cols = np.nonzero(window > 0)
+    depths = window[rows, cols] * depth_scale
+
+    points = np.empty((len(depths), 3))
+    points[:, 0] = (cols + col_start - camera_matrix["ppx"]) * depths / camera_matrix["fx"]
+    points[:, 1] = (rows + row_start - camera_matrix["ppy"]) * depths / camera_matrix["fy"]
+    points[:, 2] = depths
+    if return_indices:
+        return points, (rows + row_start) * width + cols + col_start
+    return points
+
+
+def compute_corner_coordinates(depth_image, camera_matrix, corner_list, depth_scale, pixel_tol=3):
+    """Return the mean 3D point of the depth image around each (row, col) corner in corner_list.
+
+    This is the organized counterpart of `quality.compute_corner_coordinates`: only the
+    +/- pixel_tol window around every corner is deprojected. Corners without any valid depth
+    in their window are left out of the result.
+    """
+    corner_coordinates = {}
+    for corner in corner_list:
+        row, col = corner
+        points = deproject_window(
+            depth_image, camera_matrix, depth_scale,
+            row - pixel_tol, row + pixel_tol + 1, col - pixel_tol, col + pixel_tol + 1)
+        if len(points):
+            corner_coordinates[corner] = np.mean(points, axis=0)
+    return corner_coordinates
+
+
+def project_bounds_to_window(min_bound, max_bound, transform, camera_matrix, shape):
+    """Return the image window (row_start, row_stop, col_start, col_stop) covering a 3D box.
+
+    The axis-aligned box given by min_bound and max_bound is moved into the camera frame by the
+    4x4 transform and projected into an image of the given shape. If any part of the box is
+    behind the camera, the whole image is returned.
+    """
+    height, width = shape
+    box_corners = np.array([
+        [x, y, z]
+        for x in (min_bound[0], max_bound[0])
+        for y in (min_bound[1], max_bound[1])
+        for z in (min_bound[2], max_bound[2])])
+    box_corners = box_corners @ transform[:3, :3].T + transform[:3, 3]
+    if np.any(box_corners[:, 2] <= 0):
+        return 0, height, 0, width
+
+    # the projection of the box lies inside the bounding rectangle of its projected corners
+    u = camera_matrix["fx"] * box_corners[:, 0] / box_corners[:, 2] + camera_matrix["ppx"]
+    v = camera_matrix["fy"] * box_corners[:, 1] / box_corners[:, 2] + camera_matrix["ppy"]
+    row_start = int(np.clip(np.floor(v.min()), 0, height))
+    row_stop = int(np.clip(np.ceil(v.max()) + 1, 0, height))
+    col_start = int(np.clip(np.floor(u.min()), 0, width))
+    col_stop = int(np.clip(np.ceil(u.max()) + 1, 0, width))
+    return row_start, row_stop, col_start, col_stop
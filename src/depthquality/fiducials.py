@@ -2,6 +2,7 @@
 
 from collections import namedtuple
 import cv2
+import numpy as np
 
 Location = namedtuple("Location", ("location", ))
 
@@ -11,23 +12,127 @@ BOTTOM_LEFT = Location("bottom_left")
 BOTTOM_RIGHT = Location("bottom_right")
 
 
-def detect_arucos(img):
-    # detect the aruco tags
-    aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_1000)
+def create_detector_parameters(corner_refinement=True):
+    """Return the ArUco detector parameters used for the fiducials of the reference meshes."""
     params = cv2.aruco.DetectorParameters_create()
     params.perspectiveRemovePixelPerCell = 10
     params.perspectiveRemoveIgnoredMarginPerCell = 0.1
-    params.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_CONTOUR
-    marker_corners, marker_ids, _ = cv2.aruco.detectMarkers(
-        img, aruco_dict, parameters=params)
-
-    detected_arucos = {}
-    for corners, aruco_id in zip(marker_corners, marker_ids):
-        # corners is always in top-left, top-right, bottom-right, bottom-left order
-        detected_arucos[aruco_id[0]] = {
-            TOP_LEFT: corners[0][0],
-            TOP_RIGHT: corners[0][1],
-            BOTTOM_RIGHT: corners[0][2],
-            BOTTOM_LEFT: corners[0][3]
-        }
-    return detected_arucos
+    if corner_refinement:
+        params.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_CONTOUR
+    return params
+
+
+class ArucoDetector:
+    """A reusable ArUco detector, which keeps its dictionary and parameters between images.
+
+    With expected_ids (e.g. the keys of `ReferenceMesh.fiducial_locations`) only those markers
+    are searched for, which makes identifying the marker candidates much cheaper.
+
+    With downscale > 1, the markers are first detected in an image downscaled by that factor,
+    and then detected again at full resolution only inside a small region of interest around
+    each of them, for the same corner accuracy. The full resolution detection over the whole
+    image is skipped whenever all the expected markers were found in the downscaled image.
+    """
+
+    def __init__(self, expected_ids=None, downscale=1, roi_margin=0.5):
+        self.dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_1000)
+        self.params = create_detector_parameters()
+        self.coarse_params = create_detector_parameters(corner_refinement=False)
+        self.expected_ids = None if expected_ids is None else sorted(set(expected_ids))
+        self.downscale = downscale
+        # the margin around each marker ROI, as a fraction of the marker size
+        self.roi_margin = roi_margin
+
+        if self.expected_ids is None:
+            self.search_dictionary = self.dictionary
+        else:
+            self.search_dictionary = self._get_sub_dictionary(self.expected_ids)
+        self._marker_dictionaries = {}
+
+    def _get_sub_dictionary(self, aruco_ids):
+        # a dictionary of only some of the markers, their ids become their index in aruco_ids
+        dictionary = cv2.aruco.custom_dictionary(0, self.dictionary.markerSize)
+        dictionary.bytesList = self.dictionary.bytesList[list(aruco_ids)]
+        dictionary.maxCorrectionBits = self.dictionary.maxCorrectionBits
+        return dictionary
+
+    def _detect(self, img, params, dictionary, aruco_ids=None):
+        marker_corners, marker_ids, _ = cv2.aruco.detectMarkers(
+            img, dictionary, parameters=params)
+        if marker_ids is None:
+            return {}
+        if aruco_ids is None:
+            return {
+                aruco_id[0]: corners[0] for corners, aruco_id in zip(marker_corners, marker_ids)}
+        return {
+            aruco_ids[index[0]]: corners[0] for corners, index in zip(marker_corners, marker_ids)}
+
+    def _refine(self, img, aruco_id, coarse_corners):
+        height, width = img.shape[:2]
+        margin = self.roi_margin * np.ptp(coarse_corners, axis=0).max() + 2 * self.downscale
+        col_start, row_start = np.maximum(
+            np.floor(coarse_corners.min(axis=0) - margin).astype(int), 0)
+        col_stop, row_stop = np.minimum(
+            np.ceil(coarse_corners.max(axis=0) + margin).astype(int) + 1, [width, height])
+
+        # the id is already known, so only that marker is searched for in the ROI
+        if aruco_id not in self._marker_dictionaries:
+            self._marker_dictionaries[aruco_id] = self._get_sub_dictionary([aruco_id])
+        roi_arucos = self._detect(
+            img[row_start:row_stop, col_start:col_stop], self.params,
+            self._marker_dictionaries[aruco_id], [aruco_id])
+        if aruco_id not in roi_arucos:
+            return None
+        return roi_arucos[aruco_id] + np.array([col_start, row_start], dtype=np.float32)
+
+    def detect_corners(self, img):
+        """Return the four (x, y) corners of every detected marker, keyed by marker id."""
+        if len(img.shape) == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if self.downscale <= 1:
+            return self._detect(img, self.params, self.search_dictionary, self.expected_ids)
+
+        small_img = cv2.resize(
+            img, None, fx=1 / self.downscale, fy=1 / self.downscale,
+            interpolation=cv2.INTER_AREA)
+        coarse_arucos = self._detect(
+            small_img, self.coarse_params, self.search_dictionary, self.expected_ids)
+        detected_corners = {}
+        for aruco_id, corners in coarse_arucos.items():
+            # map the pixel centers of the downscaled image back to the full image
+            refined_corners = self._refine(
+                img, aruco_id, (corners + 0.5) * self.downscale - 0.5)
+            if refined_corners is not None:
+                detected_corners[aruco_id] = refined_corners
+
+        if self.expected_ids is None or not set(self.expected_ids).issubset(detected_corners):
+            # some markers may be too small to find in the downscaled image
+            full_corners = self._detect(
+                img, self.params, self.search_dictionary, self.expected_ids)
+            full_corners.update(detected_corners)
+            detected_corners = full_corners
+        return detected_corners
+
+    def detect(self, img):
+        """Detect the markers in img, in the format of `detect_arucos`."""
+        detected_arucos = {}
+        for aruco_id, corners in self.detect_corners(img).items():
+            # corners is always in top-left, top-right, bottom-right, bottom-left order
+            detected_arucos[aruco_id] = {
+                TOP_LEFT: corners[0],
+                TOP_RIGHT: corners[1],
+                BOTTOM_RIGHT: corners[2],
+                BOTTOM_LEFT: corners[3]
+            }
+        return detected_arucos
+
+
+_default_detector = None
+
+
+def detect_arucos(img):
+    """Detect the aruco tags in img at full resolution, with a shared ArucoDetector."""
+    global _default_detector
+    if _default_detector is None:
+        _default_detector = ArucoDetector()
+    return _default_detector.detect(img)
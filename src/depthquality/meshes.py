@@ -1,53 +1,77 @@
 """All functionality related to the ground-truth meshes."""
+import os
+import threading
 import pymesh
-import pkg_resources
 import numpy as np
+from depthquality import caching
+from depthquality import distances
 from depthquality.fiducials import TOP_LEFT, TOP_RIGHT, BOTTOM_LEFT, BOTTOM_RIGHT
 
 
+# version of the preprocessed mesh cache, bump whenever what is cached changes
+MESH_CACHE_VERSION = 1
+
+# classification of the submeshes of a reference mesh
+PATTERN, FIDUCIAL, BACKPLATE, PATTERN_PLATE = range(4)
+
+# the ways of computing point-to-mesh distances, see ReferenceMesh.get_squared_distances
+DISTANCE_METHODS = ("pymesh", "bvh", "field")
+
+
 class ReferenceMesh:
-    def __init__(self, path, backplate_thickness=6.35):
+    def __init__(self, path, backplate_thickness=6.35, use_cache=True):
         self.path = path
-        self.reference_mesh = pymesh.load_mesh(path)
+        self.backplate_thickness = backplate_thickness
+        self.pattern_plate_thickness = 3
 
-        # we want to separate the submeshes based on face connectivity,
-        # since that will give us all the discrete parts
-        self.submeshes = pymesh.separate_mesh(
-            self.reference_mesh, connectivity_type="face")
+        # parsing, separating and classifying the mesh is slow for large meshes, so the
+        # results are cached on disk, keyed by the mesh contents and the constructor arguments
+        cache_path = self._get_cache_path() if use_cache else None
+        arrays = caching.load_arrays(cache_path) if use_cache else None
+        if arrays is None:
+            self.reference_mesh = pymesh.load_mesh(path)
+
+            # we want to separate the submeshes based on face connectivity,
+            # since that will give us all the discrete parts
+            self.submeshes = pymesh.separate_mesh(
+                self.reference_mesh, connectivity_type="face")
+            arrays = self._preprocess()
+            if use_cache:
+                caching.save_arrays(cache_path, **arrays)
+        else:
+            self.reference_mesh = pymesh.form_mesh(arrays["vertices"], arrays["faces"])
+            self.submeshes = [
+                pymesh.form_mesh(vertices, faces) for vertices, faces in zip(
+                    np.split(arrays["submesh_vertices"], arrays["submesh_vertex_offsets"][1:-1]),
+                    np.split(arrays["submesh_faces"], arrays["submesh_face_offsets"][1:-1]))]
 
         # get all the pattern meshes, which are the submeshes that are
         # NOT the: backplate, pattern plate, or fiducial tag locations
-        self.backplate_thickness = backplate_thickness
-        self.pattern_plate_thickness = 3
+        self.submesh_labels = arrays["submesh_labels"]
         self.pattern_meshes = []
         self.fiducial_meshes = []
         self.backplate_mesh = None
         self.pattern_plate_mesh = None
-
-        for submesh in self.submeshes:
-            if not submesh.is_closed():
-                # these are the fiducial marker locations
-                # because they are the ones that are 1-dimensional
+        for submesh, label in zip(self.submeshes, self.submesh_labels):
+            if label == FIDUCIAL:
                 self.fiducial_meshes.append(submesh)
-            elif (submesh.bbox[0][2] == 0 and
-                  submesh.bbox[1][2] == self.backplate_thickness) or \
-                    (submesh.bbox[1][2] == 0 and
-                     submesh.bbox[0][2] == self.backplate_thickness):
-                # this is the backplate, since the bounding box extends to 0
+            elif label == BACKPLATE:
                 self.backplate_mesh = submesh
-            elif (submesh.bbox[0][2] ==
-                  self.backplate_thickness + self.pattern_plate_thickness and
-                  submesh.bbox[1][2] == self.backplate_thickness) or \
-                    (submesh.bbox[1][2] ==
-                     self.backplate_thickness + self.pattern_plate_thickness and
-                     submesh.bbox[0][2] == self.backplate_thickness):
-                # this is the pattern plate, since the bounding box starts
-                # from the end of the backplate and goes the thickness of
-                # the pattern plate
+            elif label == PATTERN_PLATE:
                 self.pattern_plate_mesh = submesh
             else:
                 self.pattern_meshes.append(submesh)
 
+        # the unit normals and areas of all the faces of the pattern meshes
+        is_pattern_face = np.repeat(
+            self.submesh_labels == PATTERN, np.diff(arrays["submesh_face_offsets"]))
+        self.pattern_face_normals = arrays["submesh_face_normals"][is_pattern_face]
+        self.pattern_face_areas = arrays["submesh_face_areas"][is_pattern_face]
+        self._surface_area_tables = {}
+        self._distance_fields = {}
+        self._triangle_tree = None
+        self._surface_samples = {}
+
         # the fiducial locations on the reference mesh
         # TODO: generate these automatically from the meshes
         self.fiducial_locations = {
@@ -81,32 +105,193 @@ class ReferenceMesh:
             }
         }
 
-    def get_pattern_surface_area(self, camera_angle=np.array([0, 0, 1])):
-        total_surface_area = 0
-        for pattern_mesh in self.pattern_meshes:
-            # add the face normal and face area attributes
-            pattern_mesh.add_attribute("face_normal")
-            pattern_mesh.add_attribute("face_area")
+    def _get_cache_path(self):
+        key = caching.cache_key(
+            MESH_CACHE_VERSION, caching.file_digest(self.path),
+            float(self.backplate_thickness), float(self.pattern_plate_thickness))
+        basename = os.path.splitext(os.path.basename(self.path))[0]
+        return os.path.join(caching.get_cache_dir(), "meshes", "{}-{}.npz".format(basename, key))
+
+    def _classify_submesh(self, submesh):
+        if not submesh.is_closed():
+            # these are the fiducial marker locations
+            # because they are the ones that are 1-dimensional
+            return FIDUCIAL
+        elif (submesh.bbox[0][2] == 0 and
+              submesh.bbox[1][2] == self.backplate_thickness) or \
+                (submesh.bbox[1][2] == 0 and
+                 submesh.bbox[0][2] == self.backplate_thickness):
+            # this is the backplate, since the bounding box extends to 0
+            return BACKPLATE
+        elif (submesh.bbox[0][2] ==
+              self.backplate_thickness + self.pattern_plate_thickness and
+              submesh.bbox[1][2] == self.backplate_thickness) or \
+                (submesh.bbox[1][2] ==
+                 self.backplate_thickness + self.pattern_plate_thickness and
+                 submesh.bbox[0][2] == self.backplate_thickness):
+            # this is the pattern plate, since the bounding box starts
+            # from the end of the backplate and goes the thickness of
+            # the pattern plate
+            return PATTERN_PLATE
+        return PATTERN
+
+    def _preprocess(self):
+        """Classify the submeshes and flatten everything worth caching into arrays."""
+        face_normals, face_areas = zip(*[
+            get_face_normals_and_areas(submesh.vertices, submesh.faces)
+            for submesh in self.submeshes])
+        return {
+            "vertices": self.reference_mesh.vertices,
+            "faces": self.reference_mesh.faces,
+            "submesh_labels": np.array(
+                [self._classify_submesh(submesh) for submesh in self.submeshes]),
+            "submesh_vertices": np.concatenate([s.vertices for s in self.submeshes]),
+            "submesh_vertex_offsets": np.cumsum([0] + [s.num_vertices for s in self.submeshes]),
+            "submesh_faces": np.concatenate([s.faces for s in self.submeshes]),
+            "submesh_face_offsets": np.cumsum([0] + [s.num_faces for s in self.submeshes]),
+            "submesh_face_normals": np.concatenate(face_normals),
+            "submesh_face_areas": np.concatenate(face_areas),
+        }
+
+    def get_pattern_surface_area(self, camera_angle=np.array([0, 0, 1]), lut_resolution=None):
+        """Return the area of the pattern faces visible from the camera_angle view direction.
+
+        A face is visible when its normal points less than 90 degrees away from camera_angle.
+        camera_angle can also be a (N, 3) array of view directions, and then one area per
+        direction is returned. With lut_resolution, the areas are looked up in a table over a
+        grid of lut_resolution polar by 2 * lut_resolution azimuthal steps of the unit sphere,
+        built once, which is approximate in between the grid directions.
+        """
+        camera_angles = np.asarray(camera_angle, dtype=float)
+        if lut_resolution is None:
+            areas = self._compute_pattern_surface_areas(camera_angles.reshape(-1, 3))
+        else:
+            areas = self._lookup_pattern_surface_areas(camera_angles.reshape(-1, 3), lut_resolution)
+        return areas[0] if camera_angles.ndim == 1 else areas
 
-            # the face normals are all unit normals
-            face_normals = pattern_mesh.get_face_attribute("face_normal")
-            face_area = pattern_mesh.get_face_attribute("face_area")
+    def _compute_pattern_surface_areas(self, camera_angles, chunk_size=2 ** 24):
+        # the face normals are all unit normals, so a face is within 90 degrees of the
+        # view direction exactly when their dot product is positive
+        areas = np.empty(len(camera_angles))
+        step = max(1, chunk_size // max(1, len(self.pattern_face_areas)))
+        for start in range(0, len(camera_angles), step):
+            is_visible = self.pattern_face_normals @ camera_angles[start:start + step].T > 0
+            areas[start:start + step] = self.pattern_face_areas @ is_visible
+        return areas
 
-            faces_within_angle_of_pos_z = np.arccos(np.dot(face_normals, camera_angle)) < np.pi / 2
-            visible_surface_area = np.sum(face_area[faces_within_angle_of_pos_z])
-            total_surface_area += visible_surface_area
-        return total_surface_area
+    def _lookup_pattern_surface_areas(self, camera_angles, lut_resolution):
+        step = np.pi / lut_resolution
+        if lut_resolution not in self._surface_area_tables:
+            polar, azimuth = np.meshgrid(
+                np.arange(lut_resolution + 1) * step, np.arange(2 * lut_resolution) * step,
+                indexing="ij")
+            directions = np.stack([
+                np.sin(polar) * np.cos(azimuth),
+                np.sin(polar) * np.sin(azimuth),
+                np.cos(polar)], axis=-1)
+            self._surface_area_tables[lut_resolution] = self._compute_pattern_surface_areas(
+                directions.reshape(-1, 3)).reshape(polar.shape)
+        table = self._surface_area_tables[lut_resolution]
+
+        # look up the nearest grid direction
+        norms = np.linalg.norm(camera_angles, axis=1)
+        polar = np.arccos(np.clip(camera_angles[:, 2] / norms, -1, 1))
+        azimuth = np.arctan2(camera_angles[:, 1], camera_angles[:, 0])
+        polar_index = np.rint(polar / step).astype(int)
+        azimuth_index = np.rint(azimuth / step).astype(int) % (2 * lut_resolution)
+        return table[polar_index, azimuth_index]
+
+    def get_distance_field(self, voxel_size=0.5, band=3.0):
+        """Return the narrow-band DistanceField of the reference mesh, built once and cached."""
+        key = (voxel_size, band)
+        if key not in self._distance_fields:
+            self._distance_fields[key] = distances.get_distance_field(
+                self.reference_mesh, voxel_size=voxel_size, band=band)
+        return self._distance_fields[key]
+
+    def get_triangle_tree(self):
+        """Return the TriangleTree of the reference mesh, built on first use."""
+        if self._triangle_tree is None:
+            self._triangle_tree = distances.TriangleTree(
+                self.reference_mesh.vertices, self.reference_mesh.faces)
+        return self._triangle_tree
+
+    def get_surface_samples(self, spacing=1.0):
+        """Return the SurfaceSamples of the reference mesh, built once and cached."""
+        if spacing not in self._surface_samples:
+            self._surface_samples[spacing] = distances.SurfaceSamples(
+                self.reference_mesh.vertices, self.reference_mesh.faces, spacing=spacing)
+        return self._surface_samples[spacing]
+
+    def get_squared_distances(self, points, method="pymesh"):
+        """Return the squared distance from every point (in mm) to the reference mesh.
+
+        method is "pymesh" for an exact query per point, "bvh" for the same exact distances
+        from the multi-threaded `distances.TriangleTree`, or "field" to interpolate in the
+        precomputed distance field, see `distances.DistanceField` for its error bound.
+        """
+        if method == "pymesh":
+            return distances.exact_squared_distances(self.reference_mesh, points)
+        elif method == "bvh":
+            squared_distances, _, _ = self.get_triangle_tree().query(points)
+            return squared_distances
+        elif method == "field":
+            return self.get_distance_field().squared_distances(points)
+        raise ValueError("Unknown distance method {!r}, expected one of {}".format(
+            method, ", ".join(DISTANCE_METHODS)))
 
     def get_fiducial_coordinate(self, fiducial_id, location):
         """Return a 3D XYZ coordinate from the reference mesh based on fiducial_id and location."""
         return self.fiducial_locations[fiducial_id][location]
 
 
-VERTICAL_CYLINDERS = ReferenceMesh(
-    path=pkg_resources.resource_filename('depthquality', '../meshes/vertical_cylinders.obj'))
-HORIZONTAL_CYLINDERS = ReferenceMesh(
-    path=pkg_resources.resource_filename('depthquality', '../meshes/horizontal_cylinders.obj'))
-SPHERES = ReferenceMesh(
-    path=pkg_resources.resource_filename('depthquality', '../meshes/spheres.obj'))
-ANGLED_PLATES = ReferenceMesh(
-    path=pkg_resources.resource_filename('depthquality', '../meshes/angled_plates.obj'))
+def get_face_normals_and_areas(vertices, faces):
+    """Return the unit normal and the area of every triangle in faces."""
+    corners = vertices[faces]
+    cross = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    double_areas = np.linalg.norm(cross, axis=1)
+    # degenerate faces get a zero normal instead of nan
+    normals = cross / np.where(double_areas > 0, double_areas, 1)[:, np.newaxis]
+    return normals, double_areas / 2
+
+
+# the reference meshes that ship with this repository, by module attribute name;
+# they are only loaded from disk the first time they are accessed
+BUILTIN_MESH_FILENAMES = {
+    "VERTICAL_CYLINDERS": "vertical_cylinders.obj",
+    "HORIZONTAL_CYLINDERS": "horizontal_cylinders.obj",
+    "SPHERES": "spheres.obj",
+    "ANGLED_PLATES": "angled_plates.obj",
+}
+_builtin_meshes = {}
+_builtin_meshes_lock = threading.Lock()
+
+
+def get_builtin_mesh_path(name):
+    """Return the path to the OBJ file of the built-in mesh with the given name."""
+    if name not in BUILTIN_MESH_FILENAMES:
+        raise KeyError("Unknown reference mesh {!r}, expected one of {}".format(
+            name, ", ".join(sorted(BUILTIN_MESH_FILENAMES))))
+    # pkg_resources is slow to import, so only pay for it when a mesh is used
+    import pkg_resources
+    return pkg_resources.resource_filename(
+        'depthquality', '../meshes/' + BUILTIN_MESH_FILENAMES[name])
+
+
+def get_builtin_mesh(name):
+    """Return the built-in ReferenceMesh with the given name, loading it on first use."""
+    with _builtin_meshes_lock:
+        if name not in _builtin_meshes:
+            _builtin_meshes[name] = ReferenceMesh(path=get_builtin_mesh_path(name))
+        return _builtin_meshes[name]
+
+
+def __getattr__(name):
+    # lazily construct VERTICAL_CYLINDERS, HORIZONTAL_CYLINDERS, SPHERES and ANGLED_PLATES
+    if name in BUILTIN_MESH_FILENAMES:
+        return get_builtin_mesh(name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(BUILTIN_MESH_FILENAMES))
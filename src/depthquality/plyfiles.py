@@ -0,0 +1,142 @@
+"""All functionality related to reading PLY pointclouds without open3d."""
+from collections import namedtuple
+import numpy as np
+
+# the numpy type of every PLY scalar type, under both its old and new name
+PLY_TYPES = {
+    "char": "i1", "int8": "i1",
+    "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2",
+    "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4",
+    "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4",
+    "double": "f8", "float64": "f8",
+}
+
+PLY_FORMATS = {
+    "binary_little_endian": "<",
+    "binary_big_endian": ">",
+    "ascii": "=",
+}
+
+# an element of a PLY file; properties holds (name, type) pairs, where type is None for the
+# list properties (e.g. the vertex indices of faces)
+PlyElement = namedtuple("PlyElement", ("name", "count", "properties"))
+
+PlyHeader = namedtuple("PlyHeader", ("format", "elements", "data_offset"))
+
+
+def read_ply_header(filename):
+    """Parse the header of a PLY file, without reading any of its data."""
+    elements = []
+    ply_format = None
+    with open(filename, 'rb') as f:
+        if f.readline().strip() != b"ply":
+            raise ValueError("{} is not a PLY file".format(filename))
+        for line in iter(f.readline, b''):
+            words = line.decode("ascii", errors="replace").split()
+            if not words or words[0] in ("comment", "obj_info"):
+                continue
+            elif words[0] == "format":
+                ply_format = words[1]
+            elif words[0] == "element":
+                elements.append(PlyElement(words[1], int(words[2]), []))
+            elif words[0] == "property":
+                if words[1] == "list":
+                    elements[-1].properties.append((words[-1], None))
+                else:
+                    elements[-1].properties.append((words[2], words[1]))
+            elif words[0] == "end_header":
+                if ply_format not in PLY_FORMATS:
+                    raise ValueError("Unsupported PLY format {} in {}".format(
+                        ply_format, filename))
+                return PlyHeader(ply_format, elements, f.tell())
+    raise ValueError("{} has no end_header".format(filename))
+
+
+def element_dtype(element, ply_format):
+    """Return the structured dtype of an element, which must not have list properties."""
+    byte_order = PLY_FORMATS[ply_format]
+    fields = []
+    for name, ply_type in element.properties:
+        if ply_type is None:
+            raise ValueError("Cannot read the list property {} of element {}".format(
+                name, element.name))
+        fields.append((name, byte_order + PLY_TYPES[ply_type]))
+    return np.dtype(fields)
+
+
+def read_ply_vertices(filename, properties=None):
+    """Return the vertex element of a PLY file as a structured array.
+
+    Binary files are memory-mapped, so only the parts of the vertex block that are used are
+    ever read from disk. ASCII files are parsed, reading only the requested properties.
+    properties selects a subset of the vertex properties (e.g. ("x", "y", "z") to skip colors
+    and normals); for a binary file, the result is still a view of the mapped file.
+    """
+    header = read_ply_header(filename)
+    offset = header.data_offset
+    for index, element in enumerate(header.elements):
+        if element.name == "vertex":
+            break
+        if header.format != "ascii":
+            # the elements before the vertices need a fixed size to be skipped over
+            offset += element.count * element_dtype(element, header.format).itemsize
+    else:
+        raise ValueError("{} has no vertex element".format(filename))
+    dtype = element_dtype(element, header.format)
+
+    if header.format == "ascii":
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            for _ in range(sum(e.count for e in header.elements[:index])):
+                f.readline()
+            names = dtype.names if properties is None else properties
+            vertices = np.loadtxt(
+                f, dtype=np.dtype([(name, dtype[name]) for name in names]),
+                usecols=[dtype.names.index(name) for name in names],
+                max_rows=element.count, ndmin=1)
+        return vertices
+
+    vertices = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(element.count,))
+    if properties is not None:
+        vertices = vertices[list(properties)]
+    return vertices
+
+
+def read_ply_points(filename):
+    """Return the (N, 3) xyz coordinates of the vertices of a PLY pointcloud.
+
+    For a binary file with consecutive x, y and z properties of the same floating point type
+    (as written by librealsense and open3d), this is a strided view of the memory-mapped file,
+    skipping any other properties without copying.
+    """
+    vertices = read_ply_vertices(filename, ("x", "y", "z"))
+    field_types = [vertices.dtype.fields[name][0] for name in ("x", "y", "z")]
+    field_offsets = [vertices.dtype.fields[name][1] for name in ("x", "y", "z")]
+    item_size = field_types[0].itemsize
+    if isinstance(vertices, np.memmap) and field_types[0].kind == "f" and \
+            len(set(field_types)) == 1 and \
+            field_offsets == [field_offsets[0] + i * item_size for i in range(3)]:
+        return np.lib.stride_tricks.as_strided(
+            vertices["x"], shape=(len(vertices), 3), strides=(vertices.strides[0], item_size),
+            writeable=False)
+    return np.stack([vertices["x"], vertices["y"], vertices["z"]], axis=1).astype(np.float64)
+
+
+def write_ply_points(filename, points):
+    """Write (N, 3) points as a binary little endian PLY pointcloud of float x, y and z."""
+    points = np.ascontiguousarray(points, dtype="<f4").reshape(-1, 3)
+    header = "\n".join([
+        "ply",
+        "format binary_little_endian 1.0",
+        "element vertex {}".format(len(points)),
+        "property float x",
+        "property float y",
+        "property float z",
+        "end_header",
+        ""])
+    with open(filename, 'wb') as f:
+        f.write(header.encode("ascii"))
+        f.write(points.tobytes())
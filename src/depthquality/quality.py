@@ -1,27 +1,267 @@
 """All functions related to generating quality metrics."""
+import functools
+import itertools
 import os
+import statistics
+import time
+from collections import namedtuple
 import numpy as np
 import open3d
-import pymesh
 import cv2
 import json
+from depthquality import depthimages
+from depthquality import plyfiles
+from depthquality import timing
 from depthquality import transformations as tfms
 from depthquality.fiducials import detect_arucos
 
+# version of the evaluation pipeline, bump whenever a change to it changes its results, even
+# only by rounding, so that the results stored by `depthquality.store` are computed again
+# 2: pointclouds are cropped before the distances, metrics are summed over chunks, and the
+#    depth scale is folded into the rigid transform
+# 3: float32 chunks of float64 points are scaled before they are rounded
+PIPELINE_VERSION = 3
 
-def align_pointcloud_to_reference(
-        reference_mesh, rgb_filename, camera_matrix_filename, pointcloud_filename, depth_scale):
-    img = cv2.imread(rgb_filename)
-    detected_arucos = detect_arucos(img)
+# number of points that the crop, the distance queries and the metrics handle at a time; a
+# chunk takes about 120 bytes of temporary memory per point with the "bvh" distances (more
+# with the distance field), so the default chunks take a few hundred MB at most
+CHUNK_SIZE = 2 ** 20
 
-    with open(camera_matrix_filename, 'r') as j_file:
-        camera_matrix = json.load(j_file)
+# the fit of the fiducial corners that have a depth: their reference coordinates (in mm),
+# whether each one is an inlier of the fit, and its residual distance (in mm) under the transform
+CornerFit = namedtuple("CornerFit", ("reference_coords", "inliers", "residuals"))
+
+# metrics estimated from a sample of the points, with the (lower, upper) bounds of their
+# confidence intervals and the number of points sampled
+ApproximateMetrics = namedtuple(
+    "ApproximateMetrics", ("rmse", "density", "rmse_bounds", "density_bounds", "num_samples"))
+
+
+def align_pointcloud_to_reference(
+        reference_mesh, rgb_filename, camera_matrix_filename, pointcloud_filename, depth_scale,
+        inlier_threshold=None, icp_iterations=0, icp_time_budget=None):
+    with timing.stage("image_load"):
+        img = cv2.imread(rgb_filename)
+        camera_matrix = read_camera_matrix(camera_matrix_filename)
+
+    if os.path.splitext(pointcloud_filename)[1].lower() != ".ply":
+        with timing.stage("cloud_load"):
+            pointcloud = open3d.io.read_point_cloud(pointcloud_filename)
+        return align_pointcloud(reference_mesh, img, camera_matrix, pointcloud, depth_scale,
+                                inlier_threshold=inlier_threshold, icp_iterations=icp_iterations,
+                                icp_time_budget=icp_time_budget)
 
     # the PLY files saved from librealsense are JUST vertices (no faces)
-    # so they are pretty easy to manipulate
-    pointcloud = open3d.io.read_point_cloud(pointcloud_filename)
+    # so they are pretty easy to manipulate, straight from the memory-mapped file
+    with timing.stage("cloud_load"):
+        points = plyfiles.read_ply_points(pointcloud_filename)
+    aligned_points, camera_angle = align_pointcloud(
+        reference_mesh, img, camera_matrix, points, depth_scale,
+        inlier_threshold=inlier_threshold, icp_iterations=icp_iterations,
+        icp_time_budget=icp_time_budget)
+    pointcloud = open3d.geometry.PointCloud()
+    pointcloud.points = open3d.utility.Vector3dVector(aligned_points)
+    return pointcloud, camera_angle
 
 
+def align_pointcloud(reference_mesh, img, camera_matrix, pointcloud, depth_scale,
+                     detected_arucos=None, inlier_threshold=None, icp_iterations=0,
+                     icp_time_budget=None, return_inliers=False):
+    """Align an already loaded pointcloud to the reference mesh.
+
+    Same as `align_pointcloud_to_reference`, but with everything in memory: img is the image
+    array, camera_matrix a dictionary or a 3x3 intrinsics matrix (see `get_camera_matrix`), and
+    pointcloud an open3d pointcloud, which is transformed in place, or any array or buffer of
+    points (e.g. from `plyfiles.read_ply_points`), which gives a new (N, 3) array. The ArUco
+    detection can be passed in as detected_arucos to skip detecting them in img. With an
+    inlier_threshold (in mm), corners with a bad depth are left out of the alignment, see
+    `estimate_rigid_transform`. With icp_iterations, the fiducial alignment is refined against
+    the surface of the mesh for at most that many iterations, or icp_time_budget seconds, see
+    `refine_alignment`. With return_inliers, the CornerFit of the fiducial corners is returned
+    last, e.g. to see which corners were rejected.
+    """
+    rigid_transform, camera_angle, corner_fit = estimate_pointcloud_transform(
+        reference_mesh, img, camera_matrix, pointcloud, depth_scale,
+        detected_arucos=detected_arucos, inlier_threshold=inlier_threshold, return_inliers=True)
+
+    # transform the pointcloud
+    # and write a new one
+    with timing.stage("transform"):
+        aligned_pointcloud = apply_rigid_transform(pointcloud, rigid_transform)
+    if icp_iterations:
+        refinement = refine_alignment(
+            reference_mesh, aligned_pointcloud, depth_scale, max_iterations=icp_iterations,
+            time_budget=icp_time_budget)
+        with timing.stage("transform"):
+            aligned_pointcloud = apply_rigid_transform(aligned_pointcloud, refinement)
+        camera_angle = refinement[:3, :3] @ camera_angle
+    if return_inliers:
+        return aligned_pointcloud, camera_angle, corner_fit
+    return aligned_pointcloud, camera_angle
+
+
+def align_and_crop_pointcloud(reference_mesh, img, camera_matrix, pointcloud, depth_scale,
+                              detected_arucos=None, inlier_threshold=None, icp_iterations=0,
+                              icp_time_budget=None, return_inliers=False):
+    """Align a pointcloud to the reference mesh, only keeping the points of the pattern area.
+
+    Same as `align_pointcloud` followed by `clip_pointcloud_to_pattern_area`, but only the
+    points of the pattern area are ever transformed, see `crop_to_pattern_area`. Returns the
+    aligned (M, 3) points, the camera angle, and the indices of the points in pointcloud (and
+    the CornerFit, with return_inliers).
+    """
+    rigid_transform, camera_angle, corner_fit = estimate_pointcloud_transform(
+        reference_mesh, img, camera_matrix, pointcloud, depth_scale,
+        detected_arucos=detected_arucos, inlier_threshold=inlier_threshold, return_inliers=True)
+    if icp_iterations:
+        # the refinement only uses the points of the pattern area anyway
+        aligned_points, _ = crop_to_pattern_area(
+            reference_mesh, pointcloud, rigid_transform, depth_scale)
+        refinement = refine_alignment(
+            reference_mesh, aligned_points, depth_scale, max_iterations=icp_iterations,
+            time_budget=icp_time_budget)
+        rigid_transform = refinement @ rigid_transform
+        camera_angle = refinement[:3, :3] @ camera_angle
+    aligned_points, indices = crop_to_pattern_area(
+        reference_mesh, pointcloud, rigid_transform, depth_scale)
+    if return_inliers:
+        return aligned_points, camera_angle, indices, corner_fit
+    return aligned_points, camera_angle, indices
+
+
+def estimate_pointcloud_transform(reference_mesh, img, camera_matrix, pointcloud, depth_scale,
+                                  detected_arucos=None, inlier_threshold=None,
+                                  return_inliers=False):
+    """Return the rigid transform aligning a pointcloud to the reference mesh, and the camera
+    angle, from the fiducials in img; the arguments are those of `align_pointcloud`."""
+    camera_matrix = get_camera_matrix(camera_matrix)
+    if detected_arucos is None:
+        with timing.stage("aruco_detection"):
+            detected_arucos = detect_arucos(img)
+
+    with timing.stage("corner_matching"):
+        corner_list = get_corner_list(reference_mesh, detected_arucos)
+        corner_coordinates = compute_corner_coordinates(pointcloud, camera_matrix, corner_list)
+    return estimate_rigid_transform(
+        reference_mesh, detected_arucos, corner_coordinates, depth_scale,
+        inlier_threshold=inlier_threshold, return_inliers=return_inliers)
+
+
+def align_depth_image_to_reference(
+        reference_mesh, rgb_filename, camera_matrix_filename, depth_filename, depth_scale,
+        inlier_threshold=None, icp_iterations=0, icp_time_budget=None):
+    """Align an organized depth image to the reference mesh.
+
+    This is the organized counterpart of `align_pointcloud_to_reference`: depth_filename is a
+    uint16 depth image (PNG or `.npy`) registered to the RGB image, whose values multiplied by
+    depth_scale give the depth in the units of the pointcloud. The corner coordinates are read
+    straight from the pixel neighbourhood of every ArUco corner, and only the pixels that can
+    fall inside the pattern area are deprojected, so the full pointcloud is never built.
+    Returns the aligned (partial) pointcloud and the camera angle.
+    """
+    with timing.stage("image_load"):
+        img = cv2.imread(rgb_filename)
+        camera_matrix = read_camera_matrix(camera_matrix_filename)
+    with timing.stage("cloud_load"):
+        depth_image = depthimages.read_depth_image(depth_filename)
+
+    points, camera_angle = align_depth_image(
+        reference_mesh, img, camera_matrix, depth_image, depth_scale,
+        inlier_threshold=inlier_threshold, icp_iterations=icp_iterations,
+        icp_time_budget=icp_time_budget)
+    return open3d.geometry.PointCloud(open3d.utility.Vector3dVector(points)), camera_angle
+
+
+def align_depth_image(reference_mesh, img, camera_matrix, depth_image, depth_scale,
+                      detected_arucos=None, inlier_threshold=None, icp_iterations=0,
+                      icp_time_budget=None, return_indices=False, return_transform=False,
+                      return_inliers=False):
+    """Align an already loaded depth image to the reference mesh.
+
+    Same as `align_depth_image_to_reference`, but with the image, the camera matrix (see
+    `get_camera_matrix`) and the depth image array already in memory. Returns the aligned
+    points as an (N, 3) array, and the camera angle. detected_arucos, inlier_threshold and the
+    ICP options are the same as for `align_pointcloud`. With return_indices, the flat index of
+    the pixel of every point in depth_image is returned as well, e.g. to map the residuals of
+    the points back into the image (see `residuals.PointResiduals`). With return_transform, the
+    4x4 rigid transform that aligned the points is returned after them, and with return_inliers,
+    the CornerFit of the fiducial corners is returned last.
+    """
+    camera_matrix = get_camera_matrix(camera_matrix)
+    if detected_arucos is None:
+        with timing.stage("aruco_detection"):
+            detected_arucos = detect_arucos(img)
+
+    with timing.stage("corner_matching"):
+        corner_list = get_corner_list(reference_mesh, detected_arucos)
+        corner_coordinates = depthimages.compute_corner_coordinates(
+            depth_image, camera_matrix, corner_list, depth_scale)
+    rigid_transform, camera_angle, corner_fit = estimate_rigid_transform(
+        reference_mesh, detected_arucos, corner_coordinates, depth_scale,
+        inlier_threshold=inlier_threshold, return_inliers=True)
+
+    # only deproject the part of the image that the pattern area projects into
+    with timing.stage("deprojection"):
+        row_start, row_stop, col_start, col_stop = depthimages.project_bounds_to_window(
+            *get_pattern_area_bounds(reference_mesh, depth_scale),
+            transform=tfms.inverse_matrix(rigid_transform),
+            camera_matrix=camera_matrix,
+            shape=depth_image.shape)
+        points, pixel_indices = depthimages.deproject_window(
+            depth_image, camera_matrix, depth_scale, row_start, row_stop, col_start, col_stop,
+            return_indices=True)
+
+    with timing.stage("transform"):
+        aligned_points = apply_rigid_transform(points, rigid_transform)
+    if icp_iterations:
+        refinement = refine_alignment(
+            reference_mesh, aligned_points, depth_scale, max_iterations=icp_iterations,
+            time_budget=icp_time_budget)
+        with timing.stage("transform"):
+            aligned_points = apply_rigid_transform(aligned_points, refinement)
+        camera_angle = refinement[:3, :3] @ camera_angle
+        rigid_transform = refinement @ rigid_transform
+    result = (aligned_points, camera_angle)
+    if return_indices:
+        result += (pixel_indices,)
+    if return_transform:
+        result += (rigid_transform,)
+    if return_inliers:
+        result += (corner_fit,)
+    return result
+
+
+def read_pointcloud(pointcloud_filename):
+    """Read a pointcloud file: a PLY as memory-mapped (N, 3) points, anything else with open3d."""
+    with timing.stage("cloud_load"):
+        if os.path.splitext(pointcloud_filename)[1].lower() == ".ply":
+            return plyfiles.read_ply_points(pointcloud_filename)
+        return open3d.io.read_point_cloud(pointcloud_filename)
+
+
+def read_camera_matrix(camera_matrix_filename):
+    """Read the camera intrinsics (fx, fy, ppx, ppy) from a JSON file."""
+    with open(camera_matrix_filename, 'r') as j_file:
+        return json.load(j_file)
+
+
+def get_camera_matrix(camera_matrix):
+    """Return the intrinsics dictionary (fx, fy, ppx, ppy) of a dictionary or a 3x3 matrix."""
+    if isinstance(camera_matrix, dict):
+        return camera_matrix
+    intrinsics = np.asarray(camera_matrix, dtype=float)
+    if intrinsics.shape != (3, 3):
+        raise ValueError("Expected a 3x3 camera matrix, got shape {}".format(intrinsics.shape))
+    return {
+        "fx": intrinsics[0, 0],
+        "fy": intrinsics[1, 1],
+        "ppx": intrinsics[0, 2],
+        "ppy": intrinsics[1, 2],
+    }
+
+
+def get_corner_list(reference_mesh, detected_arucos):
+    """Return the (row, col) pixel of every detected corner of the reference mesh fiducials."""
     # Create a dictionary of the aruco corner points so as to find the 3D coordinates when
     # deprojecting the pointcloud.
     corner_list = []
@@ -30,8 +270,51 @@ def align_pointcloud_to_reference(
         if aruco_id in reference_mesh.fiducial_locations.keys():
             for location, corner in corners.items():
                 corner_list.append((int(corner[1]), int(corner[0])))
+    return corner_list
+
+
+def estimate_rigid_transform(reference_mesh, detected_arucos, corner_coordinates, depth_scale,
+                             inlier_threshold=None, return_inliers=False):
+    """Estimate the transform from the camera frame to the (depth_scale scaled) reference mesh.
+
+    corner_coordinates maps the (row, col) pixel of the detected corners to their measured 3D
+    coordinate. Returns the 4x4 rigid transform and the camera angle in the reference frame.
+    By default all the corners are fit by least squares; with an inlier_threshold (in mm), the
+    corners with a bad depth are rejected first, see `fit_rigid_transform_ransac`. With
+    return_inliers, the CornerFit of the corners is returned as well; without an
+    inlier_threshold, all of them are inliers.
+    """
+    with timing.stage("rigid_fit"):
+        measured_coords, reference_coords = get_corner_correspondences(
+            reference_mesh, detected_arucos, corner_coordinates, depth_scale)
+
+        # estimate the rigid transform
+        if inlier_threshold is None:
+            rigid_transform = tfms.affine_matrix_from_points(
+                measured_coords.T, reference_coords.T, shear=False, scale=False)
+            inliers = np.ones(len(measured_coords), dtype=bool)
+            residuals = np.linalg.norm(
+                measured_coords @ rigid_transform[:3, :3].T + rigid_transform[:3, 3] -
+                reference_coords, axis=1)
+        else:
+            rigid_transform, inliers, residuals = fit_rigid_transform_ransac(
+                measured_coords, reference_coords, inlier_threshold * depth_scale)
 
-    corner_coordinates = compute_corner_coordinates(pointcloud, camera_matrix, corner_list)
+    # estimate the camera_angle by multiplying the "ideal camera angle"
+    # by the inverse of the rotation matrix
+    camera_angle = rigid_transform[:3, :3] @ np.array([0, 0, -1])
+    if return_inliers:
+        corner_fit = CornerFit(reference_coords / depth_scale, inliers, residuals / depth_scale)
+        return rigid_transform, camera_angle, corner_fit
+    return rigid_transform, camera_angle
+
+
+def get_corner_correspondences(reference_mesh, detected_arucos, corner_coordinates, depth_scale):
+    """Return the (N, 3) measured coordinates of the corners and their reference coordinates.
+
+    Only the corners with a measured coordinate are returned, and the reference coordinates
+    are scaled by depth_scale.
+    """
     # go through the detected arucos to get the reference coordinates, and concatenate
     # two lists of matrices corresponding to both
     measured_coords = []
@@ -44,7 +327,8 @@ def align_pointcloud_to_reference(
                 # in the reference mesh
                 reference_coordinate = reference_mesh.get_fiducial_coordinate(
                     fiducial_id=aruco_id, location=location)
-                detected_coordinate = corner_coordinates[(int(corner[1]), int(corner[0]))]
+                detected_coordinate = corner_coordinates.get(
+                    (int(corner[1]), int(corner[0])), np.array([]))
 
                 # if the depth is a valid value, then we can use it for estimation
                 if detected_coordinate.size != 0:
@@ -53,24 +337,156 @@ def align_pointcloud_to_reference(
 
     # convert the coordinates into arrays for processing, and make sure the reference
     # is scaled by the depth_scale of the detected pointcloud
-    measured_coords = np.array(measured_coords)
-    reference_coords = np.array(reference_coords) * depth_scale
-
-    # estimate the rigid transform
-    rigid_transform = tfms.affine_matrix_from_points(
-        measured_coords.T, reference_coords.T, shear=False, scale=False)
-
-    # estimate the camera_angle by multiplying the "ideal camera angle"
-    # by the inverse of the rotation matrix
-    camera_angle = rigid_transform[:3, :3] @ np.array([0, 0, -1])
-    # transform the pointcloud
-    # and write a new one
+    measured_coords = np.array(measured_coords).reshape(-1, 3)
+    reference_coords = np.array(reference_coords).reshape(-1, 3) * depth_scale
+    return measured_coords, reference_coords
+
+
+def fit_rigid_transform_ransac(measured_coords, reference_coords, inlier_threshold,
+                               max_hypotheses=200):
+    """Fit the rigid transform from measured_coords to reference_coords, robust to outliers.
+
+    Every (non-degenerate) triple of corners gives a hypothesis transform, or max_hypotheses
+    random triples of them when there are more. All the hypotheses are built and scored at once:
+    the corners within inlier_threshold (in the units of the coordinates) of their reference
+    are inliers, and the hypothesis with the most inliers, then the smallest truncated squared
+    residuals, wins. The transform is then refit by least squares on its inliers.
+
+    Returns the 4x4 rigid transform, the boolean inlier mask of the corners and the residual
+    distance of every corner from its reference coordinate under the transform. Raises a
+    ValueError when no hypothesis has the 3 inliers needed for the refit.
+    """
+    num_corners = len(measured_coords)
+    if num_corners < 3:
+        raise ValueError("Need at least 3 corners to fit a rigid transform, got {}".format(
+            num_corners))
+
+    triples = get_corner_triples(num_corners, max_hypotheses)
+    measured_triples = measured_coords[triples]
+    reference_triples = reference_coords[triples]
+
+    # triples of (almost) collinear corners do not define a transform
+    normals = np.cross(reference_triples[:, 1] - reference_triples[:, 0],
+                       reference_triples[:, 2] - reference_triples[:, 0])
+    areas = np.sum(normals ** 2, axis=1)
+    is_valid = areas > 1e-6 * np.max(areas)
+    if not np.any(is_valid):
+        raise ValueError("All the corners are collinear")
+    hypotheses = tfms.rigid_matrices_from_points(
+        measured_triples[is_valid].transpose(0, 2, 1),
+        reference_triples[is_valid].transpose(0, 2, 1))
+
+    # all the hypotheses are applied to all the corners in a single matrix product
+    offsets = (hypotheses[:, :3, :3].reshape(-1, 3) @ measured_coords.T).reshape(
+        len(hypotheses), 3, num_corners) + hypotheses[:, :3, 3:] - reference_coords.T
+    squared_residuals = offsets[:, 0] ** 2 + offsets[:, 1] ** 2 + offsets[:, 2] ** 2
+    inliers = squared_residuals < inlier_threshold ** 2
+    costs = np.sum(np.minimum(squared_residuals, inlier_threshold ** 2), axis=1)
+    best = np.lexsort((costs, -np.sum(inliers, axis=1)))[0]
+    if np.count_nonzero(inliers[best]) < 3:
+        raise ValueError(
+            "No rigid transform has 3 corners within {} of their reference, the inlier threshold "
+            "is too small or the depths are bad".format(inlier_threshold))
+
+    # refit on the inliers of the best hypothesis
+    rigid_transform = tfms.rigid_matrices_from_points(
+        measured_coords.T[np.newaxis], reference_coords.T[np.newaxis], weights=inliers[best])[0]
+    residuals = np.linalg.norm(
+        measured_coords @ rigid_transform[:3, :3].T + rigid_transform[:3, 3] - reference_coords,
+        axis=1)
+    return rigid_transform, residuals < inlier_threshold, residuals
+
+
+@functools.lru_cache()
+def get_corner_triples(num_corners, max_triples=None):
+    """Return the (M, 3) indices of the triples of num_corners corners, at most max_triples.
+
+    When there are more triples than max_triples, a random (but fixed) subset of them is
+    returned, so that the alignment of a capture is reproducible.
+    """
+    triples = np.array(list(itertools.combinations(range(num_corners), 3)), dtype=np.int64)
+    if max_triples is not None and len(triples) > max_triples:
+        rng = np.random.RandomState(0)
+        triples = triples[np.sort(rng.choice(len(triples), max_triples, replace=False))]
+    triples.setflags(write=False)
+    return triples
+
+
+@timing.timed("icp_refinement")
+def refine_alignment(reference_mesh, aligned_pointcloud, depth_scale, initial_transform=None,
+                     max_iterations=20, time_budget=None, max_distance=3.0, max_points=5000,
+                     tolerance=1e-5):
+    """Refine the alignment of an aligned pointcloud with point-to-plane ICP against the mesh.
+
+    The fiducials only pin down the pose through a handful of corners; this fits all the points
+    of the pattern area to the surface instead. Every iteration matches the points to their
+    closest face through the cached `ReferenceMesh.get_surface_samples`, drops the matches
+    farther than max_distance (in mm), and solves the linearized least squares problem for a
+    small rigid motion that minimizes their distances to the planes of their faces.
+
+    At most max_points points of the pattern area are used (a fixed random subset of them).
+    The iterations start from initial_transform (e.g. the refinement of the previous frame of a
+    sequence), and stop once a step is smaller than tolerance, after max_iterations, or once
+    time_budget seconds have passed. Returns the 4x4 rigid transform, in the units of the
+    pointcloud, that moves aligned_pointcloud onto the mesh.
+    """
+    start_time = time.perf_counter()
+    min_bound, max_bound = get_pattern_area_bounds(reference_mesh, depth_scale)
+    points = get_points(aligned_pointcloud)
+    points = points[np.all((points >= min_bound) & (points <= max_bound), axis=1)]
+    if len(points) > max_points:
+        rng = np.random.RandomState(0)
+        points = points[rng.choice(len(points), max_points, replace=False)]
+    # work in the units of the mesh
+    points = points / depth_scale
+
+    transform = np.identity(4)
+    if initial_transform is not None:
+        transform[:3, :3] = initial_transform[:3, :3]
+        transform[:3, 3] = initial_transform[:3, 3] / depth_scale
+
+    surface_samples = reference_mesh.get_surface_samples()
+    for _ in range(max_iterations):
+        moved_points = points @ transform[:3, :3].T + transform[:3, 3]
+        closest_points, normals, is_matched = surface_samples.query(
+            moved_points, max_distance=max_distance)
+        if np.count_nonzero(is_matched) < 6:
+            break
+        moved_points = moved_points[is_matched]
+
+        # the distance along the normal changes by n . (w x p + t) = (p x n) . w + n . t
+        # for a small rotation w and translation t
+        residuals = np.einsum("ij,ij->i", moved_points - closest_points, normals)
+        jacobian = np.hstack([np.cross(moved_points, normals), normals])
+        step = np.linalg.lstsq(jacobian, -residuals, rcond=None)[0]
+
+        increment = np.identity(4)
+        angle = np.linalg.norm(step[:3])
+        if angle > 0:
+            increment = tfms.rotation_matrix(angle, step[:3])
+        increment[:3, 3] = step[3:]
+        transform = increment @ transform
+
+        if np.linalg.norm(step) < tolerance or \
+                (time_budget is not None and time.perf_counter() - start_time > time_budget):
+            break
+
+    transform[:3, 3] *= depth_scale
+    return transform
+
+
+def apply_rigid_transform(pointcloud, rigid_transform):
+    """Transform an open3d pointcloud in place, or return the transformed (N, 3) points."""
+    if not hasattr(pointcloud, "points"):
+        aligned_points = get_points(pointcloud) @ rigid_transform[:3, :3].T
+        aligned_points += rigid_transform[:3, 3]
+        return aligned_points
     pointcloud.transform(rigid_transform)
-    return pointcloud, camera_angle
+    return pointcloud
 
 
-def clip_pointcloud_to_pattern_area(reference_mesh, aligned_pointcloud, depth_scale):
-    # clip the pointcloud to the area of interest
+def get_pattern_area_bounds(reference_mesh, depth_scale):
+    """Return the min and max bound of the pattern area box, scaled by depth_scale."""
     # we only want to clip INSIDE the area inside the pattern plate
     # TODO: get these numbers from the reference_mesh.pattern_plate mesh
     working_height = 82.55
@@ -88,37 +504,159 @@ def clip_pointcloud_to_pattern_area(reference_mesh, aligned_pointcloud, depth_sc
     # as well
     min_bound = np.array([-working_width / 2, -working_height / 2, min_model_z - buffer_bounds])
     max_bound = np.array([working_width / 2, working_height / 2, max_model_z + buffer_bounds])
+    return depth_scale * min_bound, depth_scale * max_bound
+
 
+@timing.timed("crop")
+def clip_pointcloud_to_pattern_area(reference_mesh, aligned_pointcloud, depth_scale,
+                                    return_indices=False):
+    """Return the part of the aligned pointcloud inside the pattern area.
+
+    With return_indices, the indices of the kept points in aligned_pointcloud are returned as
+    well, in the same order as the points of the clipped pointcloud.
+    """
+    # clip the pointcloud to the area of interest
+    min_bound, max_bound = get_pattern_area_bounds(reference_mesh, depth_scale)
+    if return_indices:
+        points = get_points(aligned_pointcloud)
+        indices = np.flatnonzero(np.all((points >= min_bound) & (points <= max_bound), axis=1))
+        if not hasattr(aligned_pointcloud, "points"):
+            return points[indices], indices
+        return aligned_pointcloud.select_by_index(indices), indices
+    if not hasattr(aligned_pointcloud, "points"):
+        points = get_points(aligned_pointcloud)
+        return points[np.all((points >= min_bound) & (points <= max_bound), axis=1)]
     cropped_pointcloud = open3d.geometry.PointCloud.crop(
         aligned_pointcloud,
-        open3d.geometry.AxisAlignedBoundingBox(
-        min_bound=depth_scale * min_bound,
-        max_bound=depth_scale * max_bound))
+        open3d.geometry.AxisAlignedBoundingBox(min_bound=min_bound, max_bound=max_bound))
 
     return cropped_pointcloud
 
 
-def compute_corner_coordinates(pointcloud, camera_matrix, corner_list):
-
-    corner_coordinates = {}
+@timing.timed("crop")
+def crop_to_pattern_area(reference_mesh, pointcloud, rigid_transform, depth_scale,
+                         chunk_size=CHUNK_SIZE, dtype=np.float64):
+    """Return the points of an unaligned pointcloud inside the pattern area, aligned.
+
+    rigid_transform aligns the pointcloud to the reference mesh. Instead of transforming every
+    point, the pattern area box is moved into the frame of the pointcloud, and only the points
+    inside the bounding box of the moved box are transformed and checked against the pattern
+    area; most points are outside of it, and are only compared to its bounds. The points are
+    processed chunk_size at a time, in dtype (see `crop_and_calculate_rmse_and_density` for
+    np.float32). Returns the aligned (M, 3) points, and their indices in pointcloud.
+    """
+    points = get_points(pointcloud)
+    crop_chunk = _make_chunk_cropper(reference_mesh, rigid_transform, depth_scale, dtype=dtype)
+    chunks = [crop_chunk(points, start, start + chunk_size)
+              for start in range(0, len(points), chunk_size)]
+    if not chunks:
+        return np.empty((0, 3), dtype=dtype), np.empty(0, dtype=np.int64)
+    aligned_points, indices = zip(*chunks)
+    return np.concatenate(aligned_points), np.concatenate(indices)
+
+
+def _make_chunk_cropper(reference_mesh, rigid_transform, depth_scale, scale=1.0,
+                        dtype=np.float64):
+    """Return crop_chunk(points, start, stop), which crops points[start:stop] like
+    `crop_to_pattern_area`, returning the aligned points multiplied by scale, as dtype, and
+    their indices in points."""
+    # the pattern area box in the units of the output
+    min_bound, max_bound = get_pattern_area_bounds(reference_mesh, depth_scale * scale)
+    min_bound, max_bound = min_bound.astype(dtype), max_bound.astype(dtype)
+
+    # the bounding box of the pattern area in the frame of the pointcloud, padded by a
+    # micrometer to not lose the points on the edges of the pattern area to rounding
+    inverse_transform = tfms.inverse_matrix(rigid_transform)
+    box_corners = np.array(list(itertools.product(*zip(min_bound, max_bound)))) / scale
+    box_corners = box_corners @ inverse_transform[:3, :3].T + inverse_transform[:3, 3]
+    lower_bound = (box_corners.min(axis=0) - 1e-3 * depth_scale).astype(dtype)
+    upper_bound = (box_corners.max(axis=0) + 1e-3 * depth_scale).astype(dtype)
+
+    # the scaling is folded into the transform, to not need another pass over the points
+    rotation = (scale * rigid_transform[:3, :3].T).astype(dtype)
+    translation = (scale * rigid_transform[:3, 3]).astype(dtype)
+
+    def crop_chunk(points, start, stop):
+        chunk = points[start:stop]
+        is_candidate = (chunk[:, 0] >= lower_bound[0]) & (chunk[:, 0] <= upper_bound[0])
+        for axis in (1, 2):
+            is_candidate &= chunk[:, axis] >= lower_bound[axis]
+            is_candidate &= chunk[:, axis] <= upper_bound[axis]
+        candidates = np.flatnonzero(is_candidate)
+
+        aligned_points = chunk[candidates].astype(dtype, copy=False) @ rotation
+        aligned_points += translation
+        is_inside = np.all((aligned_points >= min_bound) & (aligned_points <= max_bound), axis=1)
+        return aligned_points[is_inside], candidates[is_inside] + start
+
+    return crop_chunk
+
+
+def compute_corner_coordinates(pointcloud, camera_matrix, corner_list, pixel_tol=3):
+    """Return the mean 3D point of the pointcloud around each (row, col) corner in corner_list.
+
+    The whole pointcloud is projected into the image in one pass, and points are assigned to
+    corners through a lookup image that covers the +/- pixel_tol window around every corner.
+    Where windows overlap, the corner that comes first in corner_list wins, just like
+    `fuzzy_match_corner`. Corners without any matching points are left out of the result.
+    """
     rectified_corner_cordinates = {}
+    points = get_points(pointcloud)
+    if not corner_list or len(points) == 0:
+        return rectified_corner_cordinates
+
+    corners = np.array(corner_list, dtype=np.int64).reshape(-1, 2)
+
+    # build a lookup image spanning all the corner windows, where each pixel holds the index
+    # of the corner it matches (or -1); fill it back to front so earlier corners take precedence
+    origin = corners.min(axis=0) - pixel_tol
+    shape = corners.max(axis=0) + pixel_tol + 1 - origin
+    lookup = np.full(shape, -1, dtype=np.int64)
+    for index in range(len(corners) - 1, -1, -1):
+        row, col = corners[index] - origin
+        lookup[row - pixel_tol:row + pixel_tol + 1, col - pixel_tol:col + pixel_tol + 1] = index
+
+    # project every point into the image; points at zero depth project to inf / nan,
+    # which then fall outside the lookup image and are ignored
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u = np.floor(camera_matrix["fx"] * points[:, 0] / points[:, 2] + camera_matrix["ppx"])
+        v = np.floor(camera_matrix["fy"] * points[:, 1] / points[:, 2] + camera_matrix["ppy"])
+    rows = v - origin[0]
+    cols = u - origin[1]
+    in_lookup = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+
+    matched_corners = np.full(len(points), -1, dtype=np.int64)
+    matched_corners[in_lookup] = lookup[
+        rows[in_lookup].astype(np.int64), cols[in_lookup].astype(np.int64)]
+    is_matched = matched_corners >= 0
+    matched_corners = matched_corners[is_matched]
+    matched_points = points[is_matched]
+
+    # average the matched points per corner
+    counts = np.bincount(matched_corners, minlength=len(corners))
+    sums = np.stack([
+        np.bincount(matched_corners, weights=matched_points[:, axis], minlength=len(corners))
+        for axis in range(3)], axis=1)
+    for index in np.flatnonzero(counts):
+        rectified_corner_cordinates[corner_list[index]] = sums[index] / counts[index]
 
-    for entry in corner_list:
-        corner_coordinates[entry] = []
+    return rectified_corner_cordinates
 
-    for point in np.asarray(pointcloud.points):
-        u = np.floor(camera_matrix["fx"] * point[0] / point[2] + camera_matrix["ppx"])
-        v = np.floor(camera_matrix["fy"] * point[1] / point[2] + camera_matrix["ppy"])
 
-        matched_corner = fuzzy_match_corner(u, v, corner_list)
-        if matched_corner:
-            corner_coordinates[matched_corner].append(point)
+def get_points(pointcloud):
+    """Return the (N, 3) points of an open3d pointcloud, or of an array or buffer of points.
 
-    for key, val in corner_coordinates.items():
-        if val:
-            rectified_corner_cordinates[key] = np.mean(val, axis=0)
-
-    return rectified_corner_cordinates
+    A flat array or buffer (e.g. the vertex buffer of a camera driver) holds consecutive
+    x, y, z coordinates.
+    """
+    if hasattr(pointcloud, "points"):
+        return np.asarray(pointcloud.points)
+    points = np.asarray(pointcloud)
+    if points.ndim == 1:
+        points = points.reshape(-1, 3)
+    elif points.ndim != 2 or points.shape[1] != 3:
+        raise ValueError("Expected (N, 3) points, got shape {}".format(points.shape))
+    return points
 
 
 def fuzzy_match_corner(u, v, corners, pixel_tol=3):
@@ -131,20 +669,261 @@ def fuzzy_match_corner(u, v, corners, pixel_tol=3):
             return corner
 
 
-def calculate_rmse_and_density(ground_truth_mesh, cropped_pointcloud, depth_scale, camera_angle):
-    # need to get the reference mesh and the pointcloud in the same units
-    squared_distances, _, _ = pymesh.distance_to_mesh(
-        ground_truth_mesh.reference_mesh, np.asarray(cropped_pointcloud.points) / depth_scale)
-
-    rmse = np.sqrt(np.sum(squared_distances) / len(squared_distances))
-    distance_thresh = 2  # mm of distance
-    threshold = distance_thresh ** 2
-    num_valid_pixels = len(squared_distances[squared_distances < threshold])
-
-    valid_pattern_surface_area = ground_truth_mesh.get_pattern_surface_area(
-        camera_angle=camera_angle)
-
-    return rmse, num_valid_pixels / valid_pattern_surface_area
+def calculate_rmse_and_density(
+        ground_truth_mesh, cropped_pointcloud, depth_scale, camera_angle, distance_method="pymesh",
+        return_residuals=False, chunk_size=CHUNK_SIZE, dtype=np.float64, tolerance=None,
+        confidence=0.95):
+    """Return the RMSE (in mm) of the cropped pointcloud to the mesh, and its density.
+
+    The density is the number of points within 2 mm of the mesh per mm^2 of the pattern surface
+    visible from camera_angle. With return_residuals, the distance (in mm) of every point to the
+    mesh is returned as well, as float16 to keep it compact (see `residuals.PointResiduals`).
+    The distances are computed chunk_size points at a time (see `CHUNK_SIZE`), with the points
+    in dtype.
+
+    With a tolerance (in mm), the metrics are only estimated from a sample of the points, see
+    `estimate_rmse_and_density`, and returned as ApproximateMetrics.
+    """
+    if tolerance is not None:
+        if return_residuals:
+            raise ValueError("the residuals of every point need the exact metrics")
+        return estimate_rmse_and_density(
+            ground_truth_mesh, cropped_pointcloud, depth_scale, camera_angle, tolerance,
+            confidence=confidence, distance_method=distance_method, chunk_size=chunk_size,
+            dtype=dtype)
+
+    points = get_points(cropped_pointcloud)
+    sums = _DistanceSums(return_residuals)
+    buffer = np.empty((min(chunk_size, len(points)), 3), dtype=dtype)
+    for start in range(0, len(points), chunk_size):
+        # need to get the reference mesh and the pointcloud in the same units
+        chunk = _scale_chunk(points[start:start + chunk_size], 1 / depth_scale, buffer)
+        sums.add(ground_truth_mesh, chunk, distance_method)
+    return sums.get_metrics(ground_truth_mesh, camera_angle)
+
+
+def _scale_chunk(points, scale, buffer):
+    """Return (N, 3) points times scale in the first N rows of buffer, in a single pass."""
+    return np.multiply(points, scale, out=buffer[:len(points)], casting="unsafe")
+
+
+def estimate_rmse_and_density(
+        ground_truth_mesh, cropped_pointcloud, depth_scale, camera_angle, tolerance,
+        confidence=0.95, distance_method="pymesh", voxel_size=10.0, min_samples=4096,
+        max_samples=None, seed=0, chunk_size=CHUNK_SIZE, dtype=np.float64):
+    """Return ApproximateMetrics of the cropped pointcloud, from a sample of its points.
+
+    The points are stratified by voxels of voxel_size mm and sampled in proportion to the
+    number of points of every voxel, so that the sample covers the pattern area evenly. The
+    sample starts with about min_samples points and doubles until the confidence interval of
+    the RMSE reaches less than tolerance mm on either side of it, or until it holds max_samples
+    points (by default all of them, and the metrics are then exact). Only the sampled points
+    are queried, but drawing the samples still takes a few vectorized passes over all of them,
+    and 16 bytes per point (see `_StratifiedSampler`), so the latency is bounded by that of the
+    distance queries of max_samples points plus a cost linear in the number of points, a small
+    fraction of that of the exact metrics.
+
+    The interval of the RMSE is that of the normal approximation of the mean squared distance,
+    and that of the density a Wilson interval, both with the variance of a simple random sample
+    of the same size, which is at least that of the stratified sample, and its finite
+    population correction. They are optimistic for heavy-tailed distances (e.g. many flying
+    pixels), so audits should use the exact metrics. The sample is random but fixed by seed, so
+    that the estimates are reproducible.
+    """
+    points = get_points(cropped_pointcloud)
+    num_points = len(points)
+    if num_points == 0:
+        return ApproximateMetrics(np.nan, 0.0, (np.nan, np.nan), (0.0, 0.0), 0)
+    max_samples = num_points if max_samples is None else min(max_samples, num_points)
+    with timing.stage("stratify"):
+        sampler = _StratifiedSampler(
+            points, voxel_size * depth_scale, np.random.RandomState(seed))
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    with timing.stage("surface_area"):
+        valid_pattern_surface_area = ground_truth_mesh.get_pattern_surface_area(
+            camera_angle=camera_angle)
+
+    sums = _DistanceSums()
+    buffer = np.empty((min(chunk_size, max_samples), 3), dtype=dtype)
+    sampled = np.empty(0, dtype=np.int64)
+    sample_size = min(min_samples, max_samples)
+    while True:
+        with timing.stage("stratify"):
+            indices = sampler.sample(sample_size / num_points)
+        # the samples are nested, so only the points new to this one are queried, in order
+        # (e.g. from a memory-mapped file)
+        new_indices = np.setdiff1d(indices, sampled, assume_unique=True)
+        sampled = indices
+        for start in range(0, len(new_indices), chunk_size):
+            chunk = _scale_chunk(
+                points[new_indices[start:start + chunk_size]], 1 / depth_scale, buffer)
+            sums.add(ground_truth_mesh, chunk, distance_method)
+
+        num_samples = sums.num_points
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # the half width of the interval of the mean squared distance
+            finite_population_correction = 1 - num_samples / num_points
+            mean_squared_distance = np.float64(sums.sum_squared_distances) / num_samples
+            variance = (sums.sum_fourth_powers / num_samples - mean_squared_distance ** 2) * \
+                num_samples / (num_samples - 1)
+            mean_half_width = z * np.sqrt(
+                max(variance, 0) * finite_population_correction / num_samples)
+            rmse = np.sqrt(mean_squared_distance)
+            rmse_bounds = (np.sqrt(max(mean_squared_distance - mean_half_width, 0)),
+                           np.sqrt(mean_squared_distance + mean_half_width))
+        if sample_size >= max_samples or \
+                max(rmse - rmse_bounds[0], rmse_bounds[1] - rmse) < tolerance:
+            break
+        sample_size = min(2 * sample_size, max_samples)
+
+    valid_fraction = sums.num_valid_points / num_samples
+    density = num_points * valid_fraction / valid_pattern_surface_area
+    if num_samples == num_points:
+        return ApproximateMetrics(rmse, density, rmse_bounds, (density, density), num_samples)
+
+    # the Wilson interval of the fraction of points near the mesh, which does not collapse when
+    # all of the sample is near it, with the finite population correction in its sample size
+    effective_size = num_samples / finite_population_correction
+    center = (valid_fraction + z ** 2 / (2 * effective_size)) / (1 + z ** 2 / effective_size)
+    half_width = z / (1 + z ** 2 / effective_size) * np.sqrt(
+        valid_fraction * (1 - valid_fraction) / effective_size +
+        z ** 2 / (4 * effective_size ** 2))
+    density_bounds = (num_points * (center - half_width) / valid_pattern_surface_area,
+                      num_points * (center + half_width) / valid_pattern_surface_area)
+    return ApproximateMetrics(rmse, density, rmse_bounds, density_bounds, num_samples)
+
+
+class _StratifiedSampler:
+    """Growing proportional stratified samples of points, without sorting all of them.
+
+    The strata are the voxels of voxel_size (in the units of the points). Every point gets a
+    random key, and the sample of a fraction of the points takes the points with the smallest
+    keys of every voxel, as many as that fraction of its points, rounded up or down at random.
+    The samples of growing fractions are nested, so a larger sample only adds points to it.
+
+    This takes a few vectorized passes over all the points: one to find their voxels, and one
+    per sample to pick its candidates, the points whose keys are low enough to be in it. Only
+    the candidates are sorted.
+    """
+
+    def __init__(self, points, voxel_size, rng):
+        # a column at a time, which is about twice as fast as on the whole (N, 3) array
+        self.voxel_ids = np.zeros(len(points), dtype=np.int64)
+        for axis in range(3):
+            voxels = np.floor(points[:, axis] * (1 / voxel_size)).astype(np.int64)
+            voxels -= voxels.min()
+            self.voxel_ids *= voxels.max() + 1
+            self.voxel_ids += voxels
+        self.counts = np.bincount(self.voxel_ids)
+        self.keys = rng.uniform(size=len(points))
+        # the random rounding of the number of points that every voxel has in a sample
+        self.offsets = rng.uniform(size=len(self.counts))
+
+    def sample(self, fraction):
+        """Return the sorted indices of the points of the sample of a fraction of them."""
+        quotas = np.clip(np.ceil(fraction * self.counts - self.offsets), 0, self.counts)
+        # the keys of the quota of every voxel are almost always below its threshold, which
+        # is only raised when they are not
+        margin = 3
+        while True:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                thresholds = np.where(
+                    quotas > 0, (quotas + margin * np.sqrt(quotas) + margin) / self.counts, 0)
+            candidates = np.flatnonzero(self.keys < thresholds[self.voxel_ids])
+            voxel_ids = self.voxel_ids[candidates]
+            num_candidates = np.bincount(voxel_ids, minlength=len(self.counts))
+            if np.all(num_candidates >= quotas):
+                break
+            margin *= 2
+
+        order = np.lexsort((self.keys[candidates], voxel_ids))
+        ranks = np.arange(len(order)) - (np.cumsum(num_candidates) - num_candidates)[
+            voxel_ids[order]]
+        return np.sort(candidates[order[ranks < quotas[voxel_ids[order]]]])
+
+
+def crop_and_calculate_rmse_and_density(
+        reference_mesh, pointcloud, rigid_transform, depth_scale, camera_angle,
+        distance_method="pymesh", return_residuals=False, chunk_size=CHUNK_SIZE,
+        dtype=np.float64):
+    """Return the RMSE, density and number of points of the pattern area of a pointcloud.
+
+    This streams `crop_to_pattern_area` and `calculate_rmse_and_density` over the unaligned
+    pointcloud, chunk_size points at a time, so neither the aligned nor the cropped pointcloud
+    is ever held in memory, and the memory it takes is the same for any size of pointcloud.
+    The points are aligned straight into mm, by a transform that includes the depth scale.
+    With return_residuals, the indices of the points of the pattern area in pointcloud and
+    their float16 distances to the mesh (in mm) are returned as well.
+
+    With dtype=np.float32, the points are cropped and transformed in single precision, without
+    any copy of float32 input such as PLY files, which halves the memory traffic; the distances
+    themselves are computed in double precision per chunk. On synthetic captures of the
+    reference meshes (see the README), the RMSE differs from double precision by less than 1e-5
+    of its value, a few nanometers, and the density and the points kept are the same.
+    """
+    points = get_points(pointcloud)
+    crop_chunk = _make_chunk_cropper(
+        reference_mesh, rigid_transform, depth_scale, scale=1 / depth_scale, dtype=dtype)
+    sums = _DistanceSums(return_residuals)
+    chunk_indices = []
+    for start in range(0, len(points), chunk_size):
+        with timing.stage("crop"):
+            aligned_points, indices = crop_chunk(points, start, start + chunk_size)
+        sums.add(reference_mesh, aligned_points, distance_method)
+        if return_residuals:
+            chunk_indices.append(indices)
+
+    metrics = sums.get_metrics(reference_mesh, camera_angle)
+    if return_residuals:
+        indices = np.concatenate(chunk_indices) if chunk_indices else \
+            np.empty(0, dtype=np.int64)
+        return metrics[0], metrics[1], sums.num_points, indices, metrics[2]
+    return metrics[0], metrics[1], sums.num_points
+
+
+class _DistanceSums:
+    """The running sums of the squared distances of chunks of points, for the metrics."""
+
+    # points within this distance (in mm) of the mesh count towards the density
+    distance_thresh = 2
+
+    def __init__(self, keep_distances=False):
+        self.sum_squared_distances = 0.0
+        # for the variance of the squared distances, see `estimate_rmse_and_density`
+        self.sum_fourth_powers = 0.0
+        self.num_points = 0
+        self.num_valid_points = 0
+        self.distances = [] if keep_distances else None
+
+    def add(self, reference_mesh, points, distance_method):
+        """Add the distances of (N, 3) points, in mm."""
+        if len(points) == 0:
+            return
+        with timing.stage("distance_query"):
+            squared_distances = reference_mesh.get_squared_distances(
+                points, method=distance_method)
+        self.sum_squared_distances += np.sum(squared_distances)
+        self.sum_fourth_powers += np.dot(squared_distances, squared_distances)
+        self.num_points += len(squared_distances)
+        self.num_valid_points += np.count_nonzero(squared_distances < self.distance_thresh ** 2)
+        if self.distances is not None:
+            self.distances.append(np.sqrt(squared_distances).astype(np.float16))
+
+    def get_metrics(self, reference_mesh, camera_angle):
+        """Return the RMSE and the density (and the float16 distances, if they are kept)."""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rmse = np.sqrt(np.float64(self.sum_squared_distances) / self.num_points)
+
+        with timing.stage("surface_area"):
+            valid_pattern_surface_area = reference_mesh.get_pattern_surface_area(
+                camera_angle=camera_angle)
+
+        density = self.num_valid_points / valid_pattern_surface_area
+        if self.distances is not None:
+            distances = np.concatenate(self.distances) if self.distances else \
+                np.empty(0, dtype=np.float16)
+            return rmse, density, distances
+        return rmse, density
 
 
 def save_pointcloud(original_filename, new_suffix, pointcloud):
@@ -0,0 +1,50 @@
+"""All functionality related to storing the per-point residuals of an evaluation."""
+from collections import namedtuple
+import numpy as np
+
+# the distance (in mm) of every evaluated point to the reference mesh; indices are the indices
+# of the points in the pointcloud they came from, or the flat pixel indices in the depth image
+# for organized input, in which case shape is the (height, width) of the depth image
+PointResiduals = namedtuple("PointResiduals", ("indices", "distances", "shape"))
+
+
+def make_point_residuals(indices, distances, shape=None):
+    """Return the PointResiduals of the points at indices, stored compactly.
+
+    The indices are stored as uint32 and the distances as float16, which is 6 bytes per point
+    and keeps the distances to about 0.05% of their value.
+    """
+    indices = np.asarray(indices)
+    distances = np.asarray(distances)
+    if indices.shape != distances.shape:
+        raise ValueError("Got {} indices for {} distances".format(
+            indices.shape, distances.shape))
+    if shape is not None:
+        shape = tuple(int(length) for length in shape)
+    return PointResiduals(indices.astype(np.uint32), distances.astype(np.float16), shape)
+
+
+def get_error_map(residuals, fill_value=np.nan):
+    """Return the residuals of organized input as a float16 image of the distances.
+
+    Pixels without an evaluated point are set to fill_value.
+    """
+    if residuals.shape is None:
+        raise ValueError("The residuals are not of a depth image, and have no error map")
+    error_map = np.full(residuals.shape, fill_value, dtype=np.float16)
+    error_map.flat[residuals.indices] = residuals.distances
+    return error_map
+
+
+def save_residuals(filename, residuals):
+    """Save PointResiduals to an `.npz` file."""
+    shape = () if residuals.shape is None else residuals.shape
+    np.savez(filename, indices=residuals.indices, distances=residuals.distances,
+             shape=np.array(shape, dtype=np.int64))
+
+
+def load_residuals(filename):
+    """Load the PointResiduals saved by `save_residuals`."""
+    with np.load(filename) as arrays:
+        shape = tuple(int(length) for length in arrays["shape"]) or None
+        return PointResiduals(arrays["indices"], arrays["distances"], shape)
@@ -0,0 +1,252 @@
+"""Stream the evaluation over sequences of frames of a static fixture."""
+import os
+import re
+import traceback
+import zipfile
+from collections import namedtuple
+import cv2
+import numpy as np
+import depthquality.quality as quality
+from depthquality import depthimages
+from depthquality import fiducials
+from depthquality import residuals
+from depthquality import timing
+from depthquality import transformations as tfms
+
+# one frame of a sequence; rgb is an image filename or array, and depth is a pointcloud
+# filename (e.g. PLY), a depth image filename (PNG or `.npy`) or a depth image array
+Frame = namedtuple("Frame", ("name", "rgb", "depth"))
+
+# the result of evaluating a frame; error is None on success, and the traceback otherwise.
+# residuals holds the residuals.PointResiduals of the frame, when they are kept, and timings
+# the timing.TimingEvents of its stages, when the timing is enabled
+FrameResult = namedtuple(
+    "FrameResult",
+    ("name", "rmse", "density", "camera_angle", "num_points", "error", "residuals", "timings"),
+    defaults=(None, None))
+
+DEPTH_IMAGE_EXTENSIONS = (".png", ".npy")
+
+
+def iter_directory(directory):
+    """Yield the frames of a sequence directory, in natural order of their names.
+
+    A frame is an RGB image `<name>.png` and either a pointcloud `<name>.ply`, a depth image
+    `<name>.npy` or a 16-bit depth image `<name>_depth.png`, next to each other.
+    """
+    filenames = set(os.listdir(directory))
+    names = [
+        os.path.splitext(filename)[0] for filename in filenames
+        if filename.endswith(".png") and not filename.endswith("_depth.png")]
+
+    def natural_key(name):
+        return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+    for name in sorted(names, key=natural_key):
+        for depth_filename in (name + ".ply", name + ".npy", name + "_depth.png"):
+            if depth_filename in filenames:
+                yield Frame(
+                    name=name,
+                    rgb=os.path.join(directory, name + ".png"),
+                    depth=os.path.join(directory, depth_filename))
+                break
+
+
+def iter_sequence_file(filename):
+    """Yield the frames of a recorded sequence file.
+
+    The file is an uncompressed `.npz` (as written by `numpy.savez`) holding an `rgb` array of
+    shape (frames, height, width[, 3]) and a `depth` array of shape (frames, height, width).
+    Both arrays are memory-mapped, so only the frame being evaluated is read from disk.
+    """
+    rgb = _memmap_npz_member(filename, "rgb")
+    depth = _memmap_npz_member(filename, "depth")
+    if len(rgb) != len(depth):
+        raise ValueError("Sequence {} has {} RGB images but {} depth images".format(
+            filename, len(rgb), len(depth)))
+    for index in range(len(rgb)):
+        yield Frame(name=str(index), rgb=rgb[index], depth=depth[index])
+
+
+def _memmap_npz_member(filename, name):
+    with zipfile.ZipFile(filename) as archive:
+        info = archive.getinfo(name + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("Cannot memory-map the compressed array {} in {}".format(
+            name, filename))
+
+    with open(filename, 'rb') as f:
+        # skip the local file header of the zip member to get to the .npy data
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = np.frombuffer(f.read(4), dtype="<u2")
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        if np.lib.format.read_magic(f) == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    return np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset,
+                     order='F' if fortran_order else 'C')
+
+
+class SequenceEvaluator:
+    """Evaluate the frames of a sequence, sharing all the per-sequence state.
+
+    The reference mesh, the camera matrix and the depth scale are the same for every frame of
+    a sequence, so they are only loaded once. The fiducials are detected with detector, by
+    default a full resolution `fiducials.ArucoDetector` looking for the fiducials of the mesh.
+
+    With icp_iterations, the alignment of every frame is refined against the mesh surface (see
+    `quality.refine_alignment`), starting from the refined pose of the previous frame, which for
+    a static fixture is already close, so that only a couple of iterations are needed. With
+    keep_residuals, every FrameResult holds the residuals of its points (see
+    `residuals.PointResiduals`), indexed by pixel for depth images. With dtype=np.float32, the
+    points are cropped and their metrics computed in single precision, see
+    `quality.crop_and_calculate_rmse_and_density`.
+    """
+
+    def __init__(self, reference_mesh, camera_matrix, depth_scale, distance_method="pymesh",
+                 detector=None, icp_iterations=0, icp_time_budget=None, keep_residuals=False,
+                 dtype=np.float64):
+        self.reference_mesh = reference_mesh
+        if detector is None:
+            detector = fiducials.ArucoDetector(expected_ids=reference_mesh.fiducial_locations)
+        self.detector = detector
+        if isinstance(camera_matrix, str):
+            camera_matrix = quality.read_camera_matrix(camera_matrix)
+        self.camera_matrix = quality.get_camera_matrix(camera_matrix)
+        self.depth_scale = depth_scale
+        self.distance_method = distance_method
+        self.icp_iterations = icp_iterations
+        self.icp_time_budget = icp_time_budget
+        self.keep_residuals = keep_residuals
+        self.dtype = dtype
+        # the refined pose of the previous frame, to start the refinement of the next one from
+        self.pose = None
+
+    def evaluate_frame(self, frame):
+        """Return the FrameResult of a single frame, reporting any exception in its error.
+
+        With the timing enabled (see `timing.enable`), the result holds the timing of every
+        stage.
+        """
+        with timing.record() as events:
+            with timing.stage("evaluate_frame"):
+                result = self._evaluate_frame(frame)
+        return result._replace(timings=tuple(events) if events else None)
+
+    def _evaluate_frame(self, frame):
+        try:
+            with timing.stage("image_load"):
+                if isinstance(frame.rgb, str):
+                    img = cv2.imread(frame.rgb)
+                else:
+                    img = np.asarray(frame.rgb)
+            with timing.stage("aruco_detection"):
+                detected_arucos = self.detector.detect(img)
+            shape = point_indices = None
+            if isinstance(frame.depth, str) and \
+                    os.path.splitext(frame.depth)[1].lower() not in DEPTH_IMAGE_EXTENSIONS:
+                pointcloud = quality.read_pointcloud(frame.depth)
+                rigid_transform, camera_angle = quality.estimate_pointcloud_transform(
+                    self.reference_mesh, img, self.camera_matrix, pointcloud, self.depth_scale,
+                    detected_arucos=detected_arucos)
+                if self.icp_iterations:
+                    aligned_points, _ = quality.crop_to_pattern_area(
+                        self.reference_mesh, pointcloud, rigid_transform, self.depth_scale,
+                        dtype=self.dtype)
+                    refinement = self._refine_alignment(aligned_points, rigid_transform)
+                    rigid_transform = refinement @ rigid_transform
+                    camera_angle = refinement[:3, :3] @ camera_angle
+                # the pointcloud is streamed, so even the largest ones take little memory
+                metrics = quality.crop_and_calculate_rmse_and_density(
+                    self.reference_mesh, pointcloud, rigid_transform, self.depth_scale,
+                    camera_angle, distance_method=self.distance_method,
+                    return_residuals=self.keep_residuals, dtype=self.dtype)
+                rmse, density, num_points = metrics[:3]
+                indices, distances = metrics[3:] if self.keep_residuals else (None, None)
+            else:
+                with timing.stage("cloud_load"):
+                    if isinstance(frame.depth, str):
+                        depth_image = depthimages.read_depth_image(frame.depth)
+                    else:
+                        depth_image = np.asarray(frame.depth)
+                aligned_pointcloud, camera_angle, point_indices, rigid_transform = \
+                    quality.align_depth_image(
+                        self.reference_mesh, img, self.camera_matrix, depth_image,
+                        self.depth_scale, detected_arucos=detected_arucos, return_indices=True,
+                        return_transform=True)
+                shape = depth_image.shape
+                if self.icp_iterations:
+                    refinement = self._refine_alignment(aligned_pointcloud, rigid_transform)
+                    aligned_pointcloud = quality.apply_rigid_transform(
+                        aligned_pointcloud, refinement)
+                    camera_angle = refinement[:3, :3] @ camera_angle
+                cropped_pointcloud, indices = quality.clip_pointcloud_to_pattern_area(
+                    self.reference_mesh, aligned_pointcloud, depth_scale=self.depth_scale,
+                    return_indices=True)
+                rmse, density, distances = quality.calculate_rmse_and_density(
+                    ground_truth_mesh=self.reference_mesh,
+                    cropped_pointcloud=cropped_pointcloud,
+                    depth_scale=self.depth_scale,
+                    camera_angle=camera_angle,
+                    distance_method=self.distance_method,
+                    return_residuals=True,
+                    dtype=self.dtype)
+                num_points = len(indices)
+
+            frame_residuals = None
+            if self.keep_residuals:
+                if point_indices is not None:
+                    indices = point_indices[indices]
+                frame_residuals = residuals.make_point_residuals(indices, distances, shape)
+            return FrameResult(
+                frame.name, rmse, density, camera_angle, num_points, None, frame_residuals)
+        except Exception:  # pylint: disable=broad-except
+            return FrameResult(frame.name, np.nan, np.nan, None, 0, traceback.format_exc())
+
+    def _refine_alignment(self, aligned_points, rigid_transform):
+        """Return the refinement of points aligned by the fiducial pose rigid_transform.
+
+        The fiducial pose of every frame has noise of its own, which the refinement corrects,
+        so it starts from the refined pose of the previous frame, relative to this fiducial pose.
+        """
+        initial_transform = None
+        if self.pose is not None:
+            initial_transform = self.pose @ tfms.inverse_matrix(rigid_transform)
+        refinement = quality.refine_alignment(
+            self.reference_mesh, aligned_points, self.depth_scale,
+            initial_transform=initial_transform, max_iterations=self.icp_iterations,
+            time_budget=self.icp_time_budget)
+        self.pose = refinement @ rigid_transform
+        return refinement
+
+    def evaluate(self, frames):
+        """Lazily yield the FrameResult of every frame of an iterable of frames."""
+        for frame in frames:
+            yield self.evaluate_frame(frame)
+
+
+def evaluate_sequence(reference_mesh, frames, camera_matrix, depth_scale,
+                      distance_method="pymesh", detector=None, icp_iterations=0,
+                      icp_time_budget=None, keep_residuals=False, dtype=np.float64):
+    """Lazily yield the FrameResult of every frame of a sequence.
+
+    frames is an iterable of `Frame`, a sequence directory (see `iter_directory`) or a recorded
+    sequence file (see `iter_sequence_file`). camera_matrix is a dictionary, a 3x3 matrix or a
+    JSON filename; for a sequence directory, it defaults to the `camera_matrix.json` inside it.
+    The ICP options, keep_residuals and dtype are those of `SequenceEvaluator`.
+    """
+    if isinstance(frames, str):
+        if os.path.isdir(frames):
+            if camera_matrix is None:
+                camera_matrix = os.path.join(frames, "camera_matrix.json")
+            frames = iter_directory(frames)
+        else:
+            frames = iter_sequence_file(frames)
+
+    evaluator = SequenceEvaluator(
+        reference_mesh, camera_matrix, depth_scale, distance_method=distance_method,
+        detector=detector, icp_iterations=icp_iterations, icp_time_budget=icp_time_budget,
+        keep_residuals=keep_residuals, dtype=dtype)
+    return evaluator.evaluate(frames)
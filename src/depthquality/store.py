@@ -0,0 +1,128 @@
+"""A content-addressed store of evaluation results, to only evaluate the captures that changed."""
+import os
+import sqlite3
+import time
+from collections import namedtuple
+import numpy as np
+import depthquality.meshes as meshes
+import depthquality.quality as quality
+from depthquality import caching
+
+# version of the database schema, bump whenever it changes
+STORE_VERSION = 1
+
+RESULT_COLUMNS = (
+    "rmse", "density", "camera_angle_x", "camera_angle_y", "camera_angle_z", "num_points")
+
+# the stored values of a successful evaluation
+StoredResult = namedtuple("StoredResult", ("rmse", "density", "camera_angle", "num_points"))
+
+
+class ResultStore:
+    """Evaluation results in a SQLite database, keyed by the contents of their inputs.
+
+    The key of a capture is a hash of its RGB image, pointcloud, camera matrix, depth scale,
+    reference mesh file, distance method, precision and `quality.PIPELINE_VERSION` (bumped by
+    every change to the pipeline that changes its results), so a result is found again whenever
+    the same inputs are evaluated, wherever they are, and never once any of them changed. Every
+    result is committed as soon as it is added, so a batch that crashed only evaluates the
+    captures it had not finished.
+
+    The digests of the input files are remembered with their size and modification time, so
+    files that did not change are not read again. Only successful results are stored: failures
+    are often due to the environment, and are retried.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        # readers (e.g. a report over the results) do not block the batch writing to it
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version not in (0, STORE_VERSION):
+            self.connection.close()
+            raise ValueError("{} is a result store of version {}, expected {}".format(
+                path, version, STORE_VERSION))
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, rgb TEXT, "
+                "camera_matrix TEXT, pointcloud TEXT, depth_scale REAL, reference_mesh TEXT, "
+                "rmse REAL, density REAL, camera_angle_x REAL, camera_angle_y REAL, "
+                "camera_angle_z REAL, num_points INTEGER, created REAL)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS file_digests (path TEXT PRIMARY KEY, "
+                "size INTEGER, mtime_ns INTEGER, digest TEXT)")
+            self.connection.execute("PRAGMA user_version = {}".format(STORE_VERSION))
+
+    def file_digest(self, path):
+        """Return the digest of a file, only reading it if it changed since it was last read."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.connection.execute(
+            "SELECT digest FROM file_digests WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is not None:
+            return row[0]
+
+        # committed with the next result, a digest that is lost is only computed again
+        digest = caching.file_digest(path)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO file_digests VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    def capture_key(self, capture, distance_method="pymesh", dtype=np.float64):
+        """Return the key of a `batch.Capture`, or None if any of its files cannot be read."""
+        if capture.reference_mesh in meshes.BUILTIN_MESH_FILENAMES:
+            mesh_path = meshes.get_builtin_mesh_path(capture.reference_mesh)
+        else:
+            mesh_path = capture.reference_mesh
+        try:
+            digests = [self.file_digest(path) for path in (
+                capture.rgb, capture.pointcloud, capture.camera_matrix, mesh_path)]
+        except OSError:
+            return None
+        return caching.cache_key(
+            quality.PIPELINE_VERSION, *digests, float(capture.depth_scale), distance_method,
+            np.dtype(dtype).name)
+
+    def get(self, key):
+        """Return the StoredResult of a key, or None if there is none."""
+        row = self.connection.execute(
+            "SELECT {} FROM results WHERE key = ?".format(", ".join(RESULT_COLUMNS)),
+            (key,)).fetchone()
+        if row is None:
+            return None
+        # SQLite stores NaNs as NULL, e.g. the rmse of a capture without any valid point
+        values = [np.nan if value is None else value for value in row[:5]]
+        return StoredResult(values[0], values[1], np.array(values[2:5]), row[5])
+
+    def add(self, key, result):
+        """Store a successful `batch.CaptureResult` under key, ignoring failed ones."""
+        if result.error is not None:
+            return
+        capture = result.capture
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, capture.rgb, capture.camera_matrix, capture.pointcloud,
+                 float(capture.depth_scale), capture.reference_mesh, float(result.rmse),
+                 float(result.density), *(float(value) for value in result.camera_angle),
+                 int(result.num_points), time.time()))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
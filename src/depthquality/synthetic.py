@@ -0,0 +1,254 @@
+"""Generate synthetic captures of the reference meshes, to test the pipeline without a camera."""
+import json
+import os
+from collections import namedtuple
+import cv2
+import numpy as np
+from depthquality import depthimages
+from depthquality import plyfiles
+from depthquality.fiducials import TOP_LEFT, TOP_RIGHT, BOTTOM_RIGHT, BOTTOM_LEFT
+from depthquality.sequences import Frame
+
+# a synthetic capture; depth is a uint16 depth image in mm and points the (N, 3) pointcloud
+# deprojected from it, in the units of the pointcloud (mm times depth_scale)
+SyntheticCapture = namedtuple(
+    "SyntheticCapture", ("rgb", "depth", "points", "camera_matrix", "camera_from_reference"))
+
+# the gray levels of the rendered image, where nothing is hit and for a surface facing the camera
+BACKGROUND_INTENSITY = 40
+SURFACE_INTENSITY = 230
+
+
+def make_camera_matrix(width, height, horizontal_fov=np.radians(69)):
+    """Return the intrinsics of an ideal camera of that resolution and horizontal field of view."""
+    focal_length = width / 2 / np.tan(horizontal_fov / 2)
+    return {
+        "fx": focal_length,
+        "fy": focal_length,
+        "ppx": (width - 1) / 2,
+        "ppy": (height - 1) / 2,
+    }
+
+
+def look_at(eye, target=(0, 0, 0), up=(0, 1, 0)):
+    """Return the 4x4 transform from the reference frame to a camera at eye looking at target.
+
+    The camera frame is that of the depth cameras: x to the right of the image, y down and z
+    along the optical axis. up is the direction of the reference frame that is up in the image.
+    """
+    eye = np.asarray(eye, dtype=np.float64)
+    forward = np.asarray(target, dtype=np.float64) - eye
+    forward /= np.linalg.norm(forward)
+    right = np.cross(forward, up)
+    right /= np.linalg.norm(right)
+    down = np.cross(forward, right)
+
+    camera_from_reference = np.identity(4)
+    camera_from_reference[:3, :3] = [right, down, forward]
+    camera_from_reference[:3, 3] = -camera_from_reference[:3, :3] @ eye
+    return camera_from_reference
+
+
+class CaptureRenderer:
+    """Ray-cast a reference mesh from any camera pose, with the fiducials drawn on its image.
+
+    The rays through the pixel centers are intersected with all the faces at once: every face
+    is projected into the image, and the pixels inside its projection get the exact depth of
+    the ray-plane intersection, keeping the nearest face of every pixel. The renders of the
+    last few poses are cached, so many noisy captures of the same pose are cheap.
+
+    Poses are 4x4 transforms from the reference frame (in mm) to the camera frame, see
+    `look_at`. Faces that reach closer than near (in mm) to the camera are skipped.
+    """
+
+    def __init__(self, reference_mesh, camera_matrix, width, height, near=1.0,
+                 chunk_size=2 ** 20, cache_size=8):
+        self.reference_mesh = reference_mesh
+        self.camera_matrix = camera_matrix
+        self.width = width
+        self.height = height
+        self.near = near
+        # the number of pixel candidates handled at once, which bounds the memory use
+        self.chunk_size = chunk_size
+        self.cache_size = cache_size
+        self._renders = {}
+
+        self.dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_1000)
+        self._markers = {}
+
+    def render(self, camera_from_reference):
+        """Return the float depth image (in mm, 0 where nothing is hit) and the BGR image."""
+        key = np.asarray(camera_from_reference, dtype=np.float64).tobytes()
+        if key not in self._renders:
+            if len(self._renders) >= self.cache_size:
+                del self._renders[next(iter(self._renders))]
+            depth, faces = self._ray_cast(camera_from_reference)
+            rgb = self._shade(camera_from_reference, depth, faces)
+            self._renders[key] = depth, rgb
+        return self._renders[key]
+
+    def capture(self, camera_from_reference, depth_scale=0.001, noise=0.0, dropout=0.0,
+                rng=None):
+        """Return a SyntheticCapture of the mesh from camera_from_reference.
+
+        Gaussian noise of standard deviation noise (in mm) is added to the depths, which are then
+        rounded to whole mm like a 16-bit depth camera, and a fraction dropout of the pixels
+        lose their depth. rng is a numpy RandomState, for reproducible noise.
+        """
+        rng = np.random if rng is None else rng
+        depth, rgb = self.render(camera_from_reference)
+        is_valid = depth > 0
+        if noise:
+            depth = depth + rng.normal(scale=noise, size=depth.shape)
+        if dropout:
+            is_valid &= rng.uniform(size=depth.shape) >= dropout
+        depth_image = np.where(is_valid, np.rint(depth), 0).astype(np.uint16)
+        points = depthimages.deproject_window(depth_image, self.camera_matrix, depth_scale)
+        return SyntheticCapture(
+            rgb, depth_image, points, self.camera_matrix, np.asarray(camera_from_reference))
+
+    def _ray_cast(self, camera_from_reference):
+        mesh = self.reference_mesh.reference_mesh
+        vertices = mesh.vertices @ camera_from_reference[:3, :3].T + camera_from_reference[:3, 3]
+        triangles = vertices[mesh.faces]
+        face_ids = np.flatnonzero(np.all(triangles[:, :, 2] > self.near, axis=1))
+        triangles = triangles[face_ids]
+
+        # the projection of every face, and the bounding box of the pixels it covers
+        cols = self.camera_matrix["fx"] * triangles[:, :, 0] / triangles[:, :, 2] + \
+            self.camera_matrix["ppx"]
+        rows = self.camera_matrix["fy"] * triangles[:, :, 1] / triangles[:, :, 2] + \
+            self.camera_matrix["ppy"]
+        col_starts = np.maximum(np.ceil(cols.min(axis=1)), 0).astype(np.int64)
+        col_stops = np.minimum(np.floor(cols.max(axis=1)), self.width - 1).astype(np.int64) + 1
+        row_starts = np.maximum(np.ceil(rows.min(axis=1)), 0).astype(np.int64)
+        row_stops = np.minimum(np.floor(rows.max(axis=1)), self.height - 1).astype(np.int64) + 1
+        box_widths = np.maximum(col_stops - col_starts, 0)
+        counts = box_widths * np.maximum(row_stops - row_starts, 0)
+
+        # the plane of every face, as normal . point = offset in the camera frame
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        offsets = np.einsum("ij,ij->i", normals, triangles[:, 0])
+        # the sign of the projected area, so that the edge functions are positive inside
+        signs = np.sign(
+            (cols[:, 1] - cols[:, 0]) * (rows[:, 2] - rows[:, 0]) -
+            (cols[:, 2] - cols[:, 0]) * (rows[:, 1] - rows[:, 0]))
+
+        # z-buffer of the depth in um in the high bits, and of the face in the low ones, so
+        # that the nearest face of every pixel is a single minimum
+        face_bits = max(int(len(mesh.faces)).bit_length(), 1)
+        zbuffer = np.full(self.width * self.height, np.iinfo(np.int64).max, dtype=np.int64)
+
+        ends = np.cumsum(counts)
+        start = 0
+        while start < len(counts):
+            stop = max(np.searchsorted(
+                ends, ends[start] - counts[start] + self.chunk_size, side="right"), start + 1)
+            chunk = np.arange(start, stop)
+            chunk_counts = counts[chunk]
+            faces = np.repeat(chunk, chunk_counts)
+            local = np.arange(len(faces)) - np.repeat(
+                np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+            pixel_rows = row_starts[faces] + local // box_widths[faces]
+            pixel_cols = col_starts[faces] + local % box_widths[faces]
+            start = stop
+
+            # the pixel centers inside the projected face, on either side of its edges
+            is_inside = signs[faces] != 0
+            for first, second in ((0, 1), (1, 2), (2, 0)):
+                edge = (cols[faces, second] - cols[faces, first]) * \
+                    (pixel_rows - rows[faces, first]) - \
+                    (rows[faces, second] - rows[faces, first]) * \
+                    (pixel_cols - cols[faces, first])
+                is_inside &= edge * signs[faces] >= 0
+            faces = faces[is_inside]
+            pixel_rows = pixel_rows[is_inside]
+            pixel_cols = pixel_cols[is_inside]
+
+            # intersect the ray through the pixel center with the plane of the face
+            ray_x = (pixel_cols - self.camera_matrix["ppx"]) / self.camera_matrix["fx"]
+            ray_y = (pixel_rows - self.camera_matrix["ppy"]) / self.camera_matrix["fy"]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                depths = offsets[faces] / (
+                    normals[faces, 0] * ray_x + normals[faces, 1] * ray_y + normals[faces, 2])
+            is_valid = np.isfinite(depths) & (depths > self.near)
+            keys = (np.rint(depths[is_valid] * 1000).astype(np.int64) << face_bits) | \
+                face_ids[faces[is_valid]]
+            np.minimum.at(
+                zbuffer, pixel_rows[is_valid] * self.width + pixel_cols[is_valid], keys)
+
+        is_hit = zbuffer != np.iinfo(np.int64).max
+        depth = np.where(is_hit, (zbuffer >> face_bits) / 1000, 0)
+        faces = np.where(is_hit, zbuffer & ((1 << face_bits) - 1), -1)
+        return depth.reshape(self.height, self.width), faces.reshape(self.height, self.width)
+
+    def _shade(self, camera_from_reference, depth, faces):
+        # lambertian shading, lit from the camera
+        mesh = self.reference_mesh.reference_mesh
+        corners = mesh.vertices[mesh.faces]
+        normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        normals = normals @ camera_from_reference[:3, :3].T
+        normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+
+        rows, cols = np.nonzero(faces >= 0)
+        rays = np.stack([
+            (cols - self.camera_matrix["ppx"]) / self.camera_matrix["fx"],
+            (rows - self.camera_matrix["ppy"]) / self.camera_matrix["fy"],
+            np.ones(len(rows))], axis=1)
+        rays /= np.linalg.norm(rays, axis=1, keepdims=True)
+        gray = np.full(depth.shape, BACKGROUND_INTENSITY, dtype=np.uint8)
+        gray[rows, cols] = SURFACE_INTENSITY * np.abs(
+            np.einsum("ij,ij->i", normals[faces[rows, cols]], rays))
+
+        for aruco_id, corners in self.reference_mesh.fiducial_locations.items():
+            self._draw_marker(gray, camera_from_reference, aruco_id, corners)
+        return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+    def _draw_marker(self, gray, camera_from_reference, aruco_id, corners):
+        corners = np.array([corners[location] for location in (
+            TOP_LEFT, TOP_RIGHT, BOTTOM_RIGHT, BOTTOM_LEFT)], dtype=np.float64)
+        corners = corners @ camera_from_reference[:3, :3].T + camera_from_reference[:3, 3]
+        normal = np.cross(corners[3] - corners[0], corners[1] - corners[0])
+        if np.any(corners[:, 2] <= self.near) or np.dot(normal, corners[0]) >= 0:
+            # behind the camera, or seen from the back
+            return
+
+        if aruco_id not in self._markers:
+            self._markers[aruco_id] = cv2.aruco.drawMarker(self.dictionary, aruco_id, 120)
+        marker = self._markers[aruco_id]
+        size = marker.shape[0]
+        marker_corners = np.array(
+            [[-0.5, -0.5], [size - 0.5, -0.5], [size - 0.5, size - 0.5], [-0.5, size - 0.5]],
+            dtype=np.float32)
+        image_corners = np.stack([
+            self.camera_matrix["fx"] * corners[:, 0] / corners[:, 2] + self.camera_matrix["ppx"],
+            self.camera_matrix["fy"] * corners[:, 1] / corners[:, 2] + self.camera_matrix["ppy"]],
+            axis=1).astype(np.float32)
+        cv2.warpPerspective(
+            marker, cv2.getPerspectiveTransform(marker_corners, image_corners),
+            (gray.shape[1], gray.shape[0]), dst=gray, flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_TRANSPARENT)
+
+
+def iter_frames(renderer, poses, depth_scale=0.001, noise=0.0, dropout=0.0, seed=0):
+    """Yield a sequence `Frame` for every camera pose in poses, e.g. for stress tests."""
+    rng = np.random.RandomState(seed)
+    for index, camera_from_reference in enumerate(poses):
+        capture = renderer.capture(
+            camera_from_reference, depth_scale=depth_scale, noise=noise, dropout=dropout, rng=rng)
+        yield Frame(name=str(index), rgb=capture.rgb, depth=capture.depth)
+
+
+def write_capture(directory, name, capture, write_pointcloud=True):
+    """Write a capture as `<name>.png`, `<name>_depth.png` and `<name>.ply`, in a directory.
+
+    The camera matrix is written to `camera_matrix.json` next to them, which makes the
+    directory a sequence that `sequences.iter_directory` can read.
+    """
+    os.makedirs(directory, exist_ok=True)
+    cv2.imwrite(os.path.join(directory, name + ".png"), capture.rgb)
+    cv2.imwrite(os.path.join(directory, name + "_depth.png"), capture.depth)
+    if write_pointcloud:
+        plyfiles.write_ply_points(os.path.join(directory, name + ".ply"), capture.points)
+    with open(os.path.join(directory, "camera_matrix.json"), 'w') as f:
+        json.dump({key: float(value) for key, value in capture.camera_matrix.items()}, f)
@@ -0,0 +1,149 @@
+"""Low-overhead timing of the stages of the pipeline, and their export as Chrome traces."""
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+# one timed stage; start is in seconds since the epoch, so that the events of different
+# processes line up, and cpu_time is the CPU time of the whole process during the stage
+TimingEvent = namedtuple("TimingEvent", ("name", "start", "wall_time", "cpu_time", "pid", "tid"))
+
+_enabled = False
+_local = threading.local()
+
+
+def enable():
+    """Start timing the stages of the pipeline."""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stop timing the stages of the pipeline; every stage is then a no-op."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+@contextlib.contextmanager
+def enabled(timing_enabled=True):
+    """Turn the timing on (or off) inside the block, and restore it after."""
+    previous = _enabled
+    if timing_enabled:
+        enable()
+    else:
+        disable()
+    try:
+        yield
+    finally:
+        if previous:
+            enable()
+        else:
+            disable()
+
+
+def _recorders():
+    if not hasattr(_local, "recorders"):
+        _local.recorders = []
+    return _local.recorders
+
+
+@contextlib.contextmanager
+def record():
+    """Collect the TimingEvents of the stages that run in this thread inside the block.
+
+    Yields the list the events are appended to; it stays empty when the timing is disabled.
+    Recorders can be nested, and every one of them gets all the events of its block.
+    """
+    events = []
+    recorders = _recorders()
+    recorders.append(events)
+    try:
+        yield events
+    finally:
+        # recorders are nested, so this one is always the innermost
+        recorders.pop()
+
+
+class _Stage:
+    __slots__ = ("name", "start", "wall_start", "cpu_start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall_time = time.perf_counter() - self.wall_start
+        cpu_time = time.process_time() - self.cpu_start
+        recorders = _recorders()
+        if recorders:
+            event = TimingEvent(
+                self.name, self.start, wall_time, cpu_time, os.getpid(), threading.get_ident())
+            for events in recorders:
+                events.append(event)
+        return False
+
+
+_null_stage = contextlib.nullcontext()
+
+
+def stage(name):
+    """Time the block as a stage of the pipeline, when the timing is enabled.
+
+    Disabled, this returns a shared no-op context manager, so instrumented code pays for
+    little more than a function call.
+    """
+    if not _enabled:
+        return _null_stage
+    return _Stage(name)
+
+
+def timed(name):
+    """Decorate a function to time all of its calls as the stage name."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summarize(events):
+    """Return the total wall-clock and CPU time of every stage, as {name: (wall, cpu)}."""
+    totals = defaultdict(lambda: [0.0, 0.0])
+    for event in events:
+        totals[event.name][0] += event.wall_time
+        totals[event.name][1] += event.cpu_time
+    return {name: tuple(total) for name, total in totals.items()}
+
+
+def write_chrome_trace(filename, events):
+    """Write events as a Chrome trace-event JSON file, to open in chrome://tracing or Perfetto.
+
+    Every stage is a complete event on the track of its process and thread, so the stages of
+    all the worker processes of a batch show up side by side.
+    """
+    trace_events = [{
+        "name": event.name,
+        "cat": "depthquality",
+        "ph": "X",
+        "ts": event.start * 1e6,
+        "dur": event.wall_time * 1e6,
+        "pid": event.pid,
+        "tid": event.tid,
+        "args": {"cpu_ms": event.cpu_time * 1e3},
+    } for event in events]
+    with open(filename, 'w') as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
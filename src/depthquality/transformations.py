@@ -1060,6 +1060,107 @@ def superimposition_matrix(v0, v1, scale=False, usesvd=True):
                                      scale=scale, usesvd=usesvd)
 
 
+def rigid_matrices_from_points(v0, v1, weights=None, scale=False):
+    """Return rigid transform matrices to register many pairs of 3D point sets.
+
+    v0 and v1 are shape (B, 3, K) arrays of B pairs of K corresponding
+    points. The result is a shape (B, 4, 4) array, whose i-th matrix is
+    the same as affine_matrix_from_points(v0[i], v1[i], shear=False,
+    scale=scale), computed for all pairs at once with batched SVD.
+
+    weights is an optional shape (B, K) or (K, ) array of non-negative
+    weights of the points in the sum of squared deviations. Points with
+    zero weight, e.g. from a boolean mask of missing points, are ignored
+    and may be NaN. Every pair needs at least 3 non-collinear points with
+    non-zero weight.
+
+    >>> R = random_rotation_matrix(numpy.random.random(3))
+    >>> T = translation_matrix(numpy.random.random(3)-0.5)
+    >>> M = concatenate_matrices(T, R)
+    >>> v0 = (numpy.random.rand(2, 4, 10) - 0.5) * 20
+    >>> v0[:, 3] = 1
+    >>> v1 = numpy.dot(M, v0).transpose(1, 0, 2)
+    >>> Ms = rigid_matrices_from_points(v0[:, :3], v1[:, :3])
+    >>> numpy.allclose(Ms, M)
+    True
+    >>> mask = numpy.ones((2, 10), dtype=bool)
+    >>> mask[:, :5] = False
+    >>> v1[:, :3, :5] = numpy.nan
+    >>> Ms = rigid_matrices_from_points(v0[:, :3], v1[:, :3], weights=mask)
+    >>> numpy.allclose(Ms, M)
+    True
+
+    """
+    v0 = numpy.array(v0, dtype=numpy.float64, copy=True)
+    v1 = numpy.array(v1, dtype=numpy.float64, copy=True)
+    if v0.ndim != 3 or v0.shape[1] != 3 or v0.shape != v1.shape:
+        raise ValueError('input arrays are of wrong shape or type')
+    nsets, ndims, npoints = v0.shape
+
+    if weights is None:
+        weights = numpy.ones((nsets, npoints))
+    else:
+        weights = numpy.broadcast_to(
+            numpy.asarray(weights, dtype=numpy.float64), (nsets, npoints))
+    # ignored points must not propagate NaN into the sums
+    ignored = numpy.broadcast_to((weights == 0)[:, None, :], v0.shape)
+    v0[ignored] = 0.0
+    v1[ignored] = 0.0
+    wsum = numpy.sum(weights, axis=1)[:, None]
+
+    # move centroids to origin
+    t0 = numpy.sum(v0 * weights[:, None, :], axis=2) / wsum
+    t1 = numpy.sum(v1 * weights[:, None, :], axis=2) / wsum
+    v0 -= t0[:, :, None]
+    v1 -= t1[:, :, None]
+
+    # rigid transformations via SVD of the weighted covariance matrices
+    u, s, vh = numpy.linalg.svd(
+        numpy.einsum('bik,bjk->bij', v1 * weights[:, None, :], v0))
+    R = numpy.matmul(u, vh)
+    # R does not constitute right handed system
+    flip = numpy.linalg.det(R) < 0.0
+    R[flip] -= 2.0 * (u[flip, :, ndims-1, None] * vh[flip, None, ndims-1, :])
+
+    if scale:
+        # scale is ratio of RMS deviations from centroid
+        R *= numpy.sqrt(
+            numpy.sum(weights * numpy.sum(v1 * v1, axis=1), axis=1) /
+            numpy.sum(weights * numpy.sum(v0 * v0, axis=1), axis=1))[:, None, None]
+
+    # move centroids back
+    M = numpy.zeros((nsets, ndims+1, ndims+1))
+    M[:, :ndims, :ndims] = R
+    M[:, :ndims, ndims] = t1 - numpy.einsum('bij,bj->bi', R, t0)
+    M[:, ndims, ndims] = 1.0
+    return M
+
+
+def transformation_residuals(matrices, v0, v1):
+    """Return distances between transformed points and their targets.
+
+    matrices is a shape (B, 4, 4) array of transformation matrices, and
+    v0 and v1 are shape (B, 3, K) arrays of corresponding points, e.g. as
+    passed to rigid_matrices_from_points. The result is the shape (B, K)
+    array of Euclidean distances between matrices[i] applied to v0[i] and
+    v1[i]. A single matrix or point set is broadcast over the others.
+
+    >>> v0 = numpy.random.rand(5, 3, 8)
+    >>> M = translation_matrix([0, 0, 1])
+    >>> d = transformation_residuals(M, v0, v0 + [[0], [0], [2]])
+    >>> d.shape
+    (5, 8)
+    >>> numpy.allclose(d, 1)
+    True
+
+    """
+    matrices = numpy.asarray(matrices, dtype=numpy.float64)
+    v0 = numpy.asarray(v0, dtype=numpy.float64)
+    v1 = numpy.asarray(v1, dtype=numpy.float64)
+    v = numpy.matmul(matrices[..., :3, :3], v0) + matrices[..., :3, 3:] - v1
+    return numpy.sqrt(numpy.sum(v * v, axis=-2))
+
+
 def euler_matrix(ai, aj, ak, axes='sxyz'):
     """Return homogeneous rotation matrix from Euler angles and axis sequence.
 
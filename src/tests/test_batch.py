@@ -0,0 +1,80 @@
+"""Tests for evaluating batches of captures."""
+import json
+import os
+import numpy as np
+import pytest
+import depthquality.batch as batch
+
+RECORDS = [
+    {"rgb": "a/1.png", "camera_matrix": "a/camera_matrix.json", "pointcloud": "a/1.ply",
+     "depth_scale": 0.001, "reference_mesh": "VERTICAL_CYLINDERS"},
+    {"rgb": "b/1.png", "camera_matrix": "b/camera_matrix.json", "pointcloud": "b/depth.npy",
+     "depth_scale": 0.0001, "reference_mesh": "meshes/custom.obj"},
+]
+
+
+@pytest.mark.parametrize("extension", [".jsonl", ".csv"])
+def test_read_manifest(tmpdir, extension):
+    """Manifests resolve paths relative to themselves, but keep built-in mesh names."""
+    filename = str(tmpdir.join("manifest" + extension))
+    with open(filename, 'w') as f:
+        if extension == ".csv":
+            f.write(",".join(batch.Capture._fields) + "\n")
+            for record in RECORDS:
+                f.write(",".join(str(record[field]) for field in batch.Capture._fields) + "\n")
+        else:
+            for record in RECORDS:
+                f.write(json.dumps(record) + "\n")
+
+    captures = batch.read_manifest(filename)
+    assert captures[0] == batch.Capture(
+        rgb=str(tmpdir.join("a", "1.png")),
+        camera_matrix=str(tmpdir.join("a", "camera_matrix.json")),
+        pointcloud=str(tmpdir.join("a", "1.ply")),
+        depth_scale=0.001,
+        reference_mesh="VERTICAL_CYLINDERS")
+    assert captures[1].reference_mesh == str(tmpdir.join("meshes", "custom.obj"))
+    assert captures[1].depth_scale == 0.0001
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_failures_are_reported_per_capture(tmpdir, processes):
+    """A capture that fails is reported in its result, without stopping the batch."""
+    captures = [
+        batch.Capture(
+            rgb=str(tmpdir.join("missing{}.png".format(i))),
+            camera_matrix=str(tmpdir.join("missing.json")),
+            pointcloud=str(tmpdir.join("missing{}.ply".format(i))),
+            depth_scale=0.001,
+            reference_mesh=str(tmpdir.join("missing.obj")))
+        for i in range(3)]
+
+    results = batch.evaluate_captures(captures, processes=processes)
+
+    assert [result.capture for result in results] == captures
+    for result in results:
+        assert np.isnan(result.rmse)
+        assert "Error" in result.error
+
+
+def test_trace_of_worker_processes(tmpdir):
+    """The stages of every worker process end up in a single trace."""
+    captures = [
+        batch.Capture(
+            rgb=str(tmpdir.join("missing{}.png".format(i))),
+            camera_matrix=str(tmpdir.join("missing.json")),
+            pointcloud=str(tmpdir.join("missing{}.ply".format(i))),
+            depth_scale=0.001,
+            reference_mesh="VERTICAL_CYLINDERS")
+        for i in range(4)]
+    trace_filename = str(tmpdir.join("trace.json"))
+
+    results = batch.evaluate_captures(captures, processes=2, trace_filename=trace_filename)
+
+    for result in results:
+        assert [event.name for event in result.timings] == ["image_load", "evaluate_capture"]
+    with open(trace_filename) as f:
+        trace_events = json.load(f)["traceEvents"]
+    assert len(trace_events) == 2 * len(captures)
+    assert {event["pid"] for event in trace_events} == {
+        result.timings[0].pid for result in results}
@@ -0,0 +1,83 @@
+"""Tests for the depth-quality command."""
+import json
+import os
+import numpy as np
+import pytest
+import depthquality.cli as cli
+import depthquality.meshes as meshes
+import depthquality.synthetic as synthetic
+
+MESH_FILENAME = os.path.join(os.path.dirname(__file__), "..", "meshes", "vertical_cylinders.obj")
+
+
+@pytest.mark.parametrize("extension", [".jsonl", ".csv"])
+def test_interrupted_run_is_resumed(tmpdir, capsys, extension):
+    """Successful captures in the output are skipped; failed and half written ones are redone."""
+    manifest = str(tmpdir.join("manifest.jsonl"))
+    with open(manifest, 'w') as f:
+        for index in range(3):
+            f.write(json.dumps({
+                "rgb": "{}.png".format(index), "camera_matrix": "camera_matrix.json",
+                "pointcloud": "{}.ply".format(index), "depth_scale": 0.001,
+                "reference_mesh": "VERTICAL_CYLINDERS"}) + "\n")
+    output = str(tmpdir.join("results" + extension))
+    output_format = cli.get_output_format(output)
+    argv = [manifest, "-o", output, "--workers", "1"]
+
+    # none of the files exist, so every capture fails
+    assert cli.main(argv) == 1
+    records, is_complete = cli.read_records(output, output_format)
+    assert is_complete
+    assert sorted(record["rgb"] for record in records) == [
+        str(tmpdir.join("{}.png".format(index))) for index in range(3)]
+    assert all("Error" in record["error"] for record in records)
+
+    # pretend the first two succeeded, and cut the last record short, as if the run was killed
+    # while writing it
+    for record in records[:2]:
+        record.update(rmse=0.5, density=2.0, num_points=10, error=None)
+    with cli.RecordWriter(output, output_format, records):
+        pass
+    succeeded = cli.read_records(output, output_format)[0][:2]
+    with open(output, 'r', newline='') as f:
+        text = f.read()
+    with open(output, 'w', newline='') as f:
+        f.write(text[:-20])
+    assert not cli.read_records(output, output_format)[1]
+
+    capsys.readouterr()
+    cli.main(argv)
+    assert "3 captures, 2 already evaluated" in capsys.readouterr().out
+    rerun_records, is_complete = cli.read_records(output, output_format)
+    assert is_complete
+    assert rerun_records[:2] == succeeded
+    assert rerun_records[2]["rgb"] == records[2]["rgb"]
+    assert "Error" in rerun_records[2]["error"]
+
+    # the failed capture is retried, and its new record replaces the old one
+    cli.main(argv)
+    assert "3 captures, 2 already evaluated" in capsys.readouterr().out
+    assert cli.read_records(output, output_format)[0] == rerun_records
+
+
+def test_directory_is_evaluated(tmpdir):
+    """Every capture directory in a tree is evaluated against a custom mesh."""
+    reference_mesh = meshes.ReferenceMesh(path=MESH_FILENAME, use_cache=False)
+    camera_matrix = synthetic.make_camera_matrix(320, 240)
+    renderer = synthetic.CaptureRenderer(reference_mesh, camera_matrix, 320, 240)
+    for name in ("a", "b"):
+        capture = renderer.capture(
+            synthetic.look_at([0, 0, 300]), depth_scale=0.001, noise=0.5,
+            rng=np.random.RandomState(0))
+        synthetic.write_capture(str(tmpdir.join("captures", name)), "0", capture)
+    output = str(tmpdir.join("results.jsonl"))
+
+    assert cli.main([
+        str(tmpdir.join("captures")), "--mesh", MESH_FILENAME, "--depth-scale", "0.001",
+        "-o", output, "--workers", "1", "--distance-method", "bvh"]) == 0
+
+    records = cli.read_records(output, "jsonl")[0]
+    assert [os.path.basename(os.path.dirname(record["rgb"])) for record in records] == ["a", "b"]
+    for record in records:
+        assert record["error"] is None
+        assert 0.3 < record["rmse"] < 1.0
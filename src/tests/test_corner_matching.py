@@ -0,0 +1,65 @@
+"""Tests for matching pointcloud points to detected ArUco corners."""
+import numpy as np
+import open3d
+import pytest
+import depthquality.quality as quality
+
+CAMERA_MATRIX = {"fx": 932.141, "fy": 932.805, "ppx": 626.04, "ppy": 360.39}
+
+
+def loop_compute_corner_coordinates(points, camera_matrix, corner_list):
+    """Reference implementation, matching one point at a time with `fuzzy_match_corner`."""
+    corner_coordinates = {entry: [] for entry in corner_list}
+    for point in points:
+        u = np.floor(camera_matrix["fx"] * point[0] / point[2] + camera_matrix["ppx"])
+        v = np.floor(camera_matrix["fy"] * point[1] / point[2] + camera_matrix["ppy"])
+        matched_corner = quality.fuzzy_match_corner(u, v, corner_list)
+        if matched_corner:
+            corner_coordinates[matched_corner].append(point)
+    return {key: np.mean(val, axis=0) for key, val in corner_coordinates.items() if val}
+
+
+@pytest.fixture(scope="module")
+def points():
+    """Random points in front of the camera, including some with invalid (zero) depth."""
+    rng = np.random.RandomState(0)
+    points = rng.uniform([-0.3, -0.2, 0.2], [0.3, 0.2, 0.5], size=(50000, 3))
+    points[:100, 2] = 0
+    return points
+
+
+def test_matches_loop(points):
+    """The vectorized matching gives the same per-corner means as the point-by-point loop."""
+    rng = np.random.RandomState(1)
+    corner_list = [(int(row), int(col)) for row, col in zip(
+        rng.randint(50, 650, size=16), rng.randint(50, 1200, size=16))]
+    # overlapping windows and duplicate corners are resolved in favour of the first corner
+    corner_list += [(corner_list[0][0] + 2, corner_list[0][1] - 1), corner_list[1]]
+
+    pointcloud = open3d.geometry.PointCloud(open3d.utility.Vector3dVector(points))
+    expected = loop_compute_corner_coordinates(points, CAMERA_MATRIX, corner_list)
+    actual = quality.compute_corner_coordinates(pointcloud, CAMERA_MATRIX, corner_list)
+
+    assert expected.keys() == actual.keys()
+    for key, value in expected.items():
+        np.testing.assert_allclose(actual[key], value, rtol=1e-12)
+
+
+def test_unmatched_corners_are_dropped(points):
+    """Corners outside the image, or an empty corner list, produce no coordinates."""
+    pointcloud = open3d.geometry.PointCloud(open3d.utility.Vector3dVector(points))
+    assert quality.compute_corner_coordinates(pointcloud, CAMERA_MATRIX, []) == {}
+    assert quality.compute_corner_coordinates(
+        pointcloud, CAMERA_MATRIX, [(-1000, -1000)]) == {}
+
+
+def test_accepts_arrays(points):
+    """Arrays of points give the same corners as open3d pointclouds."""
+    corner_list = [(360, 626), (100, 200), (600, 1100)]
+    pointcloud = open3d.geometry.PointCloud(open3d.utility.Vector3dVector(points))
+
+    from_array = quality.compute_corner_coordinates(points, CAMERA_MATRIX, corner_list)
+    from_pointcloud = quality.compute_corner_coordinates(pointcloud, CAMERA_MATRIX, corner_list)
+    assert from_array.keys() == from_pointcloud.keys()
+    for corner in from_array:
+        np.testing.assert_array_equal(from_array[corner], from_pointcloud[corner])
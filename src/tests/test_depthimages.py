@@ -0,0 +1,89 @@
+"""Tests for the organized depth image input path."""
+import cv2
+import numpy as np
+import pytest
+import depthquality.depthimages as depthimages
+
+CAMERA_MATRIX = {"fx": 932.141, "fy": 932.805, "ppx": 626.04, "ppy": 360.39}
+DEPTH_SCALE = 0.001
+
+
+@pytest.fixture(scope="module")
+def depth_image():
+    """A tilted plane about 40 cm from the camera, with a hole of invalid depth."""
+    rows, cols = np.mgrid[0:720, 0:1280]
+    depth_image = (400 + 0.05 * cols + 0.02 * rows).astype(np.uint16)
+    depth_image[100:120, 200:220] = 0
+    return depth_image
+
+
+@pytest.mark.parametrize("extension", [".npy", ".png"])
+def test_read_depth_image(tmpdir, depth_image, extension):
+    """Depth images round-trip through both supported formats without losing precision."""
+    filename = str(tmpdir.join("depth" + extension))
+    if extension == ".npy":
+        np.save(filename, depth_image)
+    else:
+        cv2.imwrite(filename, depth_image)
+
+    loaded = depthimages.read_depth_image(filename)
+    assert loaded.dtype == np.uint16
+    np.testing.assert_array_equal(loaded, depth_image)
+
+
+def test_deproject_window_projects_back(depth_image):
+    """Deprojected pixels project back onto the pixel they came from, skipping invalid depth."""
+    points = depthimages.deproject_window(
+        depth_image, CAMERA_MATRIX, DEPTH_SCALE, 90, 130, 190, 230)
+    assert len(points) == 40 * 40 - 20 * 20
+
+    u = CAMERA_MATRIX["fx"] * points[:, 0] / points[:, 2] + CAMERA_MATRIX["ppx"]
+    v = CAMERA_MATRIX["fy"] * points[:, 1] / points[:, 2] + CAMERA_MATRIX["ppy"]
+    assert np.all((np.round(u) >= 190) & (np.round(u) < 230))
+    assert np.all((np.round(v) >= 90) & (np.round(v) < 130))
+    assert depthimages.deproject_window(
+        depth_image, CAMERA_MATRIX, DEPTH_SCALE, 800, 900, 0, 10).shape == (0, 3)
+
+
+def test_deproject_window_indices(depth_image):
+    """The pixel indices of the points give back their depth, and their place in the image."""
+    points, indices = depthimages.deproject_window(
+        depth_image, CAMERA_MATRIX, DEPTH_SCALE, 90, 130, 190, 230, return_indices=True)
+    np.testing.assert_array_equal(points[:, 2], depth_image.flat[indices] * DEPTH_SCALE)
+    rows, cols = np.unravel_index(indices, depth_image.shape)
+    u = CAMERA_MATRIX["fx"] * points[:, 0] / points[:, 2] + CAMERA_MATRIX["ppx"]
+    np.testing.assert_allclose(u, cols)
+    assert np.all((rows >= 90) & (rows < 130))
+
+
+def test_compute_corner_coordinates(depth_image):
+    """Corner coordinates are the mean of the deprojected window, and empty windows are dropped."""
+    corner_list = [(360, 626), (110, 210), (-50, -50)]
+    corner_coordinates = depthimages.compute_corner_coordinates(
+        depth_image, CAMERA_MATRIX, corner_list, DEPTH_SCALE)
+
+    assert set(corner_coordinates) == {(360, 626)}
+    expected = depthimages.deproject_window(
+        depth_image, CAMERA_MATRIX, DEPTH_SCALE, 357, 364, 623, 630).mean(axis=0)
+    np.testing.assert_allclose(corner_coordinates[(360, 626)], expected)
+
+
+def test_project_bounds_to_window(depth_image):
+    """The window covers every pixel whose deprojected point falls inside the box."""
+    min_bound, max_bound = np.array([-0.05, -0.03, 0.3]), np.array([0.02, 0.04, 0.5])
+    window = depthimages.project_bounds_to_window(
+        min_bound, max_bound, np.eye(4), CAMERA_MATRIX, depth_image.shape)
+
+    points = depthimages.deproject_window(depth_image, CAMERA_MATRIX, DEPTH_SCALE)
+    inside = np.all((points >= min_bound) & (points <= max_bound), axis=1)
+    windowed_points = depthimages.deproject_window(
+        depth_image, CAMERA_MATRIX, DEPTH_SCALE, *window)
+    windowed_inside = np.all(
+        (windowed_points >= min_bound) & (windowed_points <= max_bound), axis=1)
+    assert 0 < np.sum(windowed_inside) == np.sum(inside)
+    assert len(windowed_points) < len(points)
+
+    # boxes reaching behind the camera fall back to the whole image
+    behind = depthimages.project_bounds_to_window(
+        min_bound - 1, max_bound, np.eye(4), CAMERA_MATRIX, depth_image.shape)
+    assert behind == (0, 720, 0, 1280)
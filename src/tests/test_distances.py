@@ -0,0 +1,104 @@
+"""Tests for the point-to-mesh distance queries."""
+import multiprocessing
+import os
+import numpy as np
+import pymesh
+import pytest
+import depthquality.distances as distances
+
+VOXEL_SIZE = 0.5
+BAND = 3.0
+
+
+@pytest.fixture(scope="module")
+def box_mesh():
+    """Two boxes of 20 x 10 x 5 mm side by side, so there are ridges between the parts."""
+    vertices, faces = [], []
+    for offset in ([0, 0, 0], [24, 0, 0]):
+        box = pymesh.generate_box_mesh(np.array(offset), np.array(offset) + [20, 10, 5])
+        faces.append(box.faces + sum(len(v) for v in vertices))
+        vertices.append(box.vertices)
+    return pymesh.form_mesh(np.concatenate(vertices), np.concatenate(faces))
+
+
+@pytest.fixture(scope="module")
+def distance_field(box_mesh):
+    return distances.DistanceField.build(box_mesh, voxel_size=VOXEL_SIZE, band=BAND)
+
+
+@pytest.fixture(scope="module")
+def points(box_mesh):
+    """Points scattered around the surface, and some far outside of the band."""
+    rng = np.random.RandomState(0)
+    near = rng.uniform([-2, -2, -2], [46, 12, 7], size=(5000, 3))
+    far = rng.uniform([-30, -30, 20], [70, 40, 40], size=(500, 3))
+    return np.concatenate([near, far])
+
+
+def test_distance_field_error_bound(box_mesh, distance_field, points):
+    """Interpolated squared distances stay within the documented error bound."""
+    exact = distances.exact_squared_distances(box_mesh, points)
+    interpolated = distance_field.squared_distances(points)
+
+    errors = interpolated - exact
+    assert np.all(errors <= 0.75 * VOXEL_SIZE ** 2 + 1e-6)
+    assert np.all(-errors <= np.sqrt(3) * VOXEL_SIZE * (np.sqrt(exact) + VOXEL_SIZE) + 1e-6)
+
+    # points outside of the band get the exact value
+    far = exact > (BAND + 2 * np.sqrt(3) * VOXEL_SIZE * distance_field.brick_size) ** 2
+    assert np.any(far)
+    np.testing.assert_array_equal(interpolated[far], exact[far])
+
+
+def test_distance_field_cache(tmpdir, monkeypatch, box_mesh, points):
+    """Distance fields are cached on disk and reloaded without rebuilding."""
+    monkeypatch.setenv("DEPTHQUALITY_CACHE_DIR", str(tmpdir))
+    distance_field = distances.get_distance_field(box_mesh, voxel_size=VOXEL_SIZE, band=BAND)
+    assert len(os.listdir(str(tmpdir.join("distance_fields")))) == 1
+
+    def fail_to_build(*args, **kwargs):
+        raise AssertionError("the distance field should be loaded from the cache")
+
+    monkeypatch.setattr(distances.DistanceField, "build", fail_to_build)
+    cached = distances.get_distance_field(box_mesh, voxel_size=VOXEL_SIZE, band=BAND)
+    np.testing.assert_array_equal(
+        cached.squared_distances(points), distance_field.squared_distances(points))
+
+
+@pytest.mark.parametrize("mesh_filename", [
+    "vertical_cylinders.obj", "horizontal_cylinders.obj", "angled_plates.obj"])
+def test_triangle_tree_matches_pymesh(mesh_filename):
+    """The TriangleTree gives the same squared distances and closest points as pymesh."""
+    mesh = pymesh.load_mesh(os.path.join(os.path.dirname(__file__), "..", "meshes", mesh_filename))
+
+    # points scattered around the surface the way a pointcloud would be, plus some far away
+    rng = np.random.RandomState(0)
+    faces = rng.randint(len(mesh.faces), size=5000)
+    barycentric = rng.dirichlet([1, 1, 1], size=5000)
+    points = np.einsum("ij,ijk->ik", barycentric, mesh.vertices[mesh.faces[faces]])
+    points += rng.normal(scale=2, size=points.shape)
+    points = np.concatenate([points, rng.uniform(
+        mesh.bbox[0] - 20, mesh.bbox[1] + 20, size=(500, 3))])
+
+    expected, _, _ = pymesh.distance_to_mesh(mesh, points)
+    tree = distances.TriangleTree(mesh.vertices, mesh.faces)
+    squared_distances, face_indices, closest_points = tree.query(
+        points, chunk_size=1000, workers=2)
+    single_threaded, _, _ = tree.query(points, chunk_size=1000, workers=1)
+    np.testing.assert_array_equal(single_threaded, squared_distances)
+
+    np.testing.assert_allclose(squared_distances, expected, rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(
+        np.sum((closest_points - points) ** 2, axis=1), squared_distances, rtol=1e-9, atol=1e-9)
+    face_closest_points = distances.closest_points_on_triangles(
+        points, *mesh.vertices[mesh.faces[face_indices]].transpose(1, 0, 2))
+    np.testing.assert_allclose(
+        np.sum((face_closest_points - points) ** 2, axis=1), squared_distances,
+        rtol=1e-9, atol=1e-9)
+
+
+def test_default_workers():
+    """Queries are multi-threaded, but not in the workers of a process pool."""
+    assert distances.get_default_workers() == os.cpu_count()
+    with multiprocessing.Pool(processes=1) as pool:
+        assert pool.apply(distances.get_default_workers) == 1
@@ -0,0 +1,43 @@
+"""Tests for detecting the ArUco fiducials."""
+import os
+import cv2
+import numpy as np
+import pytest
+import depthquality.fiducials as fiducials
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+EXPECTED_IDS = [231, 123, 114, 141]
+
+
+@pytest.fixture(params=sorted(os.listdir(DATA_DIR)))
+def img(request):
+    """An RGB image of each of the reference meshes."""
+    return cv2.imread(os.path.join(DATA_DIR, request.param, "1.png"))
+
+
+def test_expected_ids(img):
+    """Searching for the expected markers only gives the same corners."""
+    detected_corners = fiducials.ArucoDetector(expected_ids=EXPECTED_IDS).detect_corners(img)
+    reference_corners = fiducials.ArucoDetector().detect_corners(img)
+
+    assert set(detected_corners) == set(EXPECTED_IDS)
+    for aruco_id in EXPECTED_IDS:
+        np.testing.assert_array_equal(detected_corners[aruco_id], reference_corners[aruco_id])
+
+
+@pytest.mark.parametrize("downscale", [2, 3])
+def test_downscaled_detection(img, downscale):
+    """Detecting in a downscaled image first gives the full resolution corners."""
+    detector = fiducials.ArucoDetector(expected_ids=EXPECTED_IDS, downscale=downscale)
+    detected_arucos = detector.detect(img)
+    reference_arucos = fiducials.detect_arucos(img)
+
+    assert set(detected_arucos) == set(EXPECTED_IDS)
+    for aruco_id in EXPECTED_IDS:
+        for location, corner in reference_arucos[aruco_id].items():
+            np.testing.assert_allclose(detected_arucos[aruco_id][location], corner, atol=0.05)
+
+
+def test_no_markers():
+    """An image without any marker has no detections."""
+    assert fiducials.detect_arucos(np.zeros((72, 128, 3), dtype=np.uint8)) == {}
@@ -0,0 +1,35 @@
+"""Startup-time tests: importing the package should not load any reference meshes."""
+import os
+import subprocess
+import sys
+import depthquality
+
+# how much longer than its dependencies importing the pipeline modules may take, in seconds
+IMPORT_TIME_BUDGET = 0.25
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(depthquality.__file__)))
+
+
+def run_python(code):
+    """Run code in a fresh interpreter that can import depthquality and return its stdout."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [SRC_DIR, env.get("PYTHONPATH")]))
+    return subprocess.check_output([sys.executable, "-c", code], env=env).decode()
+
+
+def test_import_does_not_load_meshes():
+    """The built-in meshes are only constructed when they are first accessed."""
+    output = run_python(
+        "import depthquality.quality, depthquality.meshes as meshes; "
+        "print(len(meshes._builtin_meshes))")
+    assert output.strip() == "0"
+
+
+def test_import_time_budget():
+    """Importing the pipeline costs little more than importing its dependencies."""
+    output = run_python(
+        "import time, json, cv2, numpy, open3d, pymesh\n"
+        "start = time.perf_counter()\n"
+        "import depthquality.quality, depthquality.meshes\n"
+        "print(time.perf_counter() - start)")
+    assert float(output) < IMPORT_TIME_BUDGET
@@ -0,0 +1,102 @@
+"""Tests for the reference meshes and their on-disk cache."""
+import os
+import shutil
+import numpy as np
+import pymesh
+import pytest
+import depthquality.meshes as meshes
+
+MESH_FILENAME = os.path.join(
+    os.path.dirname(__file__), "..", "meshes", "vertical_cylinders.obj")
+
+
+@pytest.fixture
+def mesh_path(tmpdir, monkeypatch):
+    """A private copy of a reference mesh, with the cache directory pointed at tmpdir."""
+    monkeypatch.setenv("DEPTHQUALITY_CACHE_DIR", str(tmpdir.join("cache")))
+    path = str(tmpdir.join("mesh.obj"))
+    shutil.copy(MESH_FILENAME, path)
+    return path
+
+
+def cache_files(tmpdir):
+    cache_dir = tmpdir.join("cache", "meshes")
+    return sorted(os.listdir(str(cache_dir))) if cache_dir.check() else []
+
+
+def test_cached_mesh_matches(tmpdir, mesh_path, monkeypatch):
+    """A mesh loaded from the cache is the same as one built from the OBJ."""
+    reference_mesh = meshes.ReferenceMesh(path=mesh_path)
+    assert len(cache_files(tmpdir)) == 1
+
+    def fail_to_load(path):
+        raise AssertionError("the OBJ should not be parsed when it is cached")
+
+    monkeypatch.setattr(pymesh, "load_mesh", fail_to_load)
+    cached_mesh = meshes.ReferenceMesh(path=mesh_path)
+
+    np.testing.assert_array_equal(cached_mesh.submesh_labels, reference_mesh.submesh_labels)
+    np.testing.assert_array_equal(
+        cached_mesh.reference_mesh.faces, reference_mesh.reference_mesh.faces)
+    for cached_submesh, submesh in zip(cached_mesh.submeshes, reference_mesh.submeshes):
+        np.testing.assert_array_equal(cached_submesh.vertices, submesh.vertices)
+        np.testing.assert_array_equal(cached_submesh.faces, submesh.faces)
+    assert len(cached_mesh.pattern_meshes) == len(reference_mesh.pattern_meshes)
+    assert cached_mesh.get_pattern_surface_area() == reference_mesh.get_pattern_surface_area()
+
+
+def test_cache_invalidation(tmpdir, mesh_path):
+    """Changing the OBJ or the constructor arguments creates a new cache entry."""
+    meshes.ReferenceMesh(path=mesh_path)
+    meshes.ReferenceMesh(path=mesh_path)
+    assert len(cache_files(tmpdir)) == 1
+
+    with open(mesh_path, 'a') as f:
+        f.write("# modified\n")
+    meshes.ReferenceMesh(path=mesh_path)
+    assert len(cache_files(tmpdir)) == 2
+
+    meshes.ReferenceMesh(path=mesh_path, backplate_thickness=5)
+    assert len(cache_files(tmpdir)) == 3
+
+
+def test_no_cache(tmpdir, mesh_path):
+    """The cache can be turned off."""
+    meshes.ReferenceMesh(path=mesh_path, use_cache=False)
+    assert cache_files(tmpdir) == []
+
+
+def test_pattern_surface_area_of_many_angles(mesh_path):
+    """The areas of a batch of view directions match the original per-direction computation."""
+    reference_mesh = meshes.ReferenceMesh(path=mesh_path)
+    camera_angles = np.random.RandomState(0).normal(size=(50, 3))
+    camera_angles /= np.linalg.norm(camera_angles, axis=1, keepdims=True)
+
+    # from the face attributes of every pattern mesh, not the precomputed arrays, so that a
+    # wrong precomputation is caught
+    expected = np.zeros(len(camera_angles))
+    for pattern_mesh in reference_mesh.pattern_meshes:
+        pattern_mesh.add_attribute("face_normal")
+        pattern_mesh.add_attribute("face_area")
+        face_normals = pattern_mesh.get_face_attribute("face_normal")
+        face_areas = pattern_mesh.get_face_attribute("face_area").ravel()
+        for index, camera_angle in enumerate(camera_angles):
+            expected[index] += np.sum(face_areas[
+                np.arccos(np.clip(np.dot(face_normals, camera_angle), -1, 1)) < np.pi / 2])
+
+    np.testing.assert_allclose(reference_mesh.get_pattern_surface_area(camera_angles), expected)
+    assert reference_mesh.get_pattern_surface_area(camera_angles[0]) == \
+        pytest.approx(expected[0])
+
+
+def test_pattern_surface_area_lookup_table(mesh_path):
+    """The lookup table is exact on its grid, and close to the exact area in between."""
+    reference_mesh = meshes.ReferenceMesh(path=mesh_path)
+    camera_angle = np.array([0, 0, -1])
+    assert reference_mesh.get_pattern_surface_area(camera_angle, lut_resolution=90) == \
+        pytest.approx(reference_mesh.get_pattern_surface_area(camera_angle))
+
+    camera_angles = np.array([[0.1, 0.05, -1], [-0.2, 0.1, -1], [0.05, -0.3, -1]])
+    np.testing.assert_allclose(
+        reference_mesh.get_pattern_surface_area(camera_angles, lut_resolution=180),
+        reference_mesh.get_pattern_surface_area(camera_angles), rtol=0.05)
@@ -0,0 +1,102 @@
+"""Tests for reading PLY pointclouds."""
+import numpy as np
+import pytest
+import depthquality.plyfiles as plyfiles
+
+VERTEX_DTYPE = [("x", "f4"), ("y", "f4"), ("z", "f4"),
+                ("red", "u1"), ("green", "u1"), ("blue", "u1")]
+
+
+def write_binary_ply(filename, vertices, byte_order="<", preceding_elements=b""):
+    ply_format = {"<": "binary_little_endian", ">": "binary_big_endian"}[byte_order]
+    header = (
+        "ply\nformat {} 1.0\ncomment written by the tests\n".format(ply_format) +
+        ("element camera 1\nproperty double scale\n" if preceding_elements else "") +
+        "element vertex {}\n".format(len(vertices)) +
+        "".join("property {} {}\n".format(
+            {"f4": "float", "u1": "uchar"}[field_type], name)
+            for name, field_type in VERTEX_DTYPE) +
+        "end_header\n")
+    dtype = np.dtype([(name, byte_order + field_type) for name, field_type in VERTEX_DTYPE])
+    with open(filename, 'wb') as f:
+        f.write(header.encode("ascii"))
+        f.write(preceding_elements)
+        f.write(vertices.astype(dtype).tobytes())
+
+
+@pytest.fixture
+def vertices():
+    """Random colored vertices."""
+    rng = np.random.RandomState(0)
+    vertices = np.zeros(1000, dtype=VERTEX_DTYPE)
+    for name in ("x", "y", "z"):
+        vertices[name] = rng.uniform(-1, 1, size=len(vertices))
+    vertices["red"] = rng.randint(0, 255, size=len(vertices))
+    return vertices
+
+
+def xyz(vertices):
+    return np.stack([vertices["x"], vertices["y"], vertices["z"]], axis=1)
+
+
+def test_binary_little_endian_is_mapped(tmpdir, vertices):
+    """The points of a binary little endian PLY are a read-only view of the mapped file."""
+    filename = str(tmpdir.join("cloud.ply"))
+    write_binary_ply(filename, vertices)
+
+    points = plyfiles.read_ply_points(filename)
+    assert points.dtype == np.float32
+    assert not points.flags.writeable
+    assert not points.flags.owndata
+    np.testing.assert_array_equal(points, xyz(vertices))
+
+    colors = plyfiles.read_ply_vertices(filename, ("red", "green", "blue"))
+    np.testing.assert_array_equal(colors["red"], vertices["red"])
+
+
+@pytest.mark.parametrize("byte_order,preceding_elements", [
+    (">", b""), ("<", np.array([1.5], dtype="<f8").tobytes())])
+def test_binary_variants(tmpdir, vertices, byte_order, preceding_elements):
+    """Big endian files and fixed size elements before the vertices are supported."""
+    filename = str(tmpdir.join("cloud.ply"))
+    write_binary_ply(filename, vertices, byte_order, preceding_elements)
+
+    np.testing.assert_array_equal(plyfiles.read_ply_points(filename), xyz(vertices))
+
+
+def test_ascii(tmpdir, vertices):
+    """ASCII files are parsed, ignoring the elements after the vertices."""
+    filename = str(tmpdir.join("cloud.ply"))
+    with open(filename, 'w') as f:
+        f.write("ply\nformat ascii 1.0\nelement vertex {}\n".format(len(vertices)))
+        f.write("property float x\nproperty float y\nproperty float z\nproperty uchar red\n")
+        f.write("element face 1\nproperty list uchar int vertex_indices\nend_header\n")
+        for vertex in vertices:
+            f.write("{!r} {!r} {!r} {}\n".format(
+                float(vertex["x"]), float(vertex["y"]), float(vertex["z"]), vertex["red"]))
+        f.write("3 0 1 2\n")
+
+    np.testing.assert_array_equal(plyfiles.read_ply_points(filename), xyz(vertices))
+    np.testing.assert_array_equal(plyfiles.read_ply_vertices(filename)["red"], vertices["red"])
+
+
+def test_write_ply_points(tmpdir, vertices):
+    """Written points read back as the same float32 coordinates."""
+    filename = str(tmpdir.join("cloud.ply"))
+    plyfiles.write_ply_points(filename, xyz(vertices).astype(np.float64))
+    np.testing.assert_array_equal(plyfiles.read_ply_points(filename), xyz(vertices))
+
+
+def test_invalid_files(tmpdir):
+    """Files that are not PLY, or without a readable vertex element, are rejected."""
+    filename = str(tmpdir.join("cloud.ply"))
+    with open(filename, 'w') as f:
+        f.write("OFF\n")
+    with pytest.raises(ValueError):
+        plyfiles.read_ply_points(filename)
+
+    with open(filename, 'w') as f:
+        f.write("ply\nformat binary_little_endian 1.0\nelement face 1\n")
+        f.write("property list uchar int vertex_indices\nend_header\n")
+    with pytest.raises(ValueError):
+        plyfiles.read_ply_points(filename)
@@ -0,0 +1,340 @@
+"""Tests for the in-memory alignment API."""
+import os
+import numpy as np
+import pytest
+import depthquality.meshes as meshes
+import depthquality.quality as quality
+from depthquality import transformations as tfms
+
+CAMERA_MATRIX = {"fx": 932.141, "fy": 932.805, "ppx": 626.04, "ppy": 360.39}
+DEPTH_SCALE = 0.001
+BACKPLATE_THICKNESS = 6.35
+
+
+class PlanarFixture:
+    """The fiducials of the reference meshes, without any pattern."""
+
+    def __init__(self):
+        from depthquality.fiducials import TOP_LEFT, TOP_RIGHT, BOTTOM_RIGHT, BOTTOM_LEFT
+        self.fiducial_locations = {}
+        for aruco_id, (x, y) in zip([231, 123, 114, 141], [
+                (-75.5625, 48.575), (55.5625, 48.575), (-75.5625, -28.575), (55.5625, -28.575)]):
+            self.fiducial_locations[aruco_id] = {
+                TOP_LEFT: [x, y, BACKPLATE_THICKNESS],
+                TOP_RIGHT: [x + 20, y, BACKPLATE_THICKNESS],
+                BOTTOM_RIGHT: [x + 20, y - 20, BACKPLATE_THICKNESS],
+                BOTTOM_LEFT: [x, y - 20, BACKPLATE_THICKNESS],
+            }
+
+    def get_fiducial_coordinate(self, fiducial_id, location):
+        return self.fiducial_locations[fiducial_id][location]
+
+
+@pytest.fixture(scope="module")
+def capture():
+    """A capture of the backplate from 40 cm away, as points in the reference and camera frames."""
+    reference_mesh = PlanarFixture()
+    x, y = np.meshgrid(np.arange(-90, 90, 0.5), np.arange(-60, 60, 0.5))
+    reference_points = np.stack(
+        [x.ravel(), y.ravel(), np.full(x.size, BACKPLATE_THICKNESS)], axis=1) * DEPTH_SCALE
+
+    # the camera looks down at the backplate, slightly tilted
+    camera_from_reference = tfms.concatenate_matrices(
+        tfms.translation_matrix([0.01, -0.02, 0.4]),
+        tfms.euler_matrix(np.pi + 0.1, 0.15, 0.05))
+    camera_points = reference_points @ camera_from_reference[:3, :3].T + \
+        camera_from_reference[:3, 3]
+
+    # the detected corners are the projections of the fiducial corners
+    detected_arucos = {}
+    for aruco_id, corners in reference_mesh.fiducial_locations.items():
+        detected_arucos[aruco_id] = {}
+        for location, corner in corners.items():
+            point = camera_from_reference[:3, :3] @ (np.array(corner) * DEPTH_SCALE) + \
+                camera_from_reference[:3, 3]
+            detected_arucos[aruco_id][location] = np.array([
+                CAMERA_MATRIX["fx"] * point[0] / point[2] + CAMERA_MATRIX["ppx"],
+                CAMERA_MATRIX["fy"] * point[1] / point[2] + CAMERA_MATRIX["ppy"]])
+    return reference_mesh, reference_points, camera_points, detected_arucos
+
+
+def test_align_points(capture):
+    """An array of points is aligned to the reference frame, returning an array."""
+    reference_mesh, reference_points, camera_points, detected_arucos = capture
+    aligned_points, camera_angle = quality.align_pointcloud(
+        reference_mesh, None, CAMERA_MATRIX, camera_points, DEPTH_SCALE,
+        detected_arucos=detected_arucos)
+
+    assert isinstance(aligned_points, np.ndarray)
+    np.testing.assert_allclose(aligned_points, reference_points, atol=1e-3)
+    assert camera_angle[2] > 0.9
+
+
+def test_camera_matrix_and_buffers(capture):
+    """A 3x3 intrinsics matrix and a flat float32 buffer of points are accepted as well."""
+    reference_mesh, _, camera_points, detected_arucos = capture
+    expected_points, _ = quality.align_pointcloud(
+        reference_mesh, None, CAMERA_MATRIX, camera_points.astype(np.float32), DEPTH_SCALE,
+        detected_arucos=detected_arucos)
+
+    intrinsics = np.array([
+        [CAMERA_MATRIX["fx"], 0, CAMERA_MATRIX["ppx"]],
+        [0, CAMERA_MATRIX["fy"], CAMERA_MATRIX["ppy"]],
+        [0, 0, 1]])
+    buffer = memoryview(camera_points.astype(np.float32).ravel())
+    aligned_points, _ = quality.align_pointcloud(
+        reference_mesh, None, intrinsics, buffer, DEPTH_SCALE, detected_arucos=detected_arucos)
+
+    np.testing.assert_allclose(aligned_points, expected_points)
+    with pytest.raises(ValueError):
+        quality.get_camera_matrix(np.eye(4))
+
+
+def corrupt_corner(camera_points, corner, offset=0.03):
+    """Push the points around an (x, y) image corner away from the camera, like flying pixels."""
+    u = CAMERA_MATRIX["fx"] * camera_points[:, 0] / camera_points[:, 2] + CAMERA_MATRIX["ppx"]
+    v = CAMERA_MATRIX["fy"] * camera_points[:, 1] / camera_points[:, 2] + CAMERA_MATRIX["ppy"]
+    near_corner = (np.abs(u - corner[0]) <= 4) & (np.abs(v - corner[1]) <= 4)
+    corrupted_points = camera_points.copy()
+    corrupted_points[near_corner] *= 1 + offset / camera_points[near_corner, 2:]
+    return corrupted_points
+
+
+def test_robust_alignment(capture):
+    """A corner with a bad depth skews the least squares alignment, but not the robust one."""
+    reference_mesh, reference_points, camera_points, detected_arucos = capture
+    bad_corner = list(detected_arucos[231].values())[0]
+    corrupted_points = corrupt_corner(camera_points, bad_corner)
+
+    least_squares_points, _ = quality.align_pointcloud(
+        reference_mesh, None, CAMERA_MATRIX, corrupted_points, DEPTH_SCALE,
+        detected_arucos=detected_arucos)
+    robust_points, _ = quality.align_pointcloud(
+        reference_mesh, None, CAMERA_MATRIX, corrupted_points, DEPTH_SCALE,
+        detected_arucos=detected_arucos, inlier_threshold=5)
+
+    # the corrupted points themselves are off anyway
+    valid = np.all(corrupted_points == camera_points, axis=1)
+    least_squares_error = np.max(np.linalg.norm(
+        least_squares_points[valid] - reference_points[valid], axis=1))
+    robust_error = np.max(np.linalg.norm(robust_points[valid] - reference_points[valid], axis=1))
+    assert least_squares_error > 3e-3
+    assert robust_error < 1e-3
+
+    # the corner is reported as an outlier, with its residual
+    _, _, corner_fit = quality.align_pointcloud(
+        reference_mesh, None, CAMERA_MATRIX, corrupted_points, DEPTH_SCALE,
+        detected_arucos=detected_arucos, inlier_threshold=5, return_inliers=True)
+    bad_reference_coord = list(reference_mesh.fiducial_locations[231].values())[0]
+    is_bad = np.all(np.isclose(corner_fit.reference_coords, bad_reference_coord), axis=1)
+    np.testing.assert_array_equal(~corner_fit.inliers, is_bad)
+    assert corner_fit.residuals[is_bad] > 5
+    assert np.all(corner_fit.residuals[~is_bad] < 1)
+
+
+def test_ransac_inliers():
+    """The inlier mask flags the outliers, and the residuals are those of the refit transform."""
+    rng = np.random.RandomState(0)
+    reference_coords = np.array([
+        corner for corners in PlanarFixture().fiducial_locations.values()
+        for corner in corners.values()]) * DEPTH_SCALE
+    camera_from_reference = tfms.concatenate_matrices(
+        tfms.translation_matrix([0, 0, 0.5]), tfms.euler_matrix(np.pi, 0.2, 0.1))
+    measured_coords = reference_coords @ camera_from_reference[:3, :3].T + \
+        camera_from_reference[:3, 3] + rng.normal(scale=5e-4, size=reference_coords.shape)
+    measured_coords[[3, 10]] += [0, 0, 0.02]
+
+    rigid_transform, inliers, residuals = quality.fit_rigid_transform_ransac(
+        measured_coords, reference_coords, inlier_threshold=5e-3)
+
+    np.testing.assert_array_equal(np.flatnonzero(~inliers), [3, 10])
+    np.testing.assert_allclose(
+        rigid_transform, tfms.inverse_matrix(camera_from_reference), atol=5e-3)
+    aligned_coords = measured_coords @ rigid_transform[:3, :3].T + rigid_transform[:3, 3]
+    np.testing.assert_allclose(
+        residuals, np.linalg.norm(aligned_coords - reference_coords, axis=1))
+
+    with pytest.raises(ValueError):
+        quality.fit_rigid_transform_ransac(
+            measured_coords[:2], reference_coords[:2], inlier_threshold=5e-3)
+    # no hypothesis fits 3 noisy corners that closely
+    with pytest.raises(ValueError):
+        quality.fit_rigid_transform_ransac(
+            measured_coords, reference_coords, inlier_threshold=1e-7)
+
+
+def test_icp_refinement():
+    """ICP moves slightly misaligned points of the pattern area back onto the mesh surface."""
+    reference_mesh = meshes.ReferenceMesh(
+        path=os.path.join(os.path.dirname(__file__), "..", "meshes", "angled_plates.obj"),
+        use_cache=False)
+
+    # the surface of the pattern area as seen from above, in the units of the pointcloud
+    samples = reference_mesh.get_surface_samples(spacing=2.0)
+    min_bound, max_bound = quality.get_pattern_area_bounds(reference_mesh, 1)
+    visible = (samples.normals[:, 2] > 0.2) & \
+        np.all((samples.points >= min_bound) & (samples.points <= max_bound), axis=1)
+    points = samples.points[visible] * DEPTH_SCALE
+
+    misalignment = tfms.concatenate_matrices(
+        tfms.translation_matrix([5e-4, -4e-4, 8e-4]), tfms.euler_matrix(0.01, -0.008, 0.012))
+    misaligned_points = points @ misalignment[:3, :3].T + misalignment[:3, 3]
+
+    refinement = quality.refine_alignment(
+        reference_mesh, misaligned_points, DEPTH_SCALE, max_iterations=30)
+    refined_points = quality.apply_rigid_transform(misaligned_points, refinement)
+
+    def rms_distance(points):
+        return np.sqrt(np.mean(reference_mesh.get_squared_distances(
+            points / DEPTH_SCALE, method="bvh")))
+
+    assert rms_distance(misaligned_points) > 0.5
+    assert rms_distance(refined_points) < 0.05
+
+    # starting from the answer, a single iteration stays there
+    warm_refinement = quality.refine_alignment(
+        reference_mesh, misaligned_points, DEPTH_SCALE, initial_transform=refinement,
+        max_iterations=1)
+    np.testing.assert_allclose(warm_refinement, refinement, atol=1e-5)
+
+
+def test_crop_before_transform():
+    """Cropping in the camera frame keeps the same points as transforming all of them first."""
+    reference_mesh = meshes.ReferenceMesh(
+        path=os.path.join(os.path.dirname(__file__), "..", "meshes", "angled_plates.obj"),
+        use_cache=False)
+    rng = np.random.RandomState(0)
+    reference_points = rng.uniform(-0.1, 0.1, size=(100000, 3))
+    camera_from_reference = tfms.concatenate_matrices(
+        tfms.translation_matrix([0.01, -0.02, 0.4]),
+        tfms.euler_matrix(np.pi + 0.3, 0.25, 0.4))
+    camera_points = (reference_points @ camera_from_reference[:3, :3].T +
+                     camera_from_reference[:3, 3]).astype(np.float32)
+    rigid_transform = tfms.inverse_matrix(camera_from_reference)
+
+    expected_points, expected_indices = quality.clip_pointcloud_to_pattern_area(
+        reference_mesh, quality.apply_rigid_transform(camera_points, rigid_transform),
+        DEPTH_SCALE, return_indices=True)
+    cropped_points, indices = quality.crop_to_pattern_area(
+        reference_mesh, camera_points, rigid_transform, DEPTH_SCALE)
+
+    assert 0 < len(indices) < len(camera_points) / 2
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(cropped_points, expected_points)
+
+
+@pytest.fixture(scope="module")
+def noisy_capture():
+    """A noisy pointcloud of the angled plates in the camera frame, and its rigid transform."""
+    reference_mesh = meshes.ReferenceMesh(
+        path=os.path.join(os.path.dirname(__file__), "..", "meshes", "angled_plates.obj"),
+        use_cache=False)
+    rng = np.random.RandomState(0)
+    samples = reference_mesh.get_surface_samples(spacing=2.0)
+    reference_points = samples.points[samples.normals[:, 2] > 0.2] * DEPTH_SCALE
+    reference_points = reference_points + rng.normal(0, 5e-4, size=reference_points.shape)
+    camera_from_reference = tfms.concatenate_matrices(
+        tfms.translation_matrix([0.01, -0.02, 0.4]), tfms.euler_matrix(np.pi + 0.2, 0.1, 0.05))
+    camera_points = reference_points @ camera_from_reference[:3, :3].T + \
+        camera_from_reference[:3, 3]
+    rigid_transform = tfms.inverse_matrix(camera_from_reference)
+    camera_angle = rigid_transform[:3, :3] @ [0, 0, -1]
+    return reference_mesh, camera_points, rigid_transform, camera_angle
+
+
+def test_chunked_metrics(noisy_capture):
+    """Streaming the crop and the metrics in chunks gives the same results as all at once."""
+    reference_mesh, camera_points, rigid_transform, camera_angle = noisy_capture
+
+    cropped_points, expected_indices = quality.crop_to_pattern_area(
+        reference_mesh, camera_points, rigid_transform, DEPTH_SCALE)
+    expected_rmse, expected_density, expected_distances = quality.calculate_rmse_and_density(
+        reference_mesh, cropped_points, DEPTH_SCALE, camera_angle, distance_method="bvh",
+        return_residuals=True)
+
+    rmse, density = quality.calculate_rmse_and_density(
+        reference_mesh, cropped_points, DEPTH_SCALE, camera_angle, distance_method="bvh",
+        chunk_size=100)
+    assert rmse == pytest.approx(expected_rmse, rel=1e-12)
+    assert density == expected_density
+
+    rmse, density, num_points, indices, distances = \
+        quality.crop_and_calculate_rmse_and_density(
+            reference_mesh, camera_points, rigid_transform, DEPTH_SCALE, camera_angle,
+            distance_method="bvh", return_residuals=True, chunk_size=100)
+    assert 0.3 < rmse < 1.0
+    assert rmse == pytest.approx(expected_rmse, rel=1e-12)
+    assert density == expected_density
+    assert num_points == len(cropped_points)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_array_equal(distances, expected_distances)
+
+
+def test_float32_metrics(noisy_capture):
+    """In single precision, the metrics are those of double precision up to rounding."""
+    reference_mesh, camera_points, rigid_transform, camera_angle = noisy_capture
+
+    expected_rmse, expected_density, expected_num_points = \
+        quality.crop_and_calculate_rmse_and_density(
+            reference_mesh, camera_points, rigid_transform, DEPTH_SCALE, camera_angle,
+            distance_method="bvh")
+    rmse, density, num_points = quality.crop_and_calculate_rmse_and_density(
+        reference_mesh, camera_points.astype(np.float32), rigid_transform, DEPTH_SCALE,
+        camera_angle, distance_method="bvh", dtype=np.float32)
+    assert rmse == pytest.approx(expected_rmse, rel=1e-5)
+    assert density == pytest.approx(expected_density, abs=1e-3)
+    assert num_points == expected_num_points
+
+    # aligned float64 points, such as those of depth images, are scaled into float32 chunks
+    cropped_points, _ = quality.crop_to_pattern_area(
+        reference_mesh, camera_points, rigid_transform, DEPTH_SCALE)
+    rmse, density = quality.calculate_rmse_and_density(
+        reference_mesh, cropped_points, DEPTH_SCALE, camera_angle, distance_method="bvh",
+        chunk_size=100, dtype=np.float32)
+    assert rmse == pytest.approx(expected_rmse, rel=1e-5)
+    assert density == pytest.approx(expected_density, abs=1e-3)
+
+
+def test_approximate_metrics(noisy_capture):
+    """The sampled metrics bound the exact ones, and are exact once every point is sampled."""
+    reference_mesh, camera_points, rigid_transform, camera_angle = noisy_capture
+    cropped_points, _ = quality.crop_to_pattern_area(
+        reference_mesh, camera_points, rigid_transform, DEPTH_SCALE)
+    rmse, density = quality.calculate_rmse_and_density(
+        reference_mesh, cropped_points, DEPTH_SCALE, camera_angle, distance_method="bvh")
+
+    metrics = quality.estimate_rmse_and_density(
+        reference_mesh, cropped_points, DEPTH_SCALE, camera_angle, tolerance=0.05,
+        distance_method="bvh", min_samples=256)
+    assert metrics.num_samples < len(cropped_points)
+    assert metrics.rmse_bounds[0] <= rmse <= metrics.rmse_bounds[1]
+    assert metrics.rmse_bounds[1] - metrics.rmse_bounds[0] < 0.1
+    assert metrics.density_bounds[0] <= density <= metrics.density_bounds[1]
+
+    metrics = quality.calculate_rmse_and_density(
+        reference_mesh, cropped_points, DEPTH_SCALE, camera_angle, distance_method="bvh",
+        tolerance=0)
+    assert metrics.num_samples == len(cropped_points)
+    assert metrics.rmse == pytest.approx(rmse, rel=1e-12)
+    assert metrics.rmse_bounds[0] == metrics.rmse_bounds[1] == metrics.rmse
+    assert metrics.density == pytest.approx(density, rel=1e-12)
+
+    with pytest.raises(ValueError):
+        quality.calculate_rmse_and_density(
+            reference_mesh, cropped_points, DEPTH_SCALE, camera_angle, tolerance=0.05,
+            return_residuals=True)
+
+
+def test_stratified_sampler():
+    """The samples hold as many points of every voxel as their fraction, and are nested."""
+    points = np.concatenate([np.zeros((900, 3)), np.full((100, 3), 5.0)])
+    sampler = quality._StratifiedSampler(points, 1.0, np.random.RandomState(0))
+    previous = np.empty(0, dtype=np.int64)
+    for fraction in (0.01, 0.1, 0.5, 1.0):
+        indices = sampler.sample(fraction)
+        assert np.all(np.diff(indices) > 0)
+        assert abs(np.count_nonzero(indices < 900) - 900 * fraction) <= 1
+        assert abs(np.count_nonzero(indices >= 900) - 100 * fraction) <= 1
+        assert np.all(np.isin(previous, indices))
+        previous = indices
+    np.testing.assert_array_equal(previous, np.arange(1000))
@@ -0,0 +1,33 @@
+"""Tests for storing the per-point residuals."""
+import numpy as np
+import pytest
+import depthquality.residuals as residuals
+
+
+def test_error_map_round_trip(tmpdir):
+    """Residuals of a depth image are saved compactly, and scatter back into its pixels."""
+    distances = np.array([0.25, 1.5, 3.0])
+    point_residuals = residuals.make_point_residuals([5, 0, 11], distances, shape=(3, 4))
+    assert point_residuals.indices.dtype == np.uint32
+    assert point_residuals.distances.dtype == np.float16
+
+    filename = str(tmpdir.join("residuals.npz"))
+    residuals.save_residuals(filename, point_residuals)
+    loaded = residuals.load_residuals(filename)
+    assert loaded.shape == (3, 4)
+
+    error_map = residuals.get_error_map(loaded)
+    assert error_map.shape == (3, 4)
+    np.testing.assert_allclose(error_map.flat[[5, 0, 11]], distances, rtol=1e-3)
+    assert np.count_nonzero(np.isnan(error_map)) == 9
+
+
+def test_unorganized_residuals(tmpdir):
+    """Residuals of a pointcloud round-trip too, but have no error map."""
+    point_residuals = residuals.make_point_residuals(np.arange(4), np.ones(4))
+    filename = str(tmpdir.join("residuals.npz"))
+    residuals.save_residuals(filename, point_residuals)
+    assert residuals.load_residuals(filename).shape is None
+
+    with pytest.raises(ValueError):
+        residuals.get_error_map(point_residuals)
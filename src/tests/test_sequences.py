@@ -0,0 +1,125 @@
+"""Tests for streaming the evaluation over sequences of frames."""
+import json
+import os
+import numpy as np
+import pytest
+import depthquality.fiducials as fiducials
+import depthquality.meshes as meshes
+import depthquality.quality as quality
+import depthquality.sequences as sequences
+from depthquality import transformations as tfms
+
+
+def test_iter_directory(tmpdir):
+    """Frames pair every RGB image with its depth, in natural order of their names."""
+    for filename in ["2.png", "2.ply", "10.png", "10_depth.png", "1.png", "1.npy",
+                     "no_depth.png", "camera_matrix.json"]:
+        tmpdir.join(filename).write("")
+
+    frames = list(sequences.iter_directory(str(tmpdir)))
+
+    assert [frame.name for frame in frames] == ["1", "2", "10"]
+    assert frames[0].rgb == str(tmpdir.join("1.png"))
+    assert [frame.depth for frame in frames] == [
+        str(tmpdir.join("1.npy")), str(tmpdir.join("2.ply")), str(tmpdir.join("10_depth.png"))]
+
+
+def test_iter_sequence_file(tmpdir):
+    """Recorded sequence files are read frame by frame from memory-mapped arrays."""
+    rgb = np.random.randint(0, 255, size=(4, 6, 8, 3), dtype=np.uint8)
+    depth = np.random.randint(0, 5000, size=(4, 6, 8), dtype=np.uint16)
+    filename = str(tmpdir.join("sequence.npz"))
+    np.savez(filename, rgb=rgb, depth=depth)
+
+    frames = list(sequences.iter_sequence_file(filename))
+
+    assert [frame.name for frame in frames] == ["0", "1", "2", "3"]
+    for index, frame in enumerate(frames):
+        assert isinstance(frame.depth, np.memmap)
+        np.testing.assert_array_equal(frame.rgb, rgb[index])
+        np.testing.assert_array_equal(frame.depth, depth[index])
+
+
+def test_compressed_sequence_file_is_rejected(tmpdir):
+    """Compressed arrays cannot be memory-mapped."""
+    filename = str(tmpdir.join("sequence.npz"))
+    np.savez_compressed(filename, rgb=np.zeros((1, 2, 2)), depth=np.zeros((1, 2, 2)))
+
+    with pytest.raises(ValueError):
+        list(sequences.iter_sequence_file(filename))
+
+
+def test_evaluate_sequence_is_lazy(tmpdir):
+    """Frames are only evaluated when their result is requested, and failures are per frame."""
+    with open(str(tmpdir.join("camera_matrix.json")), 'w') as f:
+        json.dump({"fx": 600.0, "fy": 600.0, "ppx": 4.0, "ppy": 3.0}, f)
+
+    def frames():
+        for index in range(3):
+            yield sequences.Frame(
+                name=str(index), rgb=np.zeros((6, 8, 3), dtype=np.uint8),
+                depth=np.zeros((6, 8), dtype=np.uint16))
+        raise AssertionError("the frames were consumed eagerly")
+
+    results = sequences.evaluate_sequence(
+        None, frames(), str(tmpdir.join("camera_matrix.json")), depth_scale=0.001,
+        detector=fiducials.ArucoDetector())
+
+    for index in range(3):
+        result = next(results)
+        assert result.name == str(index)
+        assert np.isnan(result.rmse)
+        assert result.error is not None
+
+
+def test_refinement_starts_from_previous_pose(tmpdir, monkeypatch):
+    """The ICP of a frame starts from the refined pose of the previous one, not its correction.
+
+    The fiducial pose of every frame has different noise, so the correction of the previous
+    frame does not apply to the next one; its refined pose does.
+    """
+    depth_scale = 0.001
+    reference_mesh = meshes.ReferenceMesh(
+        path=os.path.join(os.path.dirname(__file__), "..", "meshes", "angled_plates.obj"),
+        use_cache=False)
+    samples = reference_mesh.get_surface_samples(spacing=2.0)
+    reference_points = samples.points[samples.normals[:, 2] > 0.2] * depth_scale
+    camera_from_reference = tfms.concatenate_matrices(
+        tfms.translation_matrix([0.01, -0.02, 0.4]), tfms.euler_matrix(np.pi + 0.2, 0.1, 0.05))
+    camera_points = reference_points @ camera_from_reference[:3, :3].T + \
+        camera_from_reference[:3, 3]
+    true_pose = tfms.inverse_matrix(camera_from_reference)
+
+    # the fiducial poses of the frames are off by different small motions
+    fiducial_poses = [
+        tfms.concatenate_matrices(
+            tfms.translation_matrix([0.001, 0, -0.0005]), tfms.euler_matrix(0.01, 0, 0),
+            true_pose),
+        tfms.concatenate_matrices(
+            tfms.translation_matrix([-0.0005, 0.001, 0]), tfms.euler_matrix(0, -0.01, 0.005),
+            true_pose)]
+    monkeypatch.setattr(quality, "read_pointcloud", lambda filename: camera_points)
+    monkeypatch.setattr(
+        quality, "estimate_pointcloud_transform",
+        lambda *args, **kwargs: (fiducial_poses[len(initial_transforms)], np.array([0, 0, 1.])))
+    initial_transforms, refinements = [], []
+    refine_alignment = quality.refine_alignment
+
+    def spy_refine_alignment(*args, **kwargs):
+        initial_transforms.append(kwargs["initial_transform"])
+        refinements.append(refine_alignment(*args, **kwargs))
+        return refinements[-1]
+    monkeypatch.setattr(quality, "refine_alignment", spy_refine_alignment)
+
+    evaluator = sequences.SequenceEvaluator(
+        reference_mesh, {"fx": 600.0, "fy": 600.0, "ppx": 4.0, "ppy": 3.0}, depth_scale,
+        distance_method="bvh", detector=fiducials.ArucoDetector(), icp_iterations=10)
+    frames = [sequences.Frame(str(index), np.zeros((6, 8, 3), dtype=np.uint8), "frame.ply")
+              for index in range(2)]
+    results = list(evaluator.evaluate(frames))
+    assert [result.error for result in results] == [None, None]
+
+    assert initial_transforms[0] is None
+    first_pose = refinements[0] @ fiducial_poses[0]
+    np.testing.assert_allclose(initial_transforms[1] @ fiducial_poses[1], first_pose, atol=1e-12)
+    np.testing.assert_allclose(evaluator.pose, refinements[1] @ fiducial_poses[1])
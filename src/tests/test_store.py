@@ -0,0 +1,92 @@
+"""Tests for the content-addressed store of evaluation results."""
+import os
+import numpy as np
+import pytest
+import depthquality.batch as batch
+import depthquality.cli as cli
+import depthquality.meshes as meshes
+import depthquality.store as store
+import depthquality.synthetic as synthetic
+
+MESH_FILENAME = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "meshes", "vertical_cylinders.obj"))
+
+
+@pytest.fixture
+def captures(tmpdir):
+    reference_mesh = meshes.ReferenceMesh(path=MESH_FILENAME, use_cache=False)
+    camera_matrix = synthetic.make_camera_matrix(320, 240)
+    renderer = synthetic.CaptureRenderer(reference_mesh, camera_matrix, 320, 240)
+    rng = np.random.RandomState(0)
+    for index in range(2):
+        capture = renderer.capture(
+            synthetic.look_at([10 * index, 0, 300]), depth_scale=0.001, noise=0.5, rng=rng)
+        synthetic.write_capture(str(tmpdir), str(index), capture)
+    return batch.read_capture_directory(str(tmpdir), MESH_FILENAME, 0.001)
+
+
+def test_keys_follow_the_contents(tmpdir, captures):
+    """Keys only depend on the contents of the inputs, and on how they are evaluated."""
+    with store.ResultStore(str(tmpdir.join("results.sqlite"))) as result_store:
+        key = result_store.capture_key(captures[0])
+        assert result_store.capture_key(captures[1]) != key
+        assert result_store.capture_key(captures[0]._replace(depth_scale=0.0001)) != key
+        assert result_store.capture_key(captures[0], distance_method="bvh") != key
+
+        # the same files elsewhere are the same capture
+        moved_rgb = str(tmpdir.join("moved.png"))
+        os.rename(captures[0].rgb, moved_rgb)
+        assert result_store.capture_key(captures[0]._replace(rgb=moved_rgb)) == key
+        assert result_store.capture_key(captures[0]) is None
+
+        with open(moved_rgb, 'ab') as f:
+            f.write(b"\0")
+        assert result_store.capture_key(captures[0]._replace(rgb=moved_rgb)) != key
+
+
+def test_stored_results_are_not_evaluated_again(tmpdir, captures, monkeypatch):
+    """A second batch over the same inputs only reads the results from the store."""
+    filename = str(tmpdir.join("results.sqlite"))
+    with store.ResultStore(filename) as result_store:
+        results = batch.evaluate_captures(
+            captures, processes=1, distance_method="bvh", store=result_store)
+        assert [result.error for result in results] == [None, None]
+        assert len(result_store) == 2
+
+    evaluated = []
+
+    def evaluate_capture(capture, *args):
+        evaluated.append(capture)
+        raise AssertionError("{} was evaluated again".format(capture.rgb))
+
+    monkeypatch.setattr(batch, "_evaluate_capture", evaluate_capture)
+    with store.ResultStore(filename) as result_store:
+        stored_results = batch.evaluate_captures(
+            captures, processes=1, distance_method="bvh", store=result_store)
+    assert not evaluated
+    for result, stored_result in zip(results, stored_results):
+        assert stored_result.capture == result.capture
+        assert stored_result.rmse == result.rmse
+        assert stored_result.density == result.density
+        np.testing.assert_array_equal(stored_result.camera_angle, result.camera_angle)
+        assert stored_result.num_points == result.num_points
+
+
+def test_nan_results_are_stored(tmpdir, captures):
+    """Results without any valid point are read back with NaNs, and not NULLs."""
+    result = batch.CaptureResult(
+        captures[0], np.nan, np.nan, np.array([0.125, 0.5, 0.25]), 0, None)
+    with store.ResultStore(str(tmpdir.join("results.sqlite"))) as result_store:
+        key = result_store.capture_key(captures[0])
+        result_store.add(key, result)
+        stored_result = result_store.get(key)
+    assert np.isnan(stored_result.rmse)
+    assert np.isnan(stored_result.density)
+    np.testing.assert_array_equal(stored_result.camera_angle, result.camera_angle)
+    assert stored_result.num_points == 0
+
+    record = cli.result_to_record(result._replace(
+        rmse=stored_result.rmse, density=stored_result.density,
+        camera_angle=stored_result.camera_angle))
+    assert record["rmse"] is None and record["density"] is None
+    assert record["camera_angle_y"] == 0.5
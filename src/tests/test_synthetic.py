@@ -0,0 +1,75 @@
+"""Tests for the synthetic captures of the reference meshes."""
+import os
+import numpy as np
+import pytest
+import depthquality.fiducials as fiducials
+import depthquality.meshes as meshes
+import depthquality.sequences as sequences
+import depthquality.synthetic as synthetic
+from depthquality import transformations as tfms
+
+DEPTH_SCALE = 0.001
+WIDTH, HEIGHT = 640, 480
+
+
+@pytest.fixture(scope="module")
+def reference_mesh():
+    return meshes.ReferenceMesh(
+        path=os.path.join(os.path.dirname(__file__), "..", "meshes", "vertical_cylinders.obj"),
+        use_cache=False)
+
+
+@pytest.fixture(scope="module")
+def renderer(reference_mesh):
+    return synthetic.CaptureRenderer(
+        reference_mesh, synthetic.make_camera_matrix(WIDTH, HEIGHT), WIDTH, HEIGHT)
+
+
+def test_depth_lies_on_the_mesh(reference_mesh, renderer):
+    """Without noise, the deprojected points are on the mesh, up to the rounding to whole mm."""
+    camera_from_reference = synthetic.look_at([20, -30, 400])
+    capture = renderer.capture(camera_from_reference, depth_scale=DEPTH_SCALE)
+    assert capture.depth.dtype == np.uint16
+    assert np.count_nonzero(capture.depth) == len(capture.points)
+
+    reference_from_camera = tfms.inverse_matrix(camera_from_reference)
+    points = capture.points / DEPTH_SCALE
+    points = points @ reference_from_camera[:3, :3].T + reference_from_camera[:3, 3]
+    squared_distances = reference_mesh.get_squared_distances(points[::50], method="bvh")
+    assert np.max(squared_distances) < 0.6 ** 2
+
+
+def test_fiducials_are_detected(reference_mesh, renderer):
+    """The rendered markers are found at the projections of the fiducial corners."""
+    camera_from_reference = synthetic.look_at([-30, 20, 320])
+    capture = renderer.capture(camera_from_reference)
+    detected_arucos = fiducials.ArucoDetector(
+        expected_ids=reference_mesh.fiducial_locations).detect(capture.rgb)
+
+    assert set(detected_arucos) == set(reference_mesh.fiducial_locations)
+    camera_matrix = capture.camera_matrix
+    for aruco_id, corners in detected_arucos.items():
+        for location, corner in corners.items():
+            point = camera_from_reference[:3, :3] @ \
+                reference_mesh.get_fiducial_coordinate(aruco_id, location) + \
+                camera_from_reference[:3, 3]
+            expected = [camera_matrix["fx"] * point[0] / point[2] + camera_matrix["ppx"],
+                        camera_matrix["fy"] * point[1] / point[2] + camera_matrix["ppy"]]
+            np.testing.assert_allclose(corner, expected, atol=1.5)
+
+
+def test_written_sequence_is_evaluated(tmpdir, reference_mesh, renderer):
+    """Noisy captures written to a directory go through the whole pipeline."""
+    rng = np.random.RandomState(0)
+    poses = [synthetic.look_at([10 * index, 0, 420]) for index in range(2)]
+    for index, camera_from_reference in enumerate(poses):
+        capture = renderer.capture(
+            camera_from_reference, depth_scale=DEPTH_SCALE, noise=0.5, dropout=0.1, rng=rng)
+        synthetic.write_capture(str(tmpdir), str(index), capture)
+
+    results = list(sequences.evaluate_sequence(
+        reference_mesh, str(tmpdir), None, DEPTH_SCALE, distance_method="bvh"))
+    assert [result.error for result in results] == [None, None]
+    for result in results:
+        assert 0.3 < result.rmse < 1.0
+        assert result.camera_angle[2] > 0.99
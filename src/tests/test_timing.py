@@ -0,0 +1,47 @@
+"""Tests for the timing of the pipeline stages."""
+import json
+import pytest
+import depthquality.timing as timing
+
+
+@pytest.fixture(autouse=True)
+def restore_timing():
+    with timing.enabled(False):
+        yield
+
+
+def test_disabled_stages_are_not_recorded():
+    """With the timing disabled, stages are no-ops."""
+    with timing.record() as events:
+        with timing.stage("corner_matching"):
+            pass
+    assert events == []
+
+
+def test_nested_stages(tmpdir):
+    """Nested stages and recorders all get their events, which summarize and export."""
+    timing.enable()
+
+    @timing.timed("crop")
+    def crop():
+        return 42
+
+    with timing.record() as outer_events:
+        with timing.stage("evaluate_frame"):
+            with timing.record() as inner_events:
+                assert crop() == 42
+                assert crop() == 42
+
+    assert [event.name for event in inner_events] == ["crop", "crop"]
+    assert [event.name for event in outer_events] == ["crop", "crop", "evaluate_frame"]
+    summary = timing.summarize(outer_events)
+    assert set(summary) == {"crop", "evaluate_frame"}
+    assert summary["evaluate_frame"][0] >= summary["crop"][0] >= 0
+
+    filename = str(tmpdir.join("trace.json"))
+    timing.write_chrome_trace(filename, outer_events)
+    with open(filename) as f:
+        trace_events = json.load(f)["traceEvents"]
+    assert [event["name"] for event in trace_events] == ["crop", "crop", "evaluate_frame"]
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in trace_events)
+    assert trace_events[-1]["ts"] <= trace_events[0]["ts"]
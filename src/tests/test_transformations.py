@@ -0,0 +1,74 @@
+"""Tests for the batched rigid transform estimation."""
+import numpy as np
+import pytest
+from depthquality import transformations as tfms
+
+
+def random_point_sets(rng, num_sets, num_points, coplanar=False, noise=1e-3):
+    """Pairs of point sets related by random rigid transforms, with some noise."""
+    v0 = rng.uniform(-0.1, 0.1, size=(num_sets, 3, num_points))
+    if coplanar:
+        # like the corners of the fiducials, which all lie on the backplate
+        v0[:, 2] = 0.00635
+    matrices = np.stack([
+        tfms.concatenate_matrices(
+            tfms.translation_matrix(rng.uniform(-0.5, 0.5, size=3)),
+            tfms.random_rotation_matrix(rng.uniform(size=3)))
+        for _ in range(num_sets)])
+    v1 = np.matmul(matrices[:, :3, :3], v0) + matrices[:, :3, 3:]
+    return v0, v1 + rng.normal(scale=noise, size=v1.shape)
+
+
+@pytest.mark.parametrize("coplanar", [False, True])
+@pytest.mark.parametrize("scale", [False, True])
+def test_matches_single_estimation(coplanar, scale):
+    """Every batched transform is the one estimated for its pair alone."""
+    v0, v1 = random_point_sets(np.random.RandomState(0), 50, 16, coplanar=coplanar)
+
+    matrices = tfms.rigid_matrices_from_points(v0, v1, scale=scale)
+
+    for matrix, points0, points1 in zip(matrices, v0, v1):
+        np.testing.assert_allclose(
+            matrix, tfms.affine_matrix_from_points(points0, points1, shear=False, scale=scale),
+            atol=1e-10)
+
+
+def test_weights_and_masks():
+    """Integer weights repeat points, and masked points are ignored even when they are NaN."""
+    rng = np.random.RandomState(1)
+    v0, v1 = random_point_sets(rng, 20, 10, noise=1e-2)
+    weights = rng.randint(0, 4, size=(20, 10))
+    weights[:, :3] = 1
+
+    matrices = tfms.rigid_matrices_from_points(v0, np.where(weights[:, None] > 0, v1, np.nan),
+                                               weights=weights)
+
+    for matrix, points0, points1, point_weights in zip(matrices, v0, v1, weights):
+        expected = tfms.affine_matrix_from_points(
+            np.repeat(points0, point_weights, axis=1), np.repeat(points1, point_weights, axis=1),
+            shear=False, scale=False)
+        np.testing.assert_allclose(matrix, expected, atol=1e-10)
+
+
+def test_residuals():
+    """The residuals are the distances between the transformed points and their targets."""
+    v0, v1 = random_point_sets(np.random.RandomState(2), 30, 12)
+    matrices = tfms.rigid_matrices_from_points(v0, v1)
+
+    residuals = tfms.transformation_residuals(matrices, v0, v1)
+
+    assert residuals.shape == (30, 12)
+    for matrix, points0, points1, point_residuals in zip(matrices, v0, v1, residuals):
+        transformed = np.dot(matrix[:3, :3], points0) + matrix[:3, 3:]
+        np.testing.assert_allclose(
+            point_residuals, np.linalg.norm(transformed - points1, axis=0))
+    # with noise of 1 mm per coordinate, the residuals are of the order of millimeters
+    assert np.sqrt(np.mean(residuals ** 2)) < 3e-3
+
+
+def test_wrong_shapes():
+    """Point sets must be stacked (B, 3, K) arrays of the same shape."""
+    with pytest.raises(ValueError):
+        tfms.rigid_matrices_from_points(np.zeros((3, 4)), np.zeros((3, 4)))
+    with pytest.raises(ValueError):
+        tfms.rigid_matrices_from_points(np.zeros((2, 3, 4)), np.zeros((2, 3, 5)))